@@ -0,0 +1,314 @@
+"""Warbler's JSON API, version 1.
+
+Read-only JSON under /api/v1 for the home timeline, profiles, messages,
+followers and likes, for clients that would otherwise scrape the pages.
+Each endpoint runs the same query as its page, and is signed in to the
+same way (the session cookie).
+
+`fields` picks which fields each item has, e.g.
+
+    /api/v1/timeline?fields=id,text,user.username
+
+and only those columns are selected; with none, items have every field
+(messages: their author's id, username and image). Lists come a page at a
+time, newest first, with `newer` / `older` cursors for the next `before` /
+`after` like the pages' (lists of users go by user id); `limit` asks for
+shorter pages. The newest page has a `newer` cursor too, to poll for new
+items with; an empty page gives it back unchanged. Responses are gzipped for clients that accept it.
+
+Message ids don't fit in a JavaScript number (see snowflake.py), so they're
+sent as strings.
+"""
+
+import gzip
+import json
+from datetime import datetime
+
+from flask import Blueprint, abort, current_app, g, request
+
+from assets import asset_filter
+from models import db, User, Message, Follows
+from pagination import paginate
+import timeline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GZIP_LEVEL = 6
+
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+class Resource:
+    """The fields items of one kind can have: name -> column.
+
+    `nested` names a related Resource (e.g. a message's `user`), whose
+    fields are asked for with a prefix, as in `user.username`, and a
+    function joining its table to a query of this one's. `default` is the
+    fields items have when none are asked for; all of them, unless given.
+    """
+
+    def __init__(self, key, fields, encoders=None, nested=None, default=None):
+        self.key = key
+        self.fields = fields
+        self.encoders = encoders or {}
+        self.nested = nested or {}
+
+        self.default = list(default or fields)
+        for prefix, (resource, join) in self.nested.items():
+            self.default += [f"{prefix}.{name}" for name in resource.default]
+
+    def requested(self):
+        """Names from the `fields` argument, or the default; aborts with a
+        400 for any this resource doesn't have."""
+
+        value = request.args.get('fields')
+        if value is None:
+            return self.default
+
+        names = list(dict.fromkeys(name.strip() for name in value.split(',')
+                                   if name.strip()))
+        unknown = [name for name in names if self._lookup(name) is None]
+        if unknown:
+            abort(400, f"unknown fields: {', '.join(unknown)}")
+        if not names:
+            abort(400, "no fields given")
+        return names
+
+    def project(self, names):
+        """Function selecting `names`' columns (and the key, as `id`) from a
+        query of this resource."""
+
+        columns = [self.key.label('id')]
+        joins = []
+        for name in names:
+            column = self._lookup(name)[0]
+            if name != 'id':
+                columns.append(column.label(_label(name)))
+
+            prefix = name.partition('.')[0]
+            if prefix in self.nested and self.nested[prefix][1] not in joins:
+                joins.append(self.nested[prefix][1])
+
+        def project(query):
+            for join in joins:
+                query = join(query)
+            return query.with_entities(*columns)
+
+        return project
+
+    def item(self, row, names):
+        """The JSON object for `row`, with `names`' fields."""
+
+        item = {}
+        for name in names:
+            value = getattr(row, _label(name))
+            encode = self._lookup(name)[1]
+            if encode is not None:
+                value = encode(value)
+
+            *parents, field = name.split('.')
+            target = item
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[field] = value
+        return item
+
+    def _lookup(self, name):
+        """(column, encoder) for field `name`, or None."""
+
+        prefix, dot, rest = name.partition('.')
+        if dot:
+            if prefix not in self.nested:
+                return None
+            return self.nested[prefix][0]._lookup(rest)
+
+        if name not in self.fields:
+            return None
+        return self.fields[name], self.encoders.get(name, _ENCODERS.get(name))
+
+
+def _label(name):
+    return name.replace('.', '__')
+
+
+def _timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+# images may be built assets, with their own URLs (see assets.py)
+_ENCODERS = {
+    'timestamp': _timestamp,
+    'image_url': asset_filter,
+    'header_image_url': asset_filter,
+}
+
+USERS = Resource(User.id, {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+})
+
+AUTHORS = Resource(User.id, USERS.fields, default=['id', 'username', 'image_url'])
+
+MESSAGES = Resource(Message.id, {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'like_count': Message.like_count,
+}, encoders={'id': str}, nested={
+    'user': (AUTHORS, lambda query: query.join(User, User.id == Message.user_id)),
+})
+
+
+def dumps(payload):
+    """`payload` as compact JSON bytes, with orjson if it's installed."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('UTF-8')
+
+
+def respond(payload, status=200):
+    """A JSON response of `payload`, gzipped if it's worth it and the
+    client accepts it."""
+
+    body = dumps(payload)
+    response = current_app.response_class(body, status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+
+    if (len(body) >= current_app.config['API_GZIP_MIN_BYTES']
+            and request.accept_encodings['gzip']):
+        response.set_data(gzip.compress(body, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def page_size(default):
+    """The `limit` argument, between 1 and `default` (if not given)."""
+
+    return min(max(request.args.get('limit', default, type=int), 1), default)
+
+
+def message_list(queries, fetch=paginate):
+    """A page of messages from `queries`, fetched by `fetch` (which takes the
+    arguments `pagination.paginate` does)."""
+
+    names = MESSAGES.requested()
+    page = fetch(queries,
+                 before=request.args.get('before'),
+                 after=request.args.get('after'),
+                 per_page=page_size(current_app.config['MESSAGES_PER_PAGE']),
+                 project=MESSAGES.project(names))
+    return respond({'items': [MESSAGES.item(row, names) for row in page.items],
+                    'newer': page.newer, 'older': page.older})
+
+
+def user_list(user_ids):
+    """A page of the users with ids in the `user_ids` query."""
+
+    names = USERS.requested()
+    page = paginate(User.query.filter(User.id.in_(user_ids.subquery())),
+                    before=request.args.get('before'),
+                    after=request.args.get('after'),
+                    per_page=page_size(current_app.config['USERS_PER_PAGE']),
+                    key=User.id,
+                    project=USERS.project(names))
+    return respond({'items': [USERS.item(row, names) for row in page.items],
+                    'newer': page.newer, 'older': page.older})
+
+
+def require_user(user_id):
+    if not User.exists(user_id):
+        abort(404)
+
+
+@blueprint.before_request
+def requires_signed_in():
+    """Everything but profiles and messages is for signed-in users, as the
+    pages are."""
+
+    if not g.user and request.endpoint not in ('api.profile', 'api.message',
+                                                'api.messages', 'api.likes'):
+        abort(401)
+
+
+@blueprint.route('/timeline')
+def home_timeline():
+    """The signed-in user's home timeline."""
+
+    return message_list(g.user.id, fetch=timeline.timeline_page)
+
+
+@blueprint.route('/users/<int:user_id>')
+def profile(user_id):
+    names = USERS.requested()
+    row = (USERS.project(names)(User.query.filter(User.id == user_id))
+           .first_or_404())
+    return respond(USERS.item(row, names))
+
+
+@blueprint.route('/users/<int:user_id>/messages')
+def messages(user_id):
+    require_user(user_id)
+    return message_list(Message.by_author(user_id))
+
+
+@blueprint.route('/users/<int:user_id>/likes')
+def likes(user_id):
+    require_user(user_id)
+    return message_list(Message.liked_by(user_id))
+
+
+@blueprint.route('/users/<int:user_id>/following')
+def following(user_id):
+    require_user(user_id)
+    return user_list(db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == user_id))
+
+
+@blueprint.route('/users/<int:user_id>/followers')
+def followers(user_id):
+    require_user(user_id)
+    return user_list(db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id))
+
+
+@blueprint.route('/messages/<int:message_id>')
+def message(message_id):
+    names = MESSAGES.requested()
+    row = (MESSAGES.project(names)(Message.query.filter(Message.id == message_id))
+           .first_or_404())
+    return respond(MESSAGES.item(row, names))
+
+
+def error(error):
+    return respond({'error': error.description}, error.code)
+
+
+# by code, so these win over the app's HTML error pages
+for code in (400, 401, 404):
+    blueprint.register_error_handler(code, error)
+
+
+def init_app(app):
+    """Serve the API from `app`.
+
+    Responses of API_GZIP_MIN_BYTES or more are gzipped.
+    """
+
+    app.config.setdefault('API_GZIP_MIN_BYTES', 1024)
+    app.register_blueprint(blueprint)
@@ -1,13 +1,33 @@
 import os
+import time
 from re import U
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, Response, render_template, request, flash, redirect, session, g,
+                   jsonify, abort, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from flask_wtf.csrf import CSRFProtect
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
 from auth import requires_signed_in
+import follows
+import api
+import assets
+import caching
+import counters
+import current_user
+import fragments
+import live
+import migrations
+import passwords
+import querystats
+import replicas
+import search
+from pagination import paginate
+import timeline
 
 CURR_USER_KEY = "curr_user"
 
@@ -22,9 +42,96 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Home timelines keep the newest TIMELINE_SIZE message ids per user; accounts
+# with more than TIMELINE_FANOUT_LIMIT followers are merged in at read time.
+app.config['TIMELINE_SIZE'] = int(os.environ.get('TIMELINE_SIZE', 800))
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', 1000))
+# each post trims about one in TIMELINE_TRIM_EVERY of its recipients' timelines
+app.config['TIMELINE_TRIM_EVERY'] = int(os.environ.get('TIMELINE_TRIM_EVERY', 16))
+app.config['MESSAGES_PER_PAGE'] = 100
+
+# Per-request query counts/timings go in a Server-Timing header and the log;
+# requests spending longer than this in the database log a warning.
+app.config['QUERY_STATS_HEADER'] = True
+app.config['SLOW_REQUEST_DB_MS'] = int(os.environ.get('SLOW_REQUEST_DB_MS', 200))
+
+# The logged-in user's id, name, images and counts are cached per process
+# for up to CURRENT_USER_CACHE_TTL seconds.
+app.config['CURRENT_USER_CACHE_SIZE'] = 1024
+app.config['CURRENT_USER_CACHE_TTL'] = int(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 30))
+
+# Passwords are hashed in a pool of processes; pick the cost for this host
+# with `flask calibrate-bcrypt`.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_POOL_WORKERS'] = int(
+    os.environ.get('PASSWORD_POOL_WORKERS', os.cpu_count() or 1))
+app.config['USERS_PER_PAGE'] = 60
+# 'postgres' needs the pg_trgm indexes from `flask upgrade-db`; 'auto' uses
+# them when present and an in-process index otherwise
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+
+# Pages are revalidated with ETags on every use (see caching.py); static
+# files may be reused for this many seconds without asking.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(
+    os.environ.get('STATIC_MAX_AGE', 7 * 24 * 60 * 60))
+
+# Connection pool per process (see models.connect_db); /metrics reports on
+# it, only to scrapers sending METRICS_TOKEN if that's set
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_POOL_MAX_OVERFLOW'] = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 2))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '0') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# GET requests read from a replica, if there is one; for READ_YOUR_WRITES_SECONDS
+# after a browser's request writes, it's sent to the primary (see replicas.py)
+if os.environ.get('REPLICA_DATABASE_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['REPLICA_DATABASE_URL']}
+app.config['READ_YOUR_WRITES_SECONDS'] = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+
+# Rendered message cards, shared between viewers (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+
+# Most user ids one bulk follow/unfollow request may name
+app.config['FOLLOW_BULK_LIMIT'] = int(os.environ.get('FOLLOW_BULK_LIMIT', 5000))
+
+# Live home timeline updates (see live.py): 'memory' reaches this process's
+# streams only; 'postgres' passes messages between processes with NOTIFY
+app.config['LIVE_BROKER'] = os.environ.get('LIVE_BROKER', 'memory')
+app.config['LIVE_LISTEN_URL'] = os.environ.get('LIVE_LISTEN_URL')
+app.config['LIVE_BUFFER_SIZE'] = int(os.environ.get('LIVE_BUFFER_SIZE', 100))
+app.config['LIVE_HEARTBEAT_SECONDS'] = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', 15))
+app.config['LIVE_MAX_SECONDS'] = float(os.environ.get('LIVE_MAX_SECONDS', 300))
+app.config['LIVE_MAX_STREAMS'] = int(os.environ.get('LIVE_MAX_STREAMS', 1000))
+
+# JSON API responses at least this long are gzipped (see api.py)
+app.config['API_GZIP_MIN_BYTES'] = int(os.environ.get('API_GZIP_MIN_BYTES', 1024))
+
 toolbar = DebugToolbarExtension(app)
 
+# every POST needs a CSRF token, from a form field or an X-CSRFToken header
+csrf = CSRFProtect(app)
+
 connect_db(app)
+querystats.init_app(app)
+replicas.init_app(app, db)
+current_user.init_app(app)
+passwords.init_app(app)
+search.init_app(app)
+assets.init_app(app)
+caching.init_app(app)
+fragments.init_app(app)
+live.init_app(app)
+api.init_app(app)
+
+# Pages listing messages render each one's author, so timeline-shaped
+# queries load authors in the same SELECT instead of lazily per card.
+TIMELINE_LOADING = [joinedload(Message.user)]
 
 
 ##############################################################################
@@ -33,15 +140,49 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached current_user.CurrentUser; the full User row is only
+    fetched if a route needs more than the cached fields.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = current_user.load(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.context_processor
+def add_follow_state():
+    """Make the current user's follow state available to templates."""
+
+    return {'follow_state': follow_state()}
+
+
+def follow_state():
+    """FollowState for the logged-in user, shared for the whole request.
+
+    Returns None if no one is logged in (or the request was refused before
+    we looked, e.g. for a bad CSRF token).
+    """
+
+    if not g.get('user'):
+        return None
+
+    if getattr(g, 'follow_state', None) is None:
+        g.follow_state = follows.FollowState(g.user.id)
+
+    return g.follow_state
+
+
+def wants_json():
+    """Did the request ask for JSON (e.g. from warbler.js) over a page?"""
+
+    return (request.accept_mimetypes.best_match(['text/html', 'application/json'])
+            == 'application/json')
+
+
 def do_login(user):
     """Log in user."""
 
@@ -78,6 +219,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            search.index_user(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -102,6 +244,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -127,34 +271,53 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations, and a 'page' param to page through the results.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
 
-    if not search:
-        users = User.query.all()
+    if not q:
+        users = search.all_users(page, app.config['USERS_PER_PAGE'])
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search.search_users(q, page, app.config['USERS_PER_PAGE'])
+
+    if g.user:
+        follow_state().load(user.id for user in users)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, q=q)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Takes a 'before' or 'after' cursor in the querystring to page through
+    older or newer messages.
+    """
+
+    user, viewer = (db.session
+                    .query(User, caching.viewer_versions())
+                    .filter(User.id == user_id)
+                    .first_or_404())
 
-    user = User.query.get_or_404(user_id)
+    validator = caching.Validator('users_show', user.id, user.profile_version,
+                                  user.activity_version, request.args.get('before'),
+                                  request.args.get('after'), viewer=viewer)
+    if validator.fresh():
+        return validator.not_modified()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate(Message.by_author(user_id),
+                    before=request.args.get('before'),
+                    after=request.args.get('after'),
+                    per_page=app.config['MESSAGES_PER_PAGE'],
+                    options=TIMELINE_LOADING)
+
+    return validator.tag(render_template('users/show.html', user=user,
+                                         messages=page.items, page=page))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -162,8 +325,24 @@ def users_show(user_id):
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user, profiles, viewer = (db.session
+                              .query(User, caching.profile_versions(
+                                  db.session
+                                  .query(Follows.user_being_followed_id)
+                                  .filter(Follows.user_following_id == user_id)),
+                                  caching.viewer_versions())
+                              .filter(User.id == user_id)
+                              .first_or_404())
+
+    validator = caching.Validator('show_following', user.id, user.profile_version,
+                                  user.activity_version, profiles, viewer=viewer)
+    if validator.fresh():
+        return validator.not_modified()
+
+    if g.user:
+        follow_state().load([user.id] + [followed.id for followed in user.following])
+
+    return validator.tag(render_template('users/following.html', user=user))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -171,20 +350,41 @@ def show_following(user_id):
 def users_followers(user_id):
     """Show list of followers of this user."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user, profiles, viewer = (db.session
+                              .query(User, caching.profile_versions(
+                                  db.session
+                                  .query(Follows.user_following_id)
+                                  .filter(Follows.user_being_followed_id == user_id)),
+                                  caching.viewer_versions())
+                              .filter(User.id == user_id)
+                              .first_or_404())
+
+    validator = caching.Validator('users_followers', user.id, user.profile_version,
+                                  user.activity_version, profiles, viewer=viewer)
+    if validator.fresh():
+        return validator.not_modified()
+
+    if g.user:
+        follow_state().load([user.id] + [follower.id for follower in user.followers])
+
+    return validator.tag(render_template('users/followers.html', user=user))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 @requires_signed_in
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    Following someone twice is the same as following them once.
+    """
 
-    return redirect(f"/users/{g.user.id}/following")
+    if follows.follow(g.user.id, [follow_id]):
+        db.session.commit()
+        current_user.invalidate(g.user.id, follow_id)
+    elif not User.exists(follow_id):
+        abort(404)
+
+    return follow_response(follow_id, True)
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
@@ -192,11 +392,75 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if follows.unfollow(g.user.id, [follow_id]):
+        db.session.commit()
+        current_user.invalidate(g.user.id, follow_id)
+
+    return follow_response(follow_id, False)
+
+
+@app.route('/users/follows', methods=['POST'])
+@requires_signed_in
+def bulk_follow():
+    """Follow or unfollow many users at once, in one transaction.
+
+    Takes JSON like {"follow": [2, 3], "unfollow": [4]} (either list may be
+    left out). Returns the ids whose state changed and the logged-in user's
+    updated following count.
+    """
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    requested = {}
+    for action in ('follow', 'unfollow'):
+        user_ids = body.get(action, [])
+        if (not isinstance(user_ids, list)
+                or not all(type(user_id) is int for user_id in user_ids)):
+            abort(400)
+        requested[action] = user_ids
+
+    if sum(map(len, requested.values())) > app.config['FOLLOW_BULK_LIMIT']:
+        abort(413)
+
+    followed = follows.follow(g.user.id, requested['follow'])
+    unfollowed = follows.unfollow(g.user.id, requested['unfollow'])
     db.session.commit()
+    current_user.invalidate(g.user.id, *followed, *unfollowed)
+
+    following_count = (db.session
+                       .query(User.following_count)
+                       .filter(User.id == g.user.id)
+                       .scalar())
+
+    return jsonify(followed=sorted(followed),
+                   unfollowed=sorted(unfollowed),
+                   following_count=following_count)
+
+
+def follow_response(user_id, following):
+    """The logged-in user's new follow state for `user_id`.
+
+    JSON, with both users' updated counts, if the request asked for it;
+    otherwise a redirect to the user's following page.
+    """
 
-    return redirect(f"/users/{g.user.id}/following")
+    if not wants_json():
+        return redirect(f"/users/{g.user.id}/following")
+
+    counts = {row.id: row for row in
+              db.session
+              .query(User.id, User.followers_count, User.following_count)
+              .filter(User.id.in_([user_id, g.user.id]))}
+    if user_id not in counts:
+        abort(404)
+
+    return jsonify(user_id=user_id,
+                   following=following,
+                   followers_count=counts[user_id].followers_count,
+                   follower_id=g.user.id,
+                   following_count=counts[g.user.id].following_count)
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -204,7 +468,7 @@ def stop_following(follow_id):
 def profile():
     """Update profile for current user."""
 
-    user = g.user
+    user = g.user.load()
     form = UserUpdateForm(obj=user)
 
     if form.validate_on_submit():
@@ -216,6 +480,9 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            current_user.invalidate(user.id)
+            fragments.invalidate_author(user.id)
+            search.index_user(user)
             flash(f"{user.username} successfully updated", "success")
             return redirect(f'/users/{user.id}')
         
@@ -232,8 +499,15 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    followed = [followed.id for followed in g.user.following]
+    timeline.remove_user(g.user.id)
+    db.session.delete(g.user.load())
+    db.session.flush()
+    timeline.backfill_unpulled(followed)
     db.session.commit()
+    current_user.invalidate(g.user.id)
+    fragments.invalidate_author(g.user.id)
+    search.unindex_user(g.user.id)
 
     return redirect("/signup")
 
@@ -241,38 +515,110 @@ def delete_user():
 @app.route('/users/add_like/<int:message_id>', methods=['POST'])
 @requires_signed_in
 def add_like(message_id):
-    """Like a warble"""
+    """Like a warble.
 
-    if message_id in [m.id for m in g.user.messages]:
-        flash("You can't like your own message", "warning")
-    else:
-        like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(like)
+    Liking a message twice is the same as liking it once.
+    """
+
+    if message_author(message_id) == g.user.id:
+        return like_response(message_id, False, "You can't like your own message")
+
+    if Likes.add(g.user.id, message_id):
         db.session.commit()
-        flash("Message liked", "success")
-    return redirect("/")
+        current_user.invalidate(g.user.id)
+
+    return like_response(message_id, True)
 
 @app.route('/users/remove_like/<int:message_id>', methods=['POST'])
 @requires_signed_in
 def remove_like(message_id):
     "Unlike a warble"
 
-    if message_id in [m.id for m in g.user.messages]:
-        flash("You can't unlike your own message", "warning")
-    else:
-        like = Likes.query.filter_by(message_id=message_id).first()
-        db.session.delete(like)
+    if message_author(message_id) == g.user.id:
+        return like_response(message_id, False, "You can't unlike your own message")
+
+    if Likes.remove(g.user.id, message_id):
         db.session.commit()
-        flash("Message unliked", "success")
-    return redirect("/")
+        current_user.invalidate(g.user.id)
+
+    return like_response(message_id, False)
+
+
+def message_author(message_id):
+    """Id of the user who posted `message_id`; 404s if there's no such message."""
+
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+
+    return author_id
+
+
+def like_response(message_id, liked, refused=None):
+    """The logged-in user's new like state for `message_id`.
+
+    JSON, with the user's and the message's updated like counts, if the
+    request asked for it (a 403 if the like was `refused`, with the
+    reason); otherwise a redirect to the homepage, flashing what happened.
+    """
+
+    if not wants_json():
+        if refused:
+            flash(refused, "warning")
+        else:
+            flash("Message liked" if liked else "Message unliked", "success")
+        return redirect("/")
+
+    if refused:
+        return jsonify(message_id=message_id, error=refused), 403
+
+    likes_count, like_count = (db.session
+                               .query(User.likes_count, Message.like_count)
+                               .filter(User.id == g.user.id, Message.id == message_id)
+                               .one())
+
+    return jsonify(message_id=message_id,
+                   liked=liked,
+                   like_count=like_count,
+                   user_id=g.user.id,
+                   likes_count=likes_count)
 
 @app.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
-    """Show the messages a user has liked"""
+    """Show the messages a user has liked.
+
+    Pages with 'before' / 'after' cursors, like the user's own messages.
+    """
 
-    user = User.query.get_or_404(user_id)
-    
-    return render_template('/users/likes.html', user=user)
+    # the authors of the liked messages are on the page too
+    user, authors, viewer = (db.session
+                             .query(User, caching.profile_versions(
+                                 db.session
+                                 .query(Message.user_id)
+                                 .join(Likes, Likes.message_id == Message.id)
+                                 .filter(Likes.user_id == user_id)),
+                                 caching.viewer_versions())
+                             .filter(User.id == user_id)
+                             .first_or_404())
+
+    validator = caching.Validator('show_likes', user.id, user.profile_version,
+                                  user.activity_version, authors,
+                                  request.args.get('before'), request.args.get('after'),
+                                  viewer=viewer)
+    if validator.fresh():
+        return validator.not_modified()
+
+    page = paginate(Message.liked_by(user_id),
+                    before=request.args.get('before'),
+                    after=request.args.get('after'),
+                    per_page=app.config['MESSAGES_PER_PAGE'],
+                    options=TIMELINE_LOADING)
+
+    return validator.tag(render_template('/users/likes.html', user=user,
+                                         likes=page.items, page=page))
 
 
 ##############################################################################
@@ -293,9 +639,13 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        live.publish(g.user.id, msg.id)
         db.session.commit()
+        current_user.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -306,8 +656,19 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg, viewer = (db.session
+                   .query(Message, caching.viewer_versions())
+                   .options(*TIMELINE_LOADING)
+                   .filter(Message.id == message_id)
+                   .first_or_404())
+
+    # messages don't change once posted
+    validator = caching.Validator('messages_show', msg.id, msg.user.profile_version,
+                                  viewer=viewer, last_modified=msg.timestamp)
+    if validator.fresh():
+        return validator.not_modified()
+
+    return validator.tag(render_template('messages/show.html', message=msg))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -317,12 +678,15 @@ def messages_destroy(message_id):
 
     msg = Message.query.get(message_id)
 
-    if msg.user != g.user:
+    if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    timeline.remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    current_user.invalidate(g.user.id)
+    fragments.invalidate_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -336,30 +700,150 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, paged with
+      'before' / 'after' cursors in the querystring
     """
 
     if g.user:
-        following_users = [following.id for following in g.user.following] + [g.user.id]
+        page = timeline.timeline_page(g.user.id,
+                                      before=request.args.get('before'),
+                                      after=request.args.get('after'),
+                                      per_page=app.config['MESSAGES_PER_PAGE'],
+                                      options=TIMELINE_LOADING)
+        messages = page.items
+
+        # only the likes among the messages on this page
+        likes = set()
+        if messages:
+            likes = {message_id for (message_id,) in
+                     db.session
+                     .query(Likes.message_id)
+                     .filter(Likes.user_id == g.user.id,
+                             Likes.message_id.in_([msg.id for msg in messages]))}
+
+        return render_template('home.html', messages=messages, likes=likes,
+                               page=page)
+
+    else:
+        return render_template('home-anon.html')
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
+
+@app.route('/timeline/stream')
+@requires_signed_in
+def timeline_stream():
+    """Stream new messages for the home timeline, as Server-Sent Events.
+
+    Each `messages` event's data is the new messages' list items, newest
+    first; its id is the newest message's id, so a reconnecting browser's
+    Last-Event-ID picks up where it left off. A `reset` event means
+    messages were missed, and the page should be reloaded.
+    """
+
+    if live.broker.subscriber_count() >= app.config['LIVE_MAX_STREAMS']:
+        return render_template('/errors/503.html'), 503, {'Retry-After': '10'}
+
+    user_id = g.user.id
+    followed = [followed_id for (followed_id,) in
+                db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id)]
+    subscription = live.broker.subscribe(followed + [user_id])
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    def render(message_ids):
+        messages = (Message.query
+                    .options(*TIMELINE_LOADING)
+                    .filter(Message.id.in_(message_ids))
+                    .order_by(Message.id.desc())
                     .all())
+        likes = {message_id for (message_id,) in
+                 db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == user_id,
+                         Likes.message_id.in_(message_ids))}
+        return render_template('messages/live.html', messages=messages, likes=likes)
+
+    def missed(since):
+        """Ids of messages posted since `since`, or None if too many."""
+
+        limit = app.config['LIVE_BUFFER_SIZE']
+        message_ids = [message_id for (message_id,) in
+                       timeline.followed_query(user_id)
+                       .with_entities(Message.id)
+                       .filter(Message.id > since)
+                       .order_by(Message.id)
+                       .limit(limit + 1)]
+        return message_ids if len(message_ids) <= limit else None
+
+    def events():
+        with subscription:
+            yield f"retry: {int(app.config['LIVE_HEARTBEAT_SECONDS'] * 1000)}\n\n"
+
+            # hold no connection between events; and read new messages from
+            # the primary, which a replica may not have caught up with yet
+            db.session.remove()
+
+            caught_up = set()
+            if last_id is not None:
+                message_ids = missed(last_id)
+                if message_ids is None:
+                    yield live.sse('reset', render_template('messages/live-reset.html'))
+                    return
+                if message_ids:
+                    yield live.sse('messages', render(message_ids), id=message_ids[-1])
+                    db.session.remove()
+                caught_up.update(message_ids)
+
+            deadline = time.monotonic() + app.config['LIVE_MAX_SECONDS']
+            while time.monotonic() < deadline:
+                message_ids = [message_id for message_id in
+                               subscription.get(app.config['LIVE_HEARTBEAT_SECONDS'])
+                               if message_id not in caught_up]
+                if subscription.overflowed:
+                    yield live.sse('reset', render_template('messages/live-reset.html'))
+                    return
+                if not message_ids:
+                    yield live.sse(comment='heartbeat')
+                    continue
+
+                yield live.sse('messages', render(message_ids), id=max(message_ids))
+                db.session.remove()
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    # events() never starts for a HEAD request, or a client gone before the
+    # first chunk; the server still closes the response
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Connection pool metrics, for Prometheus to scrape.
+
+    If METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
 
-        likes = [i.id for i in g.user.likes]
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
 
-        return render_template('home.html', messages=messages, likes=likes)
+    engines = {'primary': db.engine}
+    if replicas.has_replica(app):
+        engines[replicas.REPLICA] = db.get_engine(app, bind=replicas.REPLICA)
 
-    else:
-        return render_template('home-anon.html')
+    return (querystats.pool_metrics(engines), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
 
 #====================================================================================
 # error handlers
 #====================================================================================
 
+@app.errorhandler(400)
+def bad_request(error):
+    return render_template('/errors/400.html'), 400
+
 @app.errorhandler(404)
 def resource_not_found(error):
     return render_template('/errors/404.html'), 404
@@ -372,24 +856,106 @@ def resource_not_found(error):
 def resource_not_found(error):
     return render_template('/errors/403.html'), 403
 
+@app.errorhandler(passwords.PasswordPoolBusy)
+def password_pool_busy(error):
+    return render_template('/errors/503.html'), 503, {'Retry-After': '1'}
+
+@app.errorhandler(PoolTimeoutError)
+def database_pool_busy(error):
+    db.session.rollback()
+    app.logger.warning(f"database pool exhausted: {error}")
+    return render_template('/errors/503.html'), 503, {'Retry-After': '1'}
+
 @app.errorhandler(500)
 def resource_not_found(error):
     return render_template('/errors/500.html'), 500
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# CLI commands
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--batch-size', default=500,
+              help='Number of users to rebuild per transaction.')
+def rebuild_timelines(batch_size):
+    """Backfill every user's home timeline from messages and follows."""
+
+    total = timeline.rebuild_all(batch_size)
+    click.echo(f"Rebuilt home timelines for {total} users.")
+
+
+@app.cli.command('reconcile-counts')
+@click.option('--dry-run', is_flag=True,
+              help="Report drift without correcting it.")
+def reconcile_counts(dry_run):
+    """Recompute users' follower/following/message/like counts, and
+    messages' like counts."""
+
+    verb = "Found" if dry_run else "Corrected"
+
+    for model, drift in counters.reconcile_all(fix=not dry_run).items():
+        for entry in drift:
+            changes = ', '.join(f"{name} {entry[name][0]} -> {entry[name][1]}"
+                                for name, column in counters.COUNTED_BY_MODEL[model]
+                                if name in entry)
+            click.echo(f"{model.__name__} #{entry['id']}: {changes}")
+
+        click.echo(f"{verb} drift for {len(drift)} {model.__tablename__}.")
+
+
+@app.cli.command('follow-users')
+@click.argument('follower_id', type=int)
+@click.argument('user_ids', type=int, nargs=-1)
+@click.option('--from-file', type=click.File(),
+              help='Also read user ids, one per line, from this file ("-" for stdin).')
+@click.option('--unfollow', is_flag=True,
+              help='Stop following the users instead.')
+def follow_users(follower_id, user_ids, from_file, unfollow):
+    """Have FOLLOWER_ID follow (or unfollow) USER_IDS, in one transaction."""
+
+    user_ids = list(user_ids)
+    if from_file:
+        user_ids.extend(int(line) for line in from_file if line.strip())
+
+    if not User.exists(follower_id):
+        raise click.BadParameter(f"no user #{follower_id}", param_hint='FOLLOWER_ID')
+
+    change = follows.unfollow if unfollow else follows.follow
+    changed = change(follower_id, user_ids)
+    db.session.commit()
+
+    verb = "Unfollowed" if unfollow else "Followed"
+    click.echo(f"{verb} {len(changed)} of {len(user_ids)} users for user #{follower_id}.")
+
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250,
+              help='Longest acceptable time to hash one password.')
+def calibrate_bcrypt(target_ms):
+    """Pick the bcrypt cost that hashes within --target-ms on this host."""
+
+    rounds, timings = passwords.calibrate(target_ms)
+
+    for cost, ms in timings.items():
+        click.echo(f"cost {cost:2}: {ms:8.1f} ms")
+
+    click.echo(f"Set BCRYPT_LOG_ROUNDS={rounds}. Existing hashes are "
+               "upgraded as their users log in.")
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """Bring an existing database's schema up to date."""
+
+    for statement in migrations.upgrade():
+        click.echo(f"Skipped (not supported by this database): {statement}")
+    click.echo("Database schema is up to date.")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and compress static/ into ASSETS_DIR for serving."""
+
+    built = assets.build(os.path.join(app.root_path, 'static'), app.config['ASSETS_DIR'])
+    click.echo(f"Built {len(built)} assets into {app.config['ASSETS_DIR']}.")
@@ -0,0 +1,191 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+`flask build-assets` copies everything under static/ into dist/ with a
+hash of its contents in the name (style.css -> style.3b8f0c2e91d4.css),
+plus gzip (and, if the `brotli` package is installed, brotli) variants of
+text files, and writes dist/manifest.json mapping each original path to its
+hashed one. References to /static/ files inside stylesheets are rewritten
+to the hashed names first, so a stylesheet's hash changes with its images.
+
+Templates link to assets with `asset_url('stylesheets/style.css')`, or
+pass stored URLs like a user's default avatar through the `asset` filter.
+Both fall back to the plain /static/ URL for files not in the manifest
+(e.g. before the first build). Hashed files never change, so they're
+served with a year-long immutable Cache-Control, in the best encoding the
+browser accepts.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+from hashlib import sha256
+from io import BytesIO
+
+from flask import abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map', '.html'}
+MANIFEST = 'manifest.json'
+YEAR = 365 * 24 * 60 * 60
+
+# ('br' or 'gzip', file suffix), in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_URL = re.compile(r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+manifest = {}
+
+
+def init_app(app):
+    """Serve built assets and make `asset_url` / `asset` available to templates.
+
+    ASSETS_DIR is where `build` writes to (dist/ by default).
+    """
+
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.root_path, 'dist'))
+    load(app.config['ASSETS_DIR'])
+
+    # pages link to hashed names, so their ETags should change with them
+    app.config.setdefault('ASSETS_VERSION', manifest_version())
+
+    app.add_url_rule('/assets/<path:filename>', 'asset',
+                     lambda filename: serve(app.config['ASSETS_DIR'], filename))
+    app.add_template_global(asset_url)
+    app.add_template_filter(asset_filter, 'asset')
+
+
+def load(directory):
+    """Read the manifest written to `directory`, if there is one."""
+
+    manifest.clear()
+
+    path = os.path.join(directory, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest.update(json.load(f))
+
+
+def manifest_version():
+    """Short hash of the current manifest ('' if there isn't one)."""
+
+    if not manifest:
+        return ''
+    return sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def asset_url(path):
+    """URL of the static file at `path` (relative to static/)."""
+
+    if path in manifest:
+        return url_for('asset', filename=manifest[path])
+    return url_for('static', filename=path)
+
+
+def asset_filter(url):
+    """`url`, pointed at the hashed asset if it's a built /static/ file."""
+
+    if url and url.startswith('/static/') and url[len('/static/'):] in manifest:
+        return asset_url(url[len('/static/'):])
+    return url
+
+
+def serve(directory, filename):
+    """Send a hashed asset, compressed if the browser accepts it."""
+
+    if filename == MANIFEST or '..' in filename.split('/'):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if (request.accept_encodings[encoding]
+                and os.path.isfile(os.path.join(directory, filename + suffix))):
+            response = send_from_directory(directory, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={YEAR}, immutable'
+    return response
+
+
+def build(source, destination):
+    """Fingerprint and compress every file under `source` into `destination`.
+
+    Returns the new manifest. Files from earlier builds are left in place,
+    so pages cached before a deploy can still load their assets.
+    """
+
+    built = {}
+    files = []
+
+    for directory, subdirectories, names in os.walk(source):
+        for name in names:
+            path = os.path.join(directory, name)
+            files.append(os.path.relpath(path, source).replace(os.sep, '/'))
+
+    # stylesheets last, so the files they reference already have hashes
+    for path in sorted(files, key=lambda path: (path.endswith('.css'), path)):
+        with open(os.path.join(source, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = _rewrite_urls(content.decode(), built).encode()
+
+        stem, extension = os.path.splitext(path)
+        hashed = f'{stem}.{sha256(content).hexdigest()[:12]}{extension}'
+        built[path] = hashed
+
+        target = os.path.join(destination, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        _write(target, content)
+
+        if extension in COMPRESSIBLE:
+            for suffix, compressed in _compress(content):
+                if len(compressed) < len(content):
+                    _write(target + suffix, compressed)
+
+    _write(os.path.join(destination, MANIFEST),
+           json.dumps(built, indent=2, sort_keys=True).encode())
+
+    manifest.clear()
+    manifest.update(built)
+
+    return built
+
+
+def _rewrite_urls(css, built):
+    def hashed(match):
+        path = match.group(2)
+        if path not in built:
+            return match.group(0)
+        return f'url({match.group(1)}/assets/{built[path]}{match.group(1)})'
+
+    return STATIC_URL.sub(hashed, css)
+
+
+def _compress(content):
+    """(suffix, compressed content) for each encoding available here."""
+
+    buffer = BytesIO()
+    # no timestamp in the header, so rebuilding gives the same bytes
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    yield '.gz', buffer.getvalue()
+
+    if brotli is not None:
+        yield '.br', brotli.compress(content)
+
+
+def _write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
@@ -0,0 +1,352 @@
+"""Route-level benchmark of Warbler.
+
+Seeds a database with generated data, then drives the main routes through
+the app's WSGI interface (Flask's test client, so no network or server is
+involved) and reports, per route, latency percentiles, throughput and the
+queries each request ran:
+
+    createdb warbler-bench
+    python benchmark.py --users 10000 --messages 100000 --follows 200000
+    python benchmark.py --no-seed --out after.json --baseline before.json
+
+Results are saved as JSON. Given a `--baseline` from an earlier run, any
+route whose p95 latency got more than `--tolerance` worse, that runs more
+queries per request (by over `--query-slack`, on average) or that returned
+errors is reported as a regression, and the benchmark exits with status 1.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import aliased
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Likes, Message, User
+import counters
+import querystats
+import seed
+
+# fraction of messages given a like when seeding
+LIKED_FRACTION = 0.3
+
+
+class Request:
+    """One planned request: who makes it, and what it is."""
+
+    def __init__(self, user_id, path, method='GET', data=None):
+        self.user_id = user_id
+        self.path = path
+        self.method = method
+        self.data = data
+
+
+def plan_homepage(rng, users, count):
+    return [Request(rng.choice(users), '/') for i in range(count)]
+
+
+def plan_users_show(rng, users, count):
+    return [Request(rng.choice(users), f'/users/{rng.choice(users)}')
+            for i in range(count)]
+
+
+def plan_list_users(rng, users, count):
+    usernames = [username for (username,) in
+                 db.session.query(User.username).filter(User.id.in_(users))]
+
+    # alternate listing everyone with searching for part of a username
+    return [Request(rng.choice(users),
+                    '/users' if i % 2 else f'/users?q={rng.choice(usernames)[:4]}')
+            for i in range(count)]
+
+
+def plan_show_likes(rng, users, count):
+    return [Request(rng.choice(users), f'/users/{rng.choice(users)}/likes')
+            for i in range(count)]
+
+
+def plan_show_following(rng, users, count):
+    return [Request(rng.choice(users), f'/users/{rng.choice(users)}/following')
+            for i in range(count)]
+
+
+def plan_add_follow(rng, users, count):
+    """Follows between users who don't follow each other yet.
+
+    Up to `count` of them, picked (reproducibly, from `rng`) in one query:
+    fewer if the users already follow nearly everyone.
+    """
+
+    follower = aliased(User)
+    followed = aliased(User)
+
+    already = (db.session
+               .query(Follows.user_following_id)
+               .filter(Follows.user_following_id == follower.id)
+               .filter(Follows.user_being_followed_id == followed.id))
+
+    # a shuffle that's the same for the same rng
+    salt = str(rng.random())
+    shuffle = func.md5(func.concat(follower.id, ':', followed.id, ':', salt))
+
+    planned = (db.session
+               .query(follower.id, followed.id)
+               .filter(follower.id.in_(users))
+               .filter(follower.id != followed.id)
+               .filter(~already.exists())
+               .order_by(shuffle)
+               .limit(count))
+
+    return [Request(follower_id, f'/users/follow/{followed_id}', 'POST')
+            for follower_id, followed_id in sorted(planned)]
+
+
+def plan_add_like(rng, users, count):
+    """Likes of messages no one has liked yet, by someone besides their author."""
+
+    unliked = (db.session
+               .query(Message.id, Message.user_id)
+               .filter(~Message.id.in_(db.session.query(Likes.message_id)))
+               .order_by(Message.id)
+               .limit(count))
+
+    planned = []
+    for message_id, author_id in unliked:
+        user_id = rng.choice(users)
+        while user_id == author_id:
+            user_id = rng.choice(users)
+        planned.append(Request(user_id, f'/users/add_like/{message_id}', 'POST'))
+
+    return planned
+
+
+def plan_messages_add(rng, users, count):
+    return [Request(rng.choice(users), '/messages/new', 'POST',
+                    {'text': f'Benchmark warble {i}'})
+            for i in range(count)]
+
+
+PLANS = {
+    'homepage': plan_homepage,
+    'users_show': plan_users_show,
+    'list_users': plan_list_users,
+    'show_likes': plan_show_likes,
+    'show_following': plan_show_following,
+    'add_follow': plan_add_follow,
+    'add_like': plan_add_like,
+    'messages_add': plan_messages_add,
+}
+
+
+def percentile(values, fraction):
+    """The `fraction` percentile of `values` (nearest rank)."""
+
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def seed_data(users, messages, follows, random_seed):
+    """Replace the database's contents with generated data."""
+
+    with TemporaryDirectory() as directory:
+        subprocess.run(
+            [sys.executable, os.path.join('generator', 'create_csvs.py'),
+             '--users', str(users), '--messages', str(messages),
+             '--follows', str(follows), '--seed', str(random_seed),
+             '--out', directory],
+            check=True, stdout=subprocess.DEVNULL)
+
+        seed.load(directory)
+
+    # the generator doesn't make likes; like a fraction of messages, each
+    # by a random user other than its author
+    db.session.execute(text("SELECT setseed(0.5)"))
+    db.session.execute(text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT liker, id FROM (
+            SELECT id, user_id, 1 + floor(random() * :users)::int AS liker
+            FROM messages
+            WHERE random() < :fraction
+        ) AS picked
+        WHERE liker != user_id
+    """), {'users': users, 'fraction': LIKED_FRACTION})
+    db.session.commit()
+    counters.reconcile_all(report=False)
+
+
+def run_route(client, requests, warmup):
+    """Make `requests` in turn; return the route's measurements."""
+
+    latencies = []
+    queries = []
+    db_time = 0.0
+    errors = 0
+
+    for i, planned in enumerate(requests):
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = planned.user_id
+
+        with querystats.record_requests() as recorded:
+            start = perf_counter()
+            response = client.open(planned.path, method=planned.method,
+                                   data=planned.data)
+            elapsed = perf_counter() - start
+
+        if response.status_code >= 400:
+            errors += 1
+
+        if i < warmup:
+            continue
+
+        latencies.append(elapsed)
+        for name, stats in recorded:
+            queries.append(stats.count)
+            db_time += stats.total
+
+    measured = len(latencies)
+
+    return {
+        'requests': measured,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': measured / sum(latencies),
+        'queries_per_request': sum(queries) / measured,
+        'db_ms_per_request': db_time * 1000 / measured,
+    }
+
+
+def benchmark(routes, count, warmup, sample_size, random_seed):
+    """Benchmark `routes` with `count` (+ `warmup`) requests each.
+
+    Call this outside an app context, so each request gets its own (and
+    its own database session), as it would in a server.
+    """
+
+    rng = Random(random_seed)
+    with app.app_context():
+        all_users = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    users = rng.sample(all_users, min(sample_size, len(all_users)))
+
+    client = app.test_client()
+    results = {}
+
+    for route in routes:
+        with app.app_context():
+            requests = PLANS[route](rng, users, count + warmup)
+
+        results[route] = run_route(client, requests, warmup)
+
+    return results
+
+
+def compare(results, baseline, tolerance, query_slack=0.5):
+    """Regressions in `results` against `baseline`, as messages."""
+
+    regressions = []
+
+    for route, current in results['routes'].items():
+        previous = baseline['routes'].get(route)
+        if previous is None:
+            continue
+
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{route}: p95 {previous['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms")
+
+        # averages wobble a little as the data changes between runs; an
+        # extra query in every request (an N+1) doesn't
+        if current['queries_per_request'] > previous['queries_per_request'] + query_slack:
+            regressions.append(
+                f"{route}: queries/request {previous['queries_per_request']:.2f} "
+                f"-> {current['queries_per_request']:.2f}")
+
+    for route, current in results['routes'].items():
+        if current['errors']:
+            regressions.append(f"{route}: {current['errors']} error responses")
+
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Warbler's routes in-process.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="benchmark the data already in the database")
+    parser.add_argument('--routes', nargs='+', choices=list(PLANS), default=list(PLANS))
+    parser.add_argument('--requests', type=int, default=200,
+                        help="measured requests per route")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="unmeasured requests per route, made first")
+    parser.add_argument('--sample-users', type=int, default=100,
+                        help="how many users make (and are targets of) requests")
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--baseline', help="results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed fractional p95 slowdown against the baseline")
+    parser.add_argument('--query-slack', type=float, default=0.5,
+                        help="allowed increase in average queries per request")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    with app.app_context():
+        if not args.no_seed:
+            seed_data(args.users, args.messages, args.follows, args.seed)
+
+        results = {
+            'commit': git_commit(),
+            'dataset': {
+                'users': db.session.query(User.id).count(),
+                'messages': db.session.query(Message.id).count(),
+                'follows': db.session.query(Follows.user_following_id).count(),
+            },
+        }
+
+    results['routes'] = benchmark(args.routes, args.requests, args.warmup,
+                                  args.sample_users, args.seed)
+
+    print(f"{'route':<16}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>9}{'queries':>9}{'errors':>8}")
+    for route, r in results['routes'].items():
+        print(f"{route:<16}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+              f"{r['throughput_rps']:>9.0f}{r['queries_per_request']:>9.1f}{r['errors']:>8}")
+
+    with open(args.out, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance,
+                                  args.query_slack)
+
+        if regressions:
+            print("\nREGRESSIONS:", *regressions, sep="\n  ")
+            sys.exit(1)
+
+        print("\nNo regressions against", args.baseline)
+
+
+if __name__ == '__main__':
+    main()
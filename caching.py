@@ -0,0 +1,188 @@
+"""HTTP caching of Warbler's pages.
+
+A page that opts in builds a `Validator` from the versions and counters of
+the rows it's about to render, before doing any other work. If the
+browser's copy has the same ETag, the route answers 304 Not Modified and
+skips its queries and templates:
+
+    user, viewer = (db.session
+                    .query(User, caching.viewer_versions())
+                    .filter(User.id == user_id)
+                    .first_or_404())
+
+    validator = caching.Validator('users_show', user.id, user.activity_version,
+                                  viewer=viewer)
+    if validator.fresh():
+        return validator.not_modified()
+    ...
+    return validator.tag(render_template(...))
+
+Every page depends on the logged-in user too (the nav bar, follow and like
+buttons), so their versions are always part of the ETag; they're selected
+with the page's own rows (`viewer_versions`), not taken from the
+per-process current_user cache, which can lag behind. The session's CSRF
+token is part of it too: the tokens in a page's forms expire, so a page is
+only reused for half of WTF_CSRF_TIME_LIMIT. Pages are marked private, so
+shared caches never hand one user's page to another.
+
+Pages whose content has a cheap timestamp (a message's) send it as
+Last-Modified as well, for information. Only If-None-Match is answered
+with 304: the timestamp doesn't change when the viewer does.
+"""
+
+import os
+from hashlib import sha1
+from time import time
+
+from flask import current_app, g, make_response, request, session
+from sqlalchemy import func, null
+from sqlalchemy.orm import aliased
+
+from models import db, User
+
+
+class Validator:
+    """ETag of a page, computed from `parts` and the logged-in user.
+
+    `viewer` is the value of `viewer_versions()` selected with the page's
+    rows; `last_modified`, if given, is sent as Last-Modified.
+    """
+
+    def __init__(self, *parts, viewer, last_modified=None):
+        self.last_modified = last_modified
+        if g.user:
+            viewer = (g.user.id, viewer)
+
+        key = repr((current_app.config['ETAG_VERSION'], parts, viewer, _csrf_period()))
+        self.etag = sha1(key.encode()).hexdigest()
+
+    def fresh(self):
+        """Does the browser already have this version of the page?
+
+        Never true while a flash message is waiting to be shown.
+        """
+
+        return not _pending_flashes() and self.etag in request.if_none_match
+
+    def not_modified(self):
+        """An empty 304 response for this page."""
+
+        response = make_response('', 304)
+        response.set_etag(self.etag)
+        response.last_modified = self.last_modified
+        return response
+
+    def tag(self, body):
+        """A response of `body`, carrying this page's ETag.
+
+        Pages that showed a flash message aren't tagged, so the browser
+        never revalidates its way back to one.
+        """
+
+        response = make_response(body)
+        if not g.get('showed_flashes'):
+            response.set_etag(self.etag)
+            response.last_modified = self.last_modified
+        return response
+
+
+def init_app(app):
+    """Set up ETags and cache headers for `app`'s responses.
+
+    ETAG_VERSION is mixed into every ETag, so a deploy that changes the
+    templates (or the built assets they link to) changes the ETags too; by
+    default it's a hash of the templates plus ASSETS_VERSION. Call this
+    after `assets.init_app`. SEND_FILE_MAX_AGE_DEFAULT sets how long static
+    files may be cached.
+    """
+
+    app.config.setdefault('ETAG_VERSION',
+                          _templates_hash(app) + app.config.get('ASSETS_VERSION', ''))
+
+    @app.before_request
+    def note_pending_flashes():
+        g.showed_flashes = _pending_flashes()
+
+    @app.after_request
+    def add_cache_headers(response):
+        """Let static files be cached; keep pages private to their user."""
+
+        # static files and assets choose their own (public) caching
+        if response.cache_control.public:
+            return response
+
+        response.vary.add('Cookie')
+
+        if response.get_etag()[0]:
+            # may be stored, but must be revalidated before every use
+            response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            response.headers['Cache-Control'] = 'private, no-cache, no-store, must-revalidate'
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '0'
+
+        return response
+
+
+def profile_versions(user_ids):
+    """Validator part covering the profiles of the users in `user_ids`.
+
+    `user_ids` is a query of user ids; this is a scalar subquery to select
+    alongside the page's main row. Profile versions only go up, so their
+    total changes whenever any of those users edits their profile.
+    """
+
+    profiles = aliased(User)
+
+    return (db.session
+            .query(func.coalesce(func.sum(profiles.profile_version), 0))
+            .filter(profiles.id.in_(user_ids.subquery()))
+            .as_scalar())
+
+
+def viewer_versions():
+    """Validator part covering the logged-in user's own versions.
+
+    A scalar subquery to select alongside the page's main row, like
+    `profile_versions`; NULL if no one is logged in. Both versions only go
+    up, so their sum changes whenever either does.
+    """
+
+    if not g.user:
+        return null()
+
+    viewer = aliased(User)
+
+    return (db.session
+            .query(viewer.profile_version + viewer.activity_version)
+            .filter(viewer.id == g.user.id)
+            .as_scalar())
+
+
+def _csrf_period():
+    """The session's CSRF token, and which half-lifetime of it this is."""
+
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time() // (limit / 2)) if limit else None
+
+    return session.get('csrf_token'), period
+
+
+def _pending_flashes():
+    return bool(session.get('_flashes'))
+
+
+def _templates_hash(app):
+    digest = sha1()
+
+    for directory, subdirectories, files in sorted(os.walk(
+            os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(directory, name), 'rb') as template:
+                digest.update(name.encode())
+                digest.update(template.read())
+
+    return digest.hexdigest()[:12]
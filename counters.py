@@ -0,0 +1,107 @@
+"""Reconciliation of the denormalized counts on User and Message.
+
+The counts are maintained transactionally as rows are added and removed
+(see the listeners in models.py); this recomputes them in bulk from the
+underlying tables to catch any drift, e.g. after a bulk import.
+"""
+
+from sqlalchemy import exists, func, or_, select
+
+from models import db, Follows, Likes, Message, User
+
+# count column on User -> column of the table it counts rows of, by user
+COUNTED = [
+    ('messages_count', Message.user_id),
+    ('following_count', Follows.user_following_id),
+    ('followers_count', Follows.user_being_followed_id),
+    ('likes_count', Likes.user_id),
+]
+
+# the same, for each model with counts
+COUNTED_BY_MODEL = {
+    User: COUNTED,
+    Message: [('like_count', Likes.message_id)],
+}
+
+
+def find_drift(model=User):
+    """Find `model` rows whose stored counts don't match the underlying tables.
+
+    Returns a list of dicts with the row's 'id' and, for each count that
+    drifted, its name mapped to a (stored, actual) pair.
+    """
+
+    counted = COUNTED_BY_MODEL[model]
+    stored = [getattr(model, name) for name, column in counted]
+    actual = []
+    query = db.session.query(model.id)
+
+    for name, column in counted:
+        total = (db.session
+                 .query(column.label('row_id'), func.count().label('total'))
+                 .group_by(column)
+                 .subquery())
+        query = query.outerjoin(total, total.c.row_id == model.id)
+        actual.append(func.coalesce(total.c.total, 0))
+
+    query = (query
+             .add_columns(*stored, *actual)
+             .filter(or_(*[s != a for s, a in zip(stored, actual)]))
+             .order_by(model.id))
+
+    drift = []
+    for row_id, *values in query:
+        entry = {'id': row_id}
+        for i, (name, column) in enumerate(counted):
+            if values[i] != values[i + len(counted)]:
+                entry[name] = (values[i], values[i + len(counted)])
+        drift.append(entry)
+
+    return drift
+
+
+def reconcile(fix=True, model=User, report=True):
+    """Recompute the counts of every `model` row, correcting any drift if `fix`.
+
+    Returns the drift found (see `find_drift`), or None if not `report`:
+    finding it reads every drifted row, which after a bulk import is most
+    of them, while correcting it doesn't.
+    """
+
+    drift = find_drift(model) if report else None
+
+    if fix:
+        recount(model)
+        db.session.commit()
+
+    return drift
+
+
+def recount(model=User):
+    """Set `model`'s counts from the underlying tables, in a few set-based
+    UPDATEs (two per count), writing only the rows that drifted."""
+
+    table = model.__table__
+
+    for name, column in COUNTED_BY_MODEL[model]:
+        stored = table.c[name]
+        totals = (select([column.label('row_id'), func.count().label('total')])
+                  .group_by(column)
+                  .alias('totals'))
+
+        db.session.execute(table.update()
+                           .where(table.c.id == totals.c.row_id)
+                           .where(stored != totals.c.total)
+                           .values({name: totals.c.total}))
+
+        # rows with nothing to count aren't in `totals`
+        db.session.execute(table.update()
+                           .where(stored != 0)
+                           .where(~exists().where(column == table.c.id))
+                           .values({name: 0}))
+
+
+def reconcile_all(fix=True, report=True):
+    """`reconcile` every model with counts; returns {model: drift}."""
+
+    return {model: reconcile(fix, model, report) for model in COUNTED_BY_MODEL}
@@ -0,0 +1,132 @@
+"""Cached lookup of the logged-in user for Warbler.
+
+Every request needs a little about the logged-in user (their id, name,
+images and counts for the nav bar and sidebar), but few need the whole row.
+`load` answers from a small process-local LRU cache of those fields, and
+`CurrentUser` only loads the User row when a route asks for anything else,
+e.g. because it's about to change it.
+
+The cache is per process, so entries expire after CURRENT_USER_CACHE_TTL
+seconds to bound how stale changes made by other processes can look.
+Routes that change a user's cached fields call `invalidate`.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from models import db, User
+
+FIELDS = ['id', 'username', 'image_url', 'header_image_url',
+          'messages_count', 'following_count', 'followers_count', 'likes_count',
+          'profile_version', 'activity_version']
+
+
+class ProjectionCache:
+    """Bounded, expiring LRU map of user id -> dict of FIELDS."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, values = entry
+            if expires < monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return values
+
+    def set(self, user_id, values):
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ProjectionCache()
+
+
+class CurrentUser:
+    """The logged-in user, as far as the cached fields go.
+
+    Reading any attribute outside FIELDS (relationships, email, bio...)
+    loads the full User row, once per request. Routes that modify the user
+    should do so through `load()`.
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+        self._user = None
+
+    def load(self):
+        """The full User row for this user."""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __eq__(self, other):
+        return isinstance(other, (User, CurrentUser)) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def init_app(app):
+    """Size the cache from `app`'s config."""
+
+    cache.maxsize = app.config.setdefault('CURRENT_USER_CACHE_SIZE', 1024)
+    cache.ttl = app.config.setdefault('CURRENT_USER_CACHE_TTL', 30)
+
+
+def load(user_id):
+    """CurrentUser for `user_id`, or None if there's no such user."""
+
+    values = cache.get(user_id)
+
+    if values is None:
+        row = (db.session
+               .query(*[getattr(User, field) for field in FIELDS])
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+
+        values = dict(zip(FIELDS, row))
+        cache.set(user_id, values)
+
+    return CurrentUser(values)
+
+
+def invalidate(*user_ids):
+    """Forget the cached fields of `user_ids` after they've changed."""
+
+    cache.invalidate(*user_ids)
@@ -0,0 +1,93 @@
+"""Follow-state lookups and changes for Warbler."""
+
+from sqlalchemy import and_, or_
+
+from models import db, Follows
+import timeline
+
+
+def follow(follower_id, user_ids):
+    """Have `follower_id` follow `user_ids`, in the current transaction.
+
+    Ids already followed, or of users who don't exist, are skipped. Returns
+    the ids newly followed, whose messages are now on the follower's home
+    timeline.
+    """
+
+    if not user_ids:
+        return []
+
+    added = Follows.add(follower_id, user_ids)
+    if added:
+        timeline.add_authors(follower_id, added)
+    return added
+
+
+def unfollow(follower_id, user_ids):
+    """Have `follower_id` stop following `user_ids`, in the current
+    transaction. Returns the ids they had been following."""
+
+    if not user_ids:
+        return []
+
+    removed = Follows.remove(follower_id, user_ids)
+    if removed:
+        timeline.remove_authors(follower_id, removed)
+        timeline.backfill_unpulled(removed)
+    return removed
+
+
+class FollowState:
+    """Who, among other users, one user follows and is followed by.
+
+    Answers for a batch of user ids with one query against `follows`, and
+    remembers the answers, so a page can ask about each card it renders
+    without going back to the database. Make one per request.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.known = set()
+        self.following = set()
+        self.followers = set()
+
+    def load(self, user_ids):
+        """Look up the follow state for any of `user_ids` not already known."""
+
+        user_ids = set(user_ids) - self.known
+        if not user_ids:
+            return self
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id, Follows.user_following_id)
+                .filter(or_(
+                    and_(Follows.user_following_id == self.user_id,
+                         Follows.user_being_followed_id.in_(user_ids)),
+                    and_(Follows.user_being_followed_id == self.user_id,
+                         Follows.user_following_id.in_(user_ids)))))
+
+        for followed_id, follower_id in rows:
+            if follower_id == self.user_id:
+                self.following.add(followed_id)
+            if followed_id == self.user_id:
+                self.followers.add(follower_id)
+
+        self.known |= user_ids
+        return self
+
+    def is_following(self, user_id):
+        """Does our user follow `user_id`?"""
+
+        return user_id in self.load([user_id]).following
+
+    def is_followed_by(self, user_id):
+        """Is our user followed by `user_id`?"""
+
+        return user_id in self.load([user_id]).followers
+
+    def forget(self, user_id):
+        """Drop what we know about `user_id`, e.g. after (un)following them."""
+
+        self.known.discard(user_id)
+        self.following.discard(user_id)
+        self.followers.discard(user_id)
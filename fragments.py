@@ -0,0 +1,136 @@
+"""Cached rendering of message cards for Warbler.
+
+Timelines, profiles and likes pages render the same cards over and over
+for different viewers. Most of a card (the author's avatar and name, the
+timestamp and the text) looks the same to everyone, so it's rendered once
+per process and kept in a bounded LRU cache. The parts that depend on who
+is looking, like the like and follow buttons, are filled in per request:
+
+    {% call message_card(msg) %}
+      ...like button for g.user...
+    {% endcall %}
+
+Messages don't change once posted, and an author's profile_version goes
+up whenever their name or avatar does, so entries are keyed by message id
+and profile version and are never stale, even when another process made
+the change. Deleting a message or editing a profile still drops the
+affected entries here, to free their space straight away.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from markupsafe import Markup
+
+# where a card's per-viewer content goes; message text is escaped, so it
+# can't contain this
+SLOT = Markup('<!--viewer-->')
+
+TIMELINE_CARD = 'messages/card.html'
+DETAIL_CARD = 'messages/card-detail.html'
+
+
+class FragmentCache:
+    """Bounded LRU map of (template, message id, profile version) -> markup.
+
+    Remembers which keys belong to which message and author, so they can
+    be dropped together.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._by_message = {}
+        self._by_author = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, author_id, fragment):
+        with self._lock:
+            self._entries[key] = (author_id, fragment)
+            self._entries.move_to_end(key)
+            self._by_message.setdefault(key[1], set()).add(key)
+            self._by_author.setdefault(author_id, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_message(self, message_id):
+        with self._lock:
+            for key in list(self._by_message.get(message_id, ())):
+                self._discard(key)
+
+    def invalidate_author(self, user_id):
+        with self._lock:
+            for key in list(self._by_author.get(user_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_message.clear()
+            self._by_author.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        author_id, fragment = self._entries.pop(key)
+        _remove(self._by_message, key[1], key)
+        _remove(self._by_author, author_id, key)
+
+
+def _remove(index, group, key):
+    keys = index[group]
+    keys.discard(key)
+    if not keys:
+        del index[group]
+
+
+cache = FragmentCache()
+
+
+def init_app(app):
+    """Size the cache from `app`'s config and give templates `message_card`."""
+
+    cache.maxsize = app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+    app.add_template_global(message_card)
+
+
+def message_card(message, template=TIMELINE_CARD, caller=None):
+    """`message` rendered with `template`, with `caller()` in its viewer slot.
+
+    The rest of the card is rendered without the request's context (no
+    g.user), so it can be shared between viewers.
+    """
+
+    key = (template, message.id, message.user.profile_version)
+    fragment = cache.get(key)
+
+    if fragment is None:
+        fragment = Markup(current_app.jinja_env.get_template(template)
+                          .render(message=message, viewer=SLOT))
+        cache.set(key, message.user_id, fragment)
+
+    return fragment.replace(SLOT, caller() if caller else '', 1)
+
+
+def invalidate_message(message_id):
+    """Forget the cards of a deleted message."""
+
+    cache.invalidate_message(message_id)
+
+
+def invalidate_author(user_id):
+    """Forget the cards of `user_id`'s messages, e.g. after a profile edit."""
+
+    cache.invalidate_author(user_id)
@@ -2,19 +2,40 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --shards 8
+    python seed.py
+
+Rows are streamed to the files, so memory use doesn't grow with the size of
+the data. The work is split into `--shards` ranges of users and messages,
+generated in parallel processes into users.000.csv, users.001.csv... (or
+users.csv etc. for a single shard). Output depends only on the arguments
+(including `--seed`), never on the number of processes or the clock, and
+nothing is fetched over the network.
+
+The follow graph is power-law shaped like a real one: how many users each
+user follows is heavy-tailed, and who they follow is Zipf-distributed, so a
+few users have a huge share of the followers. Prolific posters are drawn
+the same way, and each user's messages come in bursts.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import get_bursty_datetime, pareto_count, rank_to_id, zipf_rank
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
@@ -22,9 +43,10 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# bcrypt hash of 'password', shared by every generated user
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +54,162 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+    f"https://picsum.photos/seed/warbler{i}/1280/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def shard_range(shard, shards, total):
+    """The [start, end) slice of 1..total that `shard` of `shards` covers."""
+
+    return (1 + total * shard // shards, 1 + total * (shard + 1) // shards)
+
+
+def shard_path(out, table, shard, shards):
+    if shards == 1:
+        return os.path.join(out, f'{table}.csv')
+    return os.path.join(out, f'{table}.{shard:03}.csv')
+
+
+def generators(seed, table, shard):
+    """Random and Faker instances for one shard of one table."""
+
+    rng = Random(f'{seed}:{table}:{shard}')
+    fake = Faker()
+    fake.seed_instance(f'{seed}:{table}:{shard}')
+    return rng, fake
+
+
+def write_users(args, shard):
+    rng, fake = generators(args.seed, 'users', shard)
+    start, end = shard_range(shard, args.shards, args.users)
+
+    with open(shard_path(args.out, 'users', shard, args.shards), 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+        users_writer.writerow(USERS_CSV_HEADERS)
+
+        for user_id in range(start, end):
+            # the id suffix keeps usernames and emails unique
+            users_writer.writerow([
+                user_id,
+                f"{user_id}.{fake.email()}",
+                f"{fake.user_name()}-{user_id}",
+                rng.choice(image_urls),
+                PASSWORD,
+                fake.sentence(),
+                rng.choice(header_image_urls),
+                fake.city(),
+            ])
+
+    return end - start
+
+
+def write_messages(args, shard):
+    rng, fake = generators(args.seed, 'messages', shard)
+    start, end = shard_range(shard, args.shards, args.messages)
+    last_posted = {}
+
+    with open(shard_path(args.out, 'messages', shard, args.shards), 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for i in range(start, end):
+            user_id = rank_to_id(zipf_rank(args.users, args.exponent, rng), args.users)
+            timestamp = get_bursty_datetime(
+                last_posted.get(user_id), rng=rng, now=args.until)
+
+            # remember only recent posters, to bound memory
+            if len(last_posted) > 100000:
+                last_posted.clear()
+            last_posted[user_id] = timestamp
+
+            messages_writer.writerow([
+                fake.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp,
+                user_id,
+            ])
+
+    return end - start
+
+
+def write_follows(args, shard):
+    rng, fake = generators(args.seed, 'follows', shard)
+    start, end = shard_range(shard, args.shards, args.users)
+    mean = args.follows / args.users
+    maximum = (args.users - 1) // 2
+    written = 0
+
+    with open(shard_path(args.out, 'follows', shard, args.shards), 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for follower in range(start, end):
+            following = set()
+
+            for i in range(pareto_count(mean, maximum, rng=rng)):
+                followed = follower
+                while followed == follower or followed in following:
+                    followed = rank_to_id(
+                        zipf_rank(args.users, args.exponent, rng), args.users)
+                following.add(followed)
+
+                follows_writer.writerow([followed, follower])
+
+            written += len(following)
+
+    return written
+
+
+WRITERS = {
+    'users': write_users,
+    'messages': write_messages,
+    'follows': write_follows,
+}
+
+
+def run(job):
+    args, table, shard = job
+    return table, WRITERS[table](args, shard)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="about how many follows to generate")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="files per table, generated in parallel")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="processes generating shards")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--exponent', type=float, default=1.0,
+                        help="Zipf exponent of who gets followed and who posts")
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime(2022, 1, 1),
+                        help="latest message timestamp")
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    # clear out files from earlier runs, which may have had more shards
+    for table in WRITERS:
+        for path in glob(os.path.join(args.out, f'{table}.csv')) + \
+                glob(os.path.join(args.out, f'{table}.*.csv')):
+            os.remove(path)
+
+    jobs = [(args, table, shard) for table in WRITERS for shard in range(args.shards)]
+    totals = dict.fromkeys(WRITERS, 0)
+
+    with Pool(min(args.processes, len(jobs))) as pool:
+        for table, rows in pool.imap_unordered(run, jobs):
+            totals[table] += rows
+
+    for table, rows in totals.items():
+        print(f"{table}: {rows:,} rows")
+
+
+if __name__ == '__main__':
+    main()
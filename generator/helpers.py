@@ -1,14 +1,78 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import floor, gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the `year_gap` years before `now`."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_bursty_datetime(previous, year_gap=2, rng=random, now=None,
+                        burstiness=0.7, mean_gap=900):
+    """Get a datetime shortly after `previous`, or a random one.
+
+    With probability `burstiness` the result follows `previous` by an
+    exponentially distributed gap averaging `mean_gap` seconds, so activity
+    comes in bursts; otherwise (or if that would pass `now`) it's a random
+    datetime, as from `get_random_datetime`.
+    """
+
+    now = now or datetime.now()
+
+    if previous is not None and rng.random() < burstiness:
+        following = previous + timedelta(seconds=rng.expovariate(1 / mean_gap))
+        if following <= now:
+            return following
+
+    return get_random_datetime(year_gap, rng, now)
+
+
+def zipf_rank(n, exponent=1.0, rng=random):
+    """Get a rank from 1 to `n`, rank k being about k**-exponent likely.
+
+    Samples the continuous approximation of the Zipf distribution by
+    inverting its CDF, so it takes constant time and memory for any `n`.
+    """
+
+    u = rng.random()
+
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        x = (1 + u * ((n + 1) ** (1 - exponent) - 1)) ** (1 / (1 - exponent))
+
+    return min(max(floor(x), 1), n)
+
+
+def pareto_count(mean, maximum, alpha=2.0, rng=random):
+    """Get a heavy-tailed count averaging about `mean`, at most `maximum`."""
+
+    scale = mean * (alpha - 1) / alpha
+    return min(int(scale * rng.paretovariate(alpha)), maximum)
+
+
+def rank_to_id(rank, n):
+    """Map ranks 1..n onto ids 1..n, scattering popular ranks across ids.
+
+    A fixed permutation (a stride coprime to `n`), so the same rank always
+    gets the same id without storing the mapping.
+    """
+
+    return (rank - 1) * _stride(n) % n + 1
+
+
+@lru_cache()
+def _stride(n):
+    stride = int(n * 0.618) or 1
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
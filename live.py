@@ -0,0 +1,238 @@
+"""Live home timeline updates for Warbler.
+
+`/timeline/stream` (app.py) holds a Server-Sent Events connection open for
+a signed-in user and sends them cards for new messages from the accounts
+they follow as they're posted, instead of them reloading `/`.
+
+Posting a message publishes its id to a `Broker`, keyed by author. Each
+stream subscribes to the authors its user follows, with its own bounded
+buffer. Publishing never blocks on a slow reader: a stream that falls more
+than LIVE_BUFFER_SIZE messages behind is told to reload instead. An idle
+stream holds no database connection, only its subscription; it sends a
+comment every LIVE_HEARTBEAT_SECONDS to keep proxies from closing it, and
+ends after LIVE_MAX_SECONDS (the browser reconnects, picking up its follows
+afresh). With LIVE_BROKER = 'memory', messages only reach streams in the
+process that posted them.
+With 'postgres', they're sent with NOTIFY when the posting transaction
+commits, and every process LISTENs and passes them on to its own streams.
+(Through pgbouncer in transaction mode, set LIVE_LISTEN_URL to connect to
+PostgreSQL directly for LISTEN.)
+
+Thousands of idle streams need a server that doesn't give each request an
+OS thread, e.g. gunicorn with gevent workers.
+"""
+
+import os
+import select
+import threading
+from collections import deque
+from time import sleep
+
+import psycopg2
+from flask import current_app
+from sqlalchemy import event, func, select as sql_select
+
+from models import db
+
+CHANNEL = 'warbler_messages'
+
+settings = {
+    'broker': 'memory',
+    'buffer_size': 100,
+    'listen_url': None,
+}
+
+
+class Subscription:
+    """One stream's view of the broker: a bounded buffer of message ids from
+    `author_ids`, newest last.
+
+    If more arrive than fit, the oldest are dropped and `overflowed` is set,
+    so the reader knows to start over.
+    """
+
+    def __init__(self, broker, author_ids, maxlen):
+        self.broker = broker
+        self.author_ids = frozenset(author_ids)
+        self.overflowed = False
+        self.subscribed = False
+        self._buffer = deque(maxlen=maxlen)
+        self._ready = threading.Condition()
+
+    def put(self, message_id):
+        with self._ready:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.overflowed = True
+            self._buffer.append(message_id)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """Message ids delivered since the last call, waiting up to
+        `timeout` seconds for some; [] if none came."""
+
+        with self._ready:
+            if not self._buffer:
+                self._ready.wait(timeout)
+
+            message_ids = list(self._buffer)
+            self._buffer.clear()
+            return message_ids
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broker:
+    """In-process pub/sub of new message ids, keyed by author id."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, author_ids, maxlen=None):
+        """A Subscription to new messages by `author_ids`."""
+
+        if settings['broker'] == 'postgres':
+            self._ensure_listener()
+
+        subscription = Subscription(self, author_ids, maxlen or settings['buffer_size'])
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._subscriptions.setdefault(author_id, set()).add(subscription)
+            subscription.subscribed = True
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering to `subscription`; unsubscribing twice is harmless."""
+
+        with self._lock:
+            if not subscription.subscribed:
+                return
+            subscription.subscribed = False
+            self._count -= 1
+
+            for author_id in subscription.author_ids:
+                subscribers = self._subscriptions.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[author_id]
+
+    def deliver(self, author_id, message_id):
+        """Hand `message_id` to this process's subscribers to `author_id`."""
+
+        with self._lock:
+            subscribers = list(self._subscriptions.get(author_id, ()))
+
+        for subscription in subscribers:
+            subscription.put(message_id)
+
+    def subscriber_count(self):
+        return self._count
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or self._listener.pid != os.getpid():
+                dsn = settings['listen_url'] or db.engine.url
+                self._listener = Listener(self, dsn, current_app.logger)
+                self._listener.start()
+
+
+class Listener(threading.Thread):
+    """Thread passing NOTIFYs on CHANNEL to a Broker's deliver(),
+    reconnecting if the connection drops."""
+
+    def __init__(self, broker, dsn, logger):
+        super().__init__(name='live-listener', daemon=True)
+        self.broker = broker
+        self.dsn = str(dsn).replace('postgresql+psycopg2://', 'postgresql://')
+        self.logger = logger
+        self.pid = os.getpid()
+        self.listening = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError) as error:
+                self.listening.clear()
+                self.logger.warning(f"live updates lost their LISTEN connection: {error}")
+                sleep(1)
+
+    def _listen(self):
+        connection = psycopg2.connect(self.dsn)
+        try:
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {CHANNEL}")
+            self.listening.set()
+
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    author_id, message_id = map(int, notify.payload.split(':'))
+                    self.broker.deliver(author_id, message_id)
+        finally:
+            connection.close()
+
+
+broker = Broker()
+
+
+def publish(author_id, message_id):
+    """Announce a new message, once the current transaction commits."""
+
+    if settings['broker'] == 'postgres':
+        # NOTIFY is only sent if (and when) the transaction commits
+        db.session.execute(sql_select([func.pg_notify(CHANNEL, f"{author_id}:{message_id}")]))
+    else:
+        db.session().info.setdefault('live_pending', []).append((author_id, message_id))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _deliver_pending(session):
+    for author_id, message_id in session.info.pop('live_pending', ()):
+        broker.deliver(author_id, message_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending(session):
+    session.info.pop('live_pending', None)
+
+
+def init_app(app):
+    """Configure streaming from `app`'s config."""
+
+    settings['broker'] = app.config.setdefault('LIVE_BROKER', 'memory')
+    settings['buffer_size'] = app.config.setdefault('LIVE_BUFFER_SIZE', 100)
+    settings['listen_url'] = app.config.setdefault('LIVE_LISTEN_URL', None)
+    app.config.setdefault('LIVE_HEARTBEAT_SECONDS', 15)
+    app.config.setdefault('LIVE_MAX_SECONDS', 300)
+    app.config.setdefault('LIVE_MAX_STREAMS', 1000)
+
+
+def sse(event=None, data=None, id=None, comment=None):
+    """One Server-Sent Events message."""
+
+    lines = []
+    if comment is not None:
+        lines.append(f": {comment}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    if id is not None:
+        lines.append(f"id: {id}")
+    if data is not None:
+        lines.extend(f"data: {line}" for line in str(data).splitlines() or [''])
+    return "\n".join(lines) + "\n\n"
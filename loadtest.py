@@ -0,0 +1,344 @@
+"""Concurrent, mixed-workload load test of Warbler.
+
+Logs in simulated users through /login, then has each of them browse
+and post in its own thread, with think time between requests, in the
+proportions given by `--mix`. Each `--concurrency` level runs for
+`--duration` seconds. Comparing their throughput shows where the app
+saturates. Error rates (and, in-process, the exceptions behind them, e.g.
+IntegrityError on likes and follows) and the time requests spent waiting
+for a database connection are reported too.
+
+    python loadtest.py --concurrency 1 4 16 64
+    python loadtest.py --url http://localhost:5000 --processes 4 \\
+        --concurrency 8 32 --mix home=70,like=20,post=10
+
+Without `--url`, requests go through the app's WSGI interface in this
+process, so `--processes` stands in for server workers (each with its own
+connection pool). With `--url`, they go over HTTP to a running server and
+`--processes` just spreads the simulated users across driver processes.
+Pool waits come from each response's Server-Timing header (see
+querystats.py), so they're measured either way.
+
+Simulated users are drawn from the database, and must have the password
+`--password` (as the generated ones do).
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.cookiejar import CookieJar
+from multiprocessing import Pool
+from random import Random
+from time import perf_counter, sleep
+
+from flask import got_request_exception
+
+from app import app
+from models import db, User
+
+DEFAULT_MIX = 'home=50,profile=15,users=5,likes=5,following=5,like=10,follow=5,post=5'
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+LIKEABLE = re.compile(r'action="/users/add_like/(\d+)"')
+FOLLOWABLE = re.compile(r'action="/users/follow/(\d+)"')
+USER_LINK = re.compile(r'href="/users/(\d+)"')
+POOL_WAIT = re.compile(r'db-pool;dur=([\d.]+)')
+
+# exception class names of failed in-process requests, per thread
+_failures = threading.local()
+
+
+class WSGIClient:
+    """Requests through the app's WSGI interface, in this process."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        _failures.name = None
+        response = self.client.open(path, method=method, data=data)
+        return (response.status_code, response.headers.get('Server-Timing', ''),
+                response.get_data(as_text=True), _failures.name)
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient:
+    """Requests over HTTP to a running server, keeping cookies."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirects())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+
+        try:
+            response = self.opener.open(request)
+        except urllib.error.HTTPError as error:
+            response = error
+
+        with response:
+            return (response.status, response.headers.get('Server-Timing', ''),
+                    response.read().decode(errors='replace'), None)
+
+
+class SimulatedUser:
+    """One logged-in session, choosing what to do next like a person might."""
+
+    def __init__(self, client, username, password, rng):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.rng = rng
+        self.user_id = None
+        self.csrf_token = None
+        self.seen_messages = []
+        self.seen_users = []
+
+    def request(self, method, path, data=None):
+        if method == 'POST':
+            data = dict(data or {}, csrf_token=self.csrf_token)
+
+        status, timing, body, failure = self.client.request(method, path, data)
+
+        token = CSRF_TOKEN.search(body)
+        if token:
+            self.csrf_token = token.group(1)
+
+        # remember what was on the page, to like and follow later
+        self.seen_messages = LIKEABLE.findall(body) or self.seen_messages
+        self.seen_users = (FOLLOWABLE.findall(body) + USER_LINK.findall(body)
+                           or self.seen_users)
+
+        return status, timing, failure
+
+    def login(self):
+        """Log in through the form; did it work?"""
+
+        self.request('GET', '/login')
+        status, timing, failure = self.request(
+            'POST', '/login', {'username': self.username, 'password': self.password})
+        with app.app_context():
+            self.user_id = (db.session.query(User.id)
+                            .filter_by(username=self.username).scalar())
+        self.home()
+
+        # a successful login redirects; a failed one re-renders the form
+        return status == 302
+
+    def home(self):
+        return self.request('GET', '/')
+
+    def profile(self):
+        return self.request('GET', f'/users/{self.other_user()}')
+
+    def users(self):
+        return self.request('GET', '/users')
+
+    def likes(self):
+        return self.request('GET', f'/users/{self.other_user()}/likes')
+
+    def following(self):
+        return self.request('GET', f'/users/{self.user_id}/following')
+
+    def like(self):
+        if not self.seen_messages:
+            return self.home()
+        return self.request('POST', f'/users/add_like/{self.rng.choice(self.seen_messages)}')
+
+    def follow(self):
+        return self.request('POST', f'/users/follow/{self.other_user()}')
+
+    def post(self):
+        return self.request('POST', '/messages/new',
+                            {'text': f'Load test warble {self.rng.random():.6f}'})
+
+    def other_user(self):
+        return self.rng.choice(self.seen_users) if self.seen_users else self.user_id
+
+
+ACTIONS = ['home', 'profile', 'users', 'likes', 'following', 'like', 'follow', 'post']
+
+
+def parse_mix(mix):
+    """{action: weight} from 'home=50,like=10,...'."""
+
+    weights = {}
+    for part in mix.split(','):
+        action, weight = part.split('=')
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}")
+        weights[action] = float(weight)
+    return weights
+
+
+def percentile(values, fraction):
+    """The `fraction` percentile of `values` (nearest rank), or 0 if empty."""
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def run_user(options, username, seed, deadline, samples):
+    """Log `username` in, then make requests until `deadline`."""
+
+    rng = Random(seed)
+    client = HTTPClient(options['url']) if options['url'] else WSGIClient()
+    user = SimulatedUser(client, username, options['password'], rng)
+    actions, weights = zip(*options['mix'].items())
+
+    if not user.login():
+        samples.append(('login', 0, 0.0, 0.0, 'LoginFailed'))
+        return
+
+    while perf_counter() < deadline:
+        action = rng.choices(actions, weights)[0]
+
+        start = perf_counter()
+        status, timing, failure = getattr(user, action)()
+        elapsed = perf_counter() - start
+
+        pool_wait = POOL_WAIT.search(timing)
+        samples.append((action, status, elapsed,
+                        float(pool_wait.group(1)) / 1000 if pool_wait else 0.0,
+                        failure))
+
+        if options['think_ms']:
+            sleep(rng.expovariate(1000 / options['think_ms']))
+
+
+def run_process(job):
+    """Run some simulated users in threads; return their samples."""
+
+    options, usernames, seed = job
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    # failures are tallied below; don't also log a traceback for each
+    app.logger.setLevel(logging.CRITICAL)
+
+    def record_failure(sender, exception, **extra):
+        _failures.name = type(exception).__name__
+
+    got_request_exception.connect(record_failure, app)
+
+    samples = []
+    deadline = perf_counter() + options['ramp'] + options['duration']
+
+    threads = [threading.Thread(target=run_user,
+                                args=(options, username, f'{seed}:{i}',
+                                      deadline, samples))
+               for i, username in enumerate(usernames)]
+    for thread in threads:
+        thread.start()
+        sleep(options['ramp'] / len(threads))
+    for thread in threads:
+        thread.join()
+
+    return samples
+
+
+def summarize(concurrency, samples, duration):
+    """Throughput, latency, error and pool-wait figures for one level."""
+
+    requests = [s for s in samples if s[0] != 'login']
+    latencies = [s[2] for s in requests]
+    pool_waits = [s[3] for s in requests]
+    errors = [s for s in samples if s[1] >= 500 or s[4]]
+
+    return {
+        'concurrency': concurrency,
+        'requests': len(requests),
+        'throughput_rps': len(requests) / duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'error_rate': len(errors) / max(len(samples), 1),
+        'errors': dict(Counter(f"{s[0]}: {s[4] or s[1]}" for s in errors)),
+        'pool_wait_mean_ms': sum(pool_waits) / max(len(pool_waits), 1) * 1000,
+        'pool_wait_p95_ms': percentile(pool_waits, 0.95) * 1000,
+        'by_action': dict(Counter(s[0] for s in requests)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Warbler with a mixed workload.")
+    parser.add_argument('--url', help="server to load; default is in-process")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help="simulated users at each level")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run each level for, after ramping up")
+    parser.add_argument('--ramp', type=float, default=5,
+                        help="seconds over which to start a level's users")
+    parser.add_argument('--think-ms', type=float, default=500,
+                        help="mean pause between a user's requests")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"action weights (default {DEFAULT_MIX})")
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='loadtest.json')
+    args = parser.parse_args()
+
+    with app.app_context():
+        rng = Random(args.seed)
+        usernames = [username for (username,) in
+                     db.session.query(User.username).order_by(User.id)]
+        usernames = rng.sample(usernames, min(max(args.concurrency), len(usernames)))
+
+    options = {
+        'url': args.url,
+        'password': args.password,
+        'mix': args.mix,
+        'think_ms': args.think_ms,
+        'duration': args.duration,
+        'ramp': args.ramp,
+    }
+    levels = []
+
+    print(f"{'users':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'errors':>9}{'pool ms':>9}")
+
+    for concurrency in args.concurrency:
+        processes = min(args.processes, concurrency)
+        jobs = [(options, usernames[:concurrency][p::processes], f'{args.seed}:{concurrency}:{p}')
+                for p in range(processes)]
+
+        if processes == 1:
+            samples = run_process(jobs[0])
+        else:
+            # children mustn't inherit (and share) the parent's pooled connections
+            with app.app_context():
+                db.engine.dispose()
+            with Pool(processes) as pool:
+                samples = [s for result in pool.map(run_process, jobs) for s in result]
+
+        level = summarize(concurrency, samples, args.ramp + args.duration)
+        levels.append(level)
+
+        print(f"{concurrency:>6}{level['throughput_rps']:>9.1f}{level['p50_ms']:>9.1f}"
+              f"{level['p95_ms']:>9.1f}{level['p99_ms']:>9.1f}"
+              f"{level['error_rate']:>9.1%}{level['pool_wait_p95_ms']:>9.1f}")
+        for error, count in sorted(level['errors'].items()):
+            print(f"{'':>8}{count:>5} x {error}")
+
+    with open(args.out, 'w') as out:
+        json.dump({'mix': args.mix, 'think_ms': args.think_ms, 'levels': levels},
+                  out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
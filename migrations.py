@@ -0,0 +1,101 @@
+"""Schema upgrades for existing Warbler databases.
+
+`db.create_all()` creates missing tables but never changes existing ones.
+These statements bring an older database up to date with models.py; each
+is idempotent, so `flask upgrade-db` can safely be rerun.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from models import db
+
+UPGRADES = [
+    # denormalized counts on users (fill them in with `flask reconcile-counts`)
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0",
+
+    # row versions for HTTP validators
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS activity_version INTEGER NOT NULL DEFAULT 0",
+
+    # likes are per user: keyed by (user_id, message_id), not a surrogate
+    # id with message_id unique
+    "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL",
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key",
+    "ALTER TABLE likes DROP COLUMN IF EXISTS id",
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'likes_pkey') THEN
+            ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id);
+        END IF;
+    END $$
+    """,
+
+    # like counts on messages (fill them in with `flask reconcile-counts`)
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0",
+
+    # message ids are time-ordered 64-bit ids made by the app (see
+    # snowflake.py), and lists of messages are ordered by id alone; existing
+    # messages keep their ids, which are older and in posting order
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "DROP SEQUENCE IF EXISTS messages_id_seq",
+    "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT",
+    "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+    "ALTER TABLE timeline_entries ALTER COLUMN message_id TYPE BIGINT",
+    "DROP INDEX IF EXISTS ix_messages_user_id_timestamp",
+    "DROP INDEX IF EXISTS ix_timeline_entries_user_id_timestamp",
+    "ALTER TABLE timeline_entries DROP COLUMN IF EXISTS timestamp",
+
+    # which home timelines have been trimmed (set it with `flask rebuild-timelines`)
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS timeline_trimmed BOOLEAN NOT NULL DEFAULT false",
+
+    # secondary indexes declared on the models
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+    "ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_follows_user_following_id "
+    "ON follows (user_following_id, user_being_followed_id)",
+    "CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_user_id_id ON messages (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_timeline_entries_message_id "
+    "ON timeline_entries (message_id)",
+]
+
+# Upgrades that need something the database may not have (here, the pg_trgm
+# extension). Each is tried on its own and skipped if it fails.
+OPTIONAL_UPGRADES = [
+    # trigram search over users (see search.py)
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_bio_trgm "
+    "ON users USING gin (bio gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_location_trgm "
+    "ON users USING gin (location gin_trgm_ops)",
+]
+
+
+def upgrade():
+    """Create missing tables and apply every upgrade statement.
+
+    Returns the optional upgrades that couldn't be applied.
+    """
+
+    db.create_all()
+
+    for statement in UPGRADES:
+        db.session.execute(text(statement))
+
+    skipped = []
+    for statement in OPTIONAL_UPGRADES:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(text(statement))
+        except DBAPIError:
+            skipped.append(statement)
+
+    db.session.commit()
+
+    return skipped
@@ -2,18 +2,71 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+import flask_sqlalchemy
+from sqlalchemy import event, func, inspect, orm
+from sqlalchemy.dialects import postgresql
+
+import passwords
+from querystats import TimedQueuePool
+from replicas import RoutingSession
+import snowflake
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy, with engines whose pool checkouts are timed, and
+    sessions that can read from a replica (see replicas.py)."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Flask-SQLAlchemy 2.4+ returns (url, options); older versions only
+        # update `options`
+        result = super().apply_driver_hacks(app, sa_url, options)
+        options.setdefault('poolclass', TimedQueuePool)
+        for name, value in pool_options(app.config).items():
+            options.setdefault(name, value)
+        return result
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def pool_options(config):
+    """create_engine() options for the connection pool, from DB_POOL_*
+    config (see `connect_db`)."""
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_POOL_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+    if config['DB_PGBOUNCER']:
+        # pgbouncer in transaction mode may hand each transaction a different
+        # server connection, so nothing may rely on a connection's state
+        # outside a transaction. psycopg2 never prepares statements on the
+        # server, and Warbler only uses SET LOCAL and temporary objects
+        # dropped in the same transaction; this skips the hstore type lookup
+        # psycopg2 would otherwise make on each new connection.
+        options['use_native_hstore'] = False
+
+    return options
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # the primary key covers a user's followers; this, who they follow
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,30 +79,154 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        return (db.session
+                .query(cls.query.filter_by(user_being_followed_id=followed_id,
+                                           user_following_id=follower_id)
+                       .exists())
+                .scalar())
+
+    @classmethod
+    def add(cls, follower_id, followed_ids):
+        """Have `follower_id` follow each of `followed_ids`.
+
+        A single INSERT ... SELECT ... ON CONFLICT, so ids they already
+        follow, or of users who don't exist, are skipped. Returns the ids
+        newly followed.
+        """
+
+        follows = cls.__table__
+        users = User.__table__
+
+        followed = (db.select([users.c.id, db.literal(follower_id)])
+                    .where(users.c.id.in_(followed_ids)))
+
+        added = [row[0] for row in db.session.execute(
+            postgresql.insert(follows)
+            .from_select(['user_being_followed_id', 'user_following_id'], followed)
+            .on_conflict_do_nothing()
+            .returning(follows.c.user_being_followed_id))]
+
+        # the rows didn't go through the session, so count them here
+        if added:
+            connection = db.session.connection()
+            adjust_counts(connection, follower_id, following_count=len(added))
+            adjust_counts(connection, added, followers_count=1)
+        return added
+
+    @classmethod
+    def remove(cls, follower_id, followed_ids):
+        """Have `follower_id` stop following each of `followed_ids`.
+
+        Returns the ids they had been following.
+        """
+
+        follows = cls.__table__
+
+        removed = [row[0] for row in db.session.execute(
+            follows.delete()
+            .where(follows.c.user_following_id == follower_id)
+            .where(follows.c.user_being_followed_id.in_(followed_ids))
+            .returning(follows.c.user_being_followed_id))]
+
+        if removed:
+            connection = db.session.connection()
+            adjust_counts(connection, follower_id, following_count=-len(removed))
+            adjust_counts(connection, removed, followers_count=-1)
+        return removed
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    # the primary key covers a user's likes; this, a message's
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    def __repr__(self):
+        return f"<Like {self.user_id} {self.message_id}>"
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Have `user_id` like `message_id`, unless they already do.
+
+        A single INSERT ... ON CONFLICT, so liking twice (even at the same
+        time) is harmless. Returns whether a like was added.
+        """
+
+        likes = cls.__table__
+        added = db.session.execute(
+            postgresql.insert(likes)
+            .values(user_id=user_id, message_id=message_id)
+            .on_conflict_do_nothing()
+            .returning(likes.c.user_id)).first()
+
+        # the row didn't go through the session, so count it here
+        if added:
+            count_like(None, db.session.connection(),
+                       cls(user_id=user_id, message_id=message_id))
+        return bool(added)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Have `user_id` stop liking `message_id`; did they like it?"""
+
+        likes = cls.__table__
+        removed = db.session.execute(
+            likes.delete()
+            .where(likes.c.user_id == user_id)
+            .where(likes.c.message_id == message_id)
+            .returning(likes.c.user_id)).first()
+
+        if removed:
+            uncount_like(None, db.session.connection(),
+                         cls(user_id=user_id, message_id=message_id))
+        return bool(removed)
+
+
+class TimelineEntry(db.Model):
+    """A message id materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    # the primary key orders each timeline by time, as message ids are
+    # time-ordered; this finds every timeline a message is on, for deleting it
+    __table_args__ = (
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
         db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
     def __repr__(self):
-        return f"Like {self.id} {self.user_id} {self.message_id}"
+        return f"<TimelineEntry {self.user_id} {self.message_id}>"
 
 
 class User(db.Model):
@@ -97,7 +274,68 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts, kept up to date by the Follows/Likes/Message
+    # event listeners below and rechecked by `counters.reconcile`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Row versions for HTTP validators (see caching.py). profile_version
+    # goes up when the user edits their profile; activity_version when their
+    # messages, likes or follows (either way) change.
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    activity_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set once trimming drops entries from the user's home timeline ring;
+    # from then on, history older than the ring comes from the follow graph
+    # (see timeline.py).
+
+    timeline_trimmed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
+    # messages are removed by the database's ON DELETE CASCADE
+    messages = db.relationship('Message', passive_deletes='all')
 
     followers = db.relationship(
         "User",
@@ -122,16 +360,26 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
+
+        (For many users at once, use `follows.FollowState`.)
+        """
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        (For many users at once, use `follows.FollowState`.)
+        """
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
+
+    @classmethod
+    def exists(cls, user_id):
+        """Is there a user `user_id`?"""
+
+        return db.session.query(cls.query.filter_by(id=user_id).exists()).scalar()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -140,7 +388,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -161,26 +409,54 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with a different bcrypt cost than the one
+        configured now, it's replaced (commit the session to keep it).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
 
 
+# worker ids for the processes making message ids
+snowflake_workers = db.Sequence('snowflake_workers', metadata=db.metadata)
+
+
+def lease_worker_id(connection):
+    return connection.scalar(snowflake_workers.next_value())
+
+
+message_ids = snowflake.IdGenerator(lease_worker_id)
+
+
+def new_message_id(context):
+    return message_ids.next_id(context.connection)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # a user's messages newest first (see pagination.py)
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
+    # time-ordered (see snowflake.py), so newest first is highest id first
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=new_message_id,
     )
 
     text = db.Column(
@@ -191,7 +467,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -200,11 +476,184 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # how many users like this message, kept up to date like User's counts
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
     def __repr__(self):
         return f"<Message #{self.id}: {self.timestamp}, {self.user_id}>"
 
+    @classmethod
+    def by_author(cls, user_id):
+        """Query of `user_id`'s messages."""
+
+        return cls.query.filter(cls.user_id == user_id)
+
+    @classmethod
+    def liked_by(cls, user_id):
+        """Query of the messages `user_id` likes."""
+
+        return (cls.query
+                .join(Likes, Likes.message_id == cls.id)
+                .filter(Likes.user_id == user_id))
+
+
+# username prefix search (see search.py)
+db.Index('ix_users_username_prefix',
+         func.lower(User.username).label('username_lower'),
+         postgresql_ops={'username_lower': 'text_pattern_ops'})
+
+
+##############################################################################
+# Counter maintenance
+#
+# Adding or deleting Follows, Likes and Message rows through the session
+# adjusts the denormalized counts on User (and Message.like_count) in the
+# same transaction. (Changes made through the `following`/`followers`/`likes`
+# collections don't go through these listeners, so app code works with the
+# rows directly.)
+
+
+def adjust_counts(connection, user_ids, **deltas):
+    """Add `deltas` (e.g. followers_count=1) to the counts of `user_ids`,
+    and bump their activity_version.
+
+    `user_ids` is a user id, a list of them, or a selectable of user ids.
+    """
+
+    users = User.__table__
+
+    if isinstance(user_ids, int):
+        criterion = users.c.id == user_ids
+    else:
+        criterion = users.c.id.in_(user_ids)
+
+    values = {users.c[name]: users.c[name] + delta
+              for name, delta in deltas.items()}
+    values[users.c.activity_version] = users.c.activity_version + 1
+
+    connection.execute(users.update().where(criterion).values(values))
+
+
+PROFILE_FIELDS = ['username', 'email', 'image_url', 'header_image_url', 'bio', 'location']
+
+
+@event.listens_for(User, 'before_update')
+def bump_profile_version(mapper, connection, user):
+    state = inspect(user)
+
+    if any(state.attrs[name].history.has_changes() for name in PROFILE_FIELDS):
+        user.profile_version = User.profile_version + 1
+
+
+@event.listens_for(Follows, 'after_insert')
+def count_follow(mapper, connection, follow):
+    adjust_counts(connection, follow.user_following_id, following_count=1)
+    adjust_counts(connection, follow.user_being_followed_id, followers_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def uncount_follow(mapper, connection, follow):
+    adjust_counts(connection, follow.user_following_id, following_count=-1)
+    adjust_counts(connection, follow.user_being_followed_id, followers_count=-1)
+
+
+def adjust_like_count(connection, message_id, delta):
+    """Add `delta` to the like_count of `message_id`."""
+
+    messages = Message.__table__
+    connection.execute(messages.update()
+                       .where(messages.c.id == message_id)
+                       .values(like_count=messages.c.like_count + delta))
+
+
+@event.listens_for(Likes, 'after_insert')
+def count_like(mapper, connection, like):
+    adjust_counts(connection, like.user_id, likes_count=1)
+    adjust_like_count(connection, like.message_id, 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def uncount_like(mapper, connection, like):
+    adjust_counts(connection, like.user_id, likes_count=-1)
+    adjust_like_count(connection, like.message_id, -1)
+
+
+@event.listens_for(Message, 'after_insert')
+def count_message(mapper, connection, message):
+    adjust_counts(connection, message.user_id, messages_count=1)
+
+
+@event.listens_for(Message, 'before_delete')
+def uncount_message(mapper, connection, message):
+    adjust_counts(connection, message.user_id, messages_count=-1)
+
+    # the message's likes go with it through ON DELETE CASCADE
+    likers = (db.select([Likes.user_id])
+              .where(Likes.message_id == message.id))
+    adjust_counts(connection, likers, likes_count=-1)
+
+
+@event.listens_for(db.session, 'before_flush')
+def uncount_deleted_users(session, flush_context, instances):
+    """Release the counts a user contributes to others before they're deleted.
+
+    This runs before the flush so the user's follows are still in place.
+    """
+
+    follows = Follows.__table__
+    likes = Likes.__table__
+    messages = Message.__table__
+    users = User.__table__
+
+    user_ids = [obj.id for obj in session.deleted if isinstance(obj, User)]
+    if not user_ids:
+        return
+
+    connection = session.connection()
+
+    followed = (db.select([follows.c.user_being_followed_id])
+                .where(follows.c.user_following_id.in_(user_ids)))
+    adjust_counts(connection, followed, followers_count=-1)
+
+    followers = (db.select([follows.c.user_following_id])
+                 .where(follows.c.user_being_followed_id.in_(user_ids)))
+    adjust_counts(connection, followers, following_count=-1)
+
+    # likes of these users' messages cascade away with the messages
+    liked = (db.select([func.count()])
+             .select_from(likes.join(messages))
+             .where(messages.c.user_id.in_(user_ids))
+             .where(likes.c.user_id == users.c.id)
+             .as_scalar())
+    likers = (db.select([likes.c.user_id])
+              .select_from(likes.join(messages))
+              .where(messages.c.user_id.in_(user_ids)))
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(likers))
+        .values(likes_count=users.c.likes_count - liked,
+                activity_version=users.c.activity_version + 1))
+
+    # and these users' likes of other messages cascade away with them
+    likes_lost = (db.select([func.count()])
+                  .select_from(likes)
+                  .where(likes.c.user_id.in_(user_ids))
+                  .where(likes.c.message_id == messages.c.id)
+                  .as_scalar())
+    liked_messages = (db.select([likes.c.message_id])
+                      .where(likes.c.user_id.in_(user_ids)))
+    connection.execute(
+        messages.update()
+        .where(messages.c.id.in_(liked_messages))
+        .values(like_count=messages.c.like_count - likes_lost))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -212,5 +661,18 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
+    # Each process keeps up to DB_POOL_SIZE connections open, and opens up to
+    # DB_POOL_MAX_OVERFLOW more under load. A request waits at most
+    # DB_POOL_TIMEOUT seconds for one, then fails (app.py serves a 503).
+    # Connections are replaced after DB_POOL_RECYCLE seconds, and checked
+    # before use if DB_POOL_PRE_PING. Set DB_PGBOUNCER when connecting
+    # through pgbouncer in transaction pooling mode.
+    app.config.setdefault('DB_POOL_SIZE', 5)
+    app.config.setdefault('DB_POOL_MAX_OVERFLOW', 10)
+    app.config.setdefault('DB_POOL_TIMEOUT', 2)
+    app.config.setdefault('DB_POOL_RECYCLE', 1800)
+    app.config.setdefault('DB_POOL_PRE_PING', True)
+    app.config.setdefault('DB_PGBOUNCER', False)
+
     db.app = app
     db.init_app(app)
@@ -0,0 +1,113 @@
+"""Keyset (cursor) pagination for Warbler message lists.
+
+Pages are addressed by opaque cursors encoding a message's id (ids are
+time-ordered, see snowflake.py), rather than by OFFSET, so fetching a page
+deep in someone's history costs the same index range scan as fetching the
+first one. (Other lists, like the API's lists of users, can be paged the
+same way by their own ids.)
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from flask import abort
+
+from models import Message
+
+
+class Page:
+    """One page of messages, newest first, and the cursors around it.
+
+    `older` is a cursor for the next older page, or None when there's
+    nothing older. `newer` is a cursor for what's newer than this page,
+    even on the newest page, so clients can poll it for new messages (an
+    empty `after` page gives back its own cursor); it's None only for an
+    empty page that isn't an `after` page. `latest` says there was nothing
+    newer when the page was fetched.
+    """
+
+    def __init__(self, items, newer=None, older=None, latest=False):
+        self.items = items
+        self.newer = newer
+        self.older = older
+        self.latest = latest
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing at `message` (or any row with an `id`)."""
+
+    key = str(message.id)
+    return urlsafe_b64encode(key.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Message id encoded in `cursor`; aborts with a 400 if it's invalid."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(urlsafe_b64decode(padded.encode('ascii')).decode('UTF-8'))
+
+    except (ValueError, UnicodeError, binascii.Error):
+        abort(400)
+
+
+def paginate(queries, before=None, after=None, per_page=100, options=(),
+             key=Message.id, project=None):
+    """Fetch one page of messages from `queries`.
+
+    `queries` is a Message query, or a list of them whose results are
+    merged. Pass a cursor as `before` for messages older than it, or as
+    `after` for messages newer than it; with neither, the newest page.
+    `options` (e.g. eager loads) apply to the final, merged query.
+
+    `project`, if given, is applied to each query first, e.g. to select
+    only some columns; the rows must still have an `id`. To page by some
+    other id column, pass it as `key`.
+    """
+
+    if not isinstance(queries, list):
+        queries = [queries]
+
+    if after:
+        criterion = key > decode_cursor(after)
+        order = key.asc()
+    elif before:
+        criterion = key < decode_cursor(before)
+        order = key.desc()
+    else:
+        criterion = None
+        order = key.desc()
+
+    branches = []
+    for query in queries:
+        if project is not None:
+            query = project(query)
+        if criterion is not None:
+            query = query.filter(criterion)
+        branches.append(query.order_by(order).limit(per_page + 1))
+
+    query = branches[0]
+    if len(branches) > 1:
+        query = query.union(*branches[1:]).order_by(order).limit(per_page + 1)
+
+    rows = query.options(*options).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+
+    if after:
+        items.reverse()
+        newer = encode_cursor(items[0]) if items else after
+        older = encode_cursor(items[-1]) if items else None
+        latest = not has_more
+    else:
+        newer = encode_cursor(items[0]) if items else None
+        older = encode_cursor(items[-1]) if has_more else None
+        latest = not before
+
+    return Page(items, newer=newer, older=older, latest=latest)
@@ -0,0 +1,166 @@
+"""Password hashing for Warbler, off the request thread.
+
+bcrypt is slow on purpose, so hashing inline lets a burst of signups or
+logins pin every worker's CPU. Instead, hashes are computed and checked in
+a bounded pool of processes. Once PASSWORD_POOL_QUEUE_DEPTH jobs are
+waiting, further callers get PasswordPoolBusy straight away (served as a
+503) rather than queueing behind them.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+import bcrypt
+
+settings = {
+    'rounds': 12,
+    'workers': os.cpu_count() or 1,
+    'queue_depth': 4 * (os.cpu_count() or 1),
+    'timeout': 10,
+}
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+_slots = BoundedSemaphore(settings['queue_depth'])
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password hashes are already waiting to be computed."""
+
+
+def init_app(app):
+    """Configure hashing from `app`'s config.
+
+    BCRYPT_LOG_ROUNDS is the bcrypt cost for new hashes,
+    PASSWORD_POOL_WORKERS the number of hashing processes (0 hashes inline),
+    PASSWORD_POOL_QUEUE_DEPTH how many jobs may wait for them and
+    PASSWORD_POOL_TIMEOUT how many seconds to wait for a result.
+    """
+
+    global _slots
+
+    settings['rounds'] = app.config.setdefault('BCRYPT_LOG_ROUNDS', settings['rounds'])
+    settings['workers'] = app.config.setdefault('PASSWORD_POOL_WORKERS', settings['workers'])
+    settings['queue_depth'] = app.config.setdefault(
+        'PASSWORD_POOL_QUEUE_DEPTH', 4 * max(settings['workers'], 1))
+    settings['timeout'] = app.config.setdefault('PASSWORD_POOL_TIMEOUT', settings['timeout'])
+
+    _slots = BoundedSemaphore(settings['queue_depth'])
+
+
+def hash_password(password, rounds=None):
+    """bcrypt hash (as a str) of `password`, at the configured cost."""
+
+    if not password:
+        raise ValueError("Password must be non-empty.")
+
+    return _run(_hash, password, rounds or settings['rounds'])
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return _run(_check, hashed, password)
+
+
+def hash_rounds(hashed):
+    """The bcrypt cost a hash was made with, e.g. 12 for '$2b$12$...'."""
+
+    return int(hashed.split('$')[2])
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a different cost than the configured one?"""
+
+    return hash_rounds(hashed) != settings['rounds']
+
+
+def calibrate(target_ms, min_rounds=4, max_rounds=16):
+    """Find the highest bcrypt cost that hashes within `target_ms` here.
+
+    Returns (rounds, {rounds: milliseconds taken}). Hashes inline, one at a
+    time, so run it on an otherwise idle host.
+    """
+
+    timings = {}
+    best = min_rounds
+
+    for rounds in range(min_rounds, max_rounds + 1):
+        start = perf_counter()
+        _hash('calibration password', rounds)
+        timings[rounds] = (perf_counter() - start) * 1000
+
+        if timings[rounds] > target_ms:
+            break
+        best = rounds
+
+    return best, timings
+
+
+def _run(fn, *args):
+    """Run fn(*args) in the pool (or inline if there are no workers)."""
+
+    if not settings['workers']:
+        return fn(*args)
+
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise PasswordPoolBusy()
+
+    pool = _get_pool()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        slots.release()
+        _discard_pool(pool)
+        raise PasswordPoolBusy()
+
+    # the slot is held until the job is done, not just until we give up
+    # waiting for it, so timed-out jobs still count against the queue
+    future.add_done_callback(lambda future: slots.release())
+
+    try:
+        return future.result(timeout=settings['timeout'])
+    except TimeoutError:
+        raise PasswordPoolBusy()
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM-killed); the next call starts a new pool
+        _discard_pool(pool)
+        raise PasswordPoolBusy()
+
+
+def _get_pool():
+    """This process's pool, created on first use (and again after a fork)."""
+
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=settings['workers'])
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def _discard_pool(pool):
+    """Stop using `pool`, if it's still this process's pool."""
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+    pool.shutdown(wait=False)
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
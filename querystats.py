@@ -0,0 +1,249 @@
+"""Counting and timing the SQL statements Warbler issues.
+
+`init_app` hooks the SQLAlchemy engine so every request records how many
+statements it ran, the total time spent in the database and its slowest
+statement. Those are reported in a `Server-Timing` response header and a
+log line per request.
+
+If the engine uses `TimedQueuePool` (models.py sets it up), requests also
+record how long they waited to check a connection out of the pool, and
+`pool_metrics` reports the pools' sizes, checkouts and waits.
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# lists collecting (request, QueryStats) pairs; see `record_requests`
+_recorders = []
+
+
+class QueryStats:
+    """The statements run while handling one request."""
+
+    def __init__(self):
+        self.statements = []
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.pool_wait = 0.0
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def record(self, statement, duration):
+        self.statements.append(statement)
+        self.total += duration
+
+        if duration >= self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+
+    def server_timing(self):
+        """Value for a `Server-Timing` header describing these statements."""
+
+        return (f'db;dur={self.total * 1000:.2f};desc="{self.count} queries", '
+                f'db-slowest;dur={self.slowest * 1000:.2f}, '
+                f'db-pool;dur={self.pool_wait * 1000:.2f}')
+
+    def log_line(self, method, path, status):
+        """Structured (key=value) log line describing these statements."""
+
+        return (f"queries method={method} path={path} status={status} "
+                f"count={self.count} db_ms={self.total * 1000:.2f} "
+                f"slowest_ms={self.slowest * 1000:.2f} "
+                f"pool_wait_ms={self.pool_wait * 1000:.2f}")
+
+
+class QueryCounter:
+    """Context manager recording every statement run on `engine` inside it.
+
+        with QueryCounter(db.engine) as queries:
+            client.get('/')
+        print(queries.count, queries.statements)
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits, into the request's
+    QueryStats and running totals for `pool_metrics`.
+
+    The wait includes opening a new connection when the pool has none idle.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._totals_lock = Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait = perf_counter() - start
+            with self._totals_lock:
+                self.checkouts += 1
+                self.checkout_timeouts += timed_out
+                self.checkout_wait += wait
+
+            if has_request_context():
+                stats = getattr(g, 'query_stats', None)
+                if stats is not None:
+                    stats.pool_wait += wait
+
+    def recreate(self):
+        # keep the totals going when the pool is replaced, e.g. on dispose()
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.checkout_timeouts = self.checkout_timeouts
+        pool.checkout_wait = self.checkout_wait
+        return pool
+
+
+POOL_METRICS = [
+    # (name, type, help, value of a TimedQueuePool)
+    ('db_pool_size', 'gauge',
+     "Connections the pool keeps open.", lambda pool: pool.size()),
+    ('db_pool_checked_out', 'gauge',
+     "Connections currently checked out.", lambda pool: pool.checkedout()),
+    ('db_pool_overflow', 'gauge',
+     "Connections open beyond the pool size (negative while it fills).",
+     lambda pool: pool.overflow()),
+    ('db_pool_checkouts_total', 'counter',
+     "Connections checked out.", lambda pool: pool.checkouts),
+    ('db_pool_checkout_timeouts_total', 'counter',
+     "Checkouts that gave up waiting for a connection.",
+     lambda pool: pool.checkout_timeouts),
+    ('db_pool_checkout_wait_seconds_total', 'counter',
+     "Time spent waiting to check connections out.",
+     lambda pool: pool.checkout_wait),
+]
+
+
+def pool_metrics(engines):
+    """Prometheus text exposition of the pool metrics of `engines`, a dict
+    of {bind name: engine}. Engines without a TimedQueuePool are left out.
+    """
+
+    pools = {name: engine.pool for name, engine in engines.items()
+             if isinstance(engine.pool, TimedQueuePool)}
+
+    lines = []
+    for name, kind, help, value in POOL_METRICS:
+        lines.append(f"# HELP warbler_{name} {help}")
+        lines.append(f"# TYPE warbler_{name} {kind}")
+        for bind, pool in pools.items():
+            lines.append(f'warbler_{name}{{bind="{bind}"}} {value(pool)}')
+
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Record query stats for each of `app`'s requests.
+
+    Call this before registering any other `before_request` hooks, so the
+    queries they run are counted too.
+    """
+
+    app.config.setdefault('QUERY_STATS_HEADER', True)
+    app.config.setdefault('SLOW_REQUEST_DB_MS', 200)
+
+    if not event.contains(Engine, 'before_cursor_execute', _start_timer):
+        event.listen(Engine, 'before_cursor_execute', _start_timer)
+        event.listen(Engine, 'after_cursor_execute', _stop_timer)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = getattr(g, 'query_stats', None)
+        if stats is None:
+            return response
+
+        if app.config['QUERY_STATS_HEADER']:
+            response.headers.add('Server-Timing', stats.server_timing())
+
+        line = stats.log_line(request.method, request.path, response.status_code)
+        if stats.total * 1000 >= app.config['SLOW_REQUEST_DB_MS']:
+            app.logger.warning(f'{line} slowest="{stats.slowest_statement}"')
+        else:
+            app.logger.info(line)
+
+        for recorder in _recorders:
+            recorder.append((f"{request.method} {request.full_path}", stats))
+
+        return response
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = perf_counter() - conn.info['query_start'].pop()
+
+    if has_request_context():
+        stats = getattr(g, 'query_stats', None)
+        if stats is not None:
+            stats.record(statement, duration)
+
+
+@contextmanager
+def record_requests():
+    """Collect (request, QueryStats) for every request finished in the block."""
+
+    recorded = []
+    _recorders.append(recorded)
+    try:
+        yield recorded
+    finally:
+        _recorders.remove(recorded)
+
+
+@contextmanager
+def query_budget(test, limit):
+    """Fail the TestCase `test` if any request in the block runs more than
+    `limit` statements.
+    """
+
+    with record_requests() as recorded:
+        yield recorded
+
+    for name, stats in recorded:
+        test.assertLessEqual(
+            stats.count, limit,
+            f"{name} ran {stats.count} queries (budget {limit}):\n"
+            + "\n\n".join(stats.statements))
@@ -0,0 +1,93 @@
+"""Sending Warbler's reads to a read replica.
+
+With a `replica` bind configured (SQLALCHEMY_BINDS, see app.py), GET and
+HEAD requests run their SELECTs on the replica, so browsing pages doesn't
+compete with posting, liking and following on the primary. Everything else
+goes to the primary:
+
+- writes, and any statement after one in the same session, so a request
+  reads what it just wrote;
+- every request from a browser that wrote in the last
+  READ_YOUR_WRITES_SECONDS (marked by a cookie), so the page it's sent to
+  next doesn't come from a replica that hasn't caught up yet.
+
+Without a replica bind, everything goes to the primary as before.
+"""
+
+import flask_sqlalchemy
+from flask import current_app, request
+from sqlalchemy.sql.expression import SelectBase, TextClause
+
+REPLICA = 'replica'
+PRIMARY_COOKIE = 'read_primary'
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def is_read(clause):
+    """Is `clause` a statement that only reads?
+
+    A session asking for a connection without a statement (or for a
+    flush) might do anything with it, so that isn't a read.
+    """
+
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith('SELECT')
+
+    return (isinstance(clause, SelectBase)
+            and getattr(clause, '_for_update_arg', None) is None)
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """Session that sends reads to the replica while `read_from_replica`.
+
+    `wrote` is set once the session writes (or might have), after which it
+    only uses the primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.read_from_replica = False
+        self.wrote = False
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not is_read(clause):
+            self.wrote = True
+        elif self.read_from_replica and not self.wrote:
+            return self.db.get_engine(self.app, bind=REPLICA)
+
+        return super().get_bind(mapper, clause)
+
+
+def has_replica(app):
+    return REPLICA in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def init_app(app, db):
+    """Route `app`'s requests' reads between the primary and the replica.
+
+    Call this before registering any `before_request` hooks that query.
+    """
+
+    app.config.setdefault('READ_YOUR_WRITES_SECONDS', 10)
+
+    @app.before_request
+    def route_reads():
+        session = db.session()
+        session.wrote = False
+        session.read_from_replica = (has_replica(current_app)
+                                     and request.method in SAFE_METHODS
+                                     and PRIMARY_COOKIE not in request.cookies)
+
+    @app.after_request
+    def stick_to_primary(response):
+        session = db.session()
+        if session.wrote and has_replica(current_app):
+            response.set_cookie(PRIMARY_COOKIE, '1',
+                                max_age=current_app.config['READ_YOUR_WRITES_SECONDS'],
+                                httponly=True, samesite='Lax')
+
+        # later uses of this session, e.g. in tests, start on the primary
+        session.read_from_replica = False
+        return response
@@ -0,0 +1,376 @@
+"""User search for Warbler.
+
+`/users?q=` matches the query anywhere in a user's username, bio or
+location, and ranks exact and prefix username matches first, then by
+trigram similarity. Queries shorter than a trigram take a fast path that
+only looks for usernames starting with them.
+
+On PostgreSQL with the pg_trgm indexes from `flask upgrade-db`, searches
+run in the database. Without them, searches use an in-process trigram
+index of every user, built on first use and rebuilt every
+SEARCH_INDEX_TTL seconds (this process keeps it current for its own
+changes in between). Rebuilds run in a background thread; searches keep
+using the old index until the new one is ready.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import case, func, or_, text
+
+from models import db, User
+
+TRIGRAM_INDEXES = ['ix_users_username_trgm', 'ix_users_bio_trgm', 'ix_users_location_trgm']
+
+settings = {
+    'backend': 'auto',
+    'index_ttl': 300,
+}
+
+
+class Results:
+    """One page of matching users."""
+
+    def __init__(self, users, page, has_next):
+        self.users = users
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+
+def init_app(app):
+    """Configure search from `app`'s config.
+
+    SEARCH_BACKEND is 'postgres', 'memory' or 'auto' (postgres if its
+    indexes exist); SEARCH_INDEX_TTL is how often the in-process index is
+    rebuilt, in seconds.
+    """
+
+    settings['backend'] = app.config.setdefault('SEARCH_BACKEND', 'auto')
+    settings['index_ttl'] = app.config.setdefault('SEARCH_INDEX_TTL', 300)
+
+
+def search_users(q, page=1, per_page=60):
+    """Page `page` of users matching `q`, best matches first."""
+
+    q = q.strip().lower()
+    offset = (page - 1) * per_page
+
+    if backend() == 'postgres':
+        ids = _postgres_search(q, offset, per_page + 1)
+    else:
+        ids = memory_index().search(q, offset, per_page + 1)
+
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids[:per_page]))}
+    return Results([users[i] for i in ids[:per_page] if i in users],
+                   page, len(ids) > per_page)
+
+
+def all_users(page=1, per_page=60):
+    """Page `page` of every user, in signup order."""
+
+    users = (User
+             .query
+             .order_by(User.id)
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+
+    return Results(users[:per_page], page, len(users) > per_page)
+
+
+##############################################################################
+# PostgreSQL
+
+
+_postgres_ready = None
+
+
+def backend():
+    """'postgres' or 'memory': where searches run in this process."""
+
+    global _postgres_ready
+
+    if settings['backend'] != 'auto':
+        return settings['backend']
+
+    if _postgres_ready is None:
+        _postgres_ready = (
+            db.engine.dialect.name == 'postgresql'
+            and db.session.execute(
+                text("SELECT count(*) FROM pg_indexes "
+                     "WHERE tablename = 'users' AND indexname = ANY(:names)"),
+                {'names': TRIGRAM_INDEXES}).scalar() == len(TRIGRAM_INDEXES))
+
+    return 'postgres' if _postgres_ready else 'memory'
+
+
+def _escape_like(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _postgres_search(q, offset, limit):
+    """Ids of users matching `q`, ranked, using the pg_trgm indexes."""
+
+    username = func.lower(User.username)
+    prefix = _escape_like(q) + '%'
+
+    if len(q) < 3:
+        query = (db.session
+                 .query(User.id)
+                 .filter(username.like(prefix, escape='\\'))
+                 .order_by(func.length(User.username), User.id))
+    else:
+        pattern = '%' + _escape_like(q) + '%'
+        query = (db.session
+                 .query(User.id)
+                 .filter(or_(User.username.ilike(pattern, escape='\\'),
+                             User.bio.ilike(pattern, escape='\\'),
+                             User.location.ilike(pattern, escape='\\')))
+                 .order_by(
+                     case([(username == q, 2),
+                           (username.like(prefix, escape='\\'), 1)],
+                          else_=0).desc(),
+                     func.greatest(func.similarity(User.username, q),
+                                   func.similarity(User.bio, q),
+                                   func.similarity(User.location, q)).desc(),
+                     User.id))
+
+    return [user_id for (user_id,) in query.offset(offset).limit(limit)]
+
+
+##############################################################################
+# In-process index
+
+
+def trigrams(value):
+    """Set of the 3-character substrings of `value` (lowercased)."""
+
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class MemoryIndex:
+    """Trigram index of users' username, bio and location."""
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.documents = {}
+        self.usernames = []
+        self.built = monotonic()
+        self._lock = Lock()
+
+    @classmethod
+    def build(cls, rows):
+        """Index of the (user_id, username, bio, location) `rows`, with the
+        usernames sorted once at the end rather than kept sorted per row."""
+
+        index = cls()
+        index.usernames = sorted(index._index(*row) for row in rows)
+        return index
+
+    def add(self, user_id, username, bio=None, location=None):
+        """Index (or reindex) one user."""
+
+        with self._lock:
+            self._remove(user_id)
+            key = self._index(user_id, username, bio, location)
+            self.usernames.insert(bisect_left(self.usernames, key), key)
+
+    def remove(self, user_id):
+        """Drop one user from the index."""
+
+        with self._lock:
+            self._remove(user_id)
+
+    def search(self, q, offset, limit):
+        """Ids of users matching `q` (lowercased), ranked like postgres."""
+
+        with self._lock:
+            if len(q) < 3:
+                return self._prefix_search(q)[offset:offset + limit]
+
+            grams = trigrams(q)
+            candidates = set.intersection(
+                *[self.postings.get(gram, set()) for gram in grams])
+
+            matches = []
+            for user_id in candidates:
+                username, bio, location = self.documents[user_id]
+                if not any(q in field for field in (username, bio, location)):
+                    continue
+
+                rank = 2 if username == q else 1 if username.startswith(q) else 0
+                similarity = max(_similarity(grams, field)
+                                 for field in (username, bio, location))
+                matches.append((-rank, -similarity, user_id))
+
+            matches.sort()
+            return [user_id for (_, _, user_id) in matches[offset:offset + limit]]
+
+    def _prefix_search(self, q):
+        start = bisect_left(self.usernames, (q, -1))
+        matches = []
+
+        for username, user_id in self.usernames[start:]:
+            if not username.startswith(q):
+                break
+            matches.append((len(username), user_id))
+
+        return [user_id for (_, user_id) in sorted(matches)]
+
+    def _index(self, user_id, username, bio, location):
+        """Add one (unindexed) user's fields; returns their username key."""
+
+        fields = [(username or '').lower(), (bio or '').lower(),
+                  (location or '').lower()]
+        self.documents[user_id] = fields
+
+        for field in fields:
+            for trigram in trigrams(field):
+                self.postings[trigram].add(user_id)
+
+        return (fields[0], user_id)
+
+    def _remove(self, user_id):
+        fields = self.documents.pop(user_id, None)
+        if fields is None:
+            return
+
+        for field in fields:
+            for trigram in trigrams(field):
+                self.postings[trigram].discard(user_id)
+
+        key = (fields[0], user_id)
+        position = bisect_left(self.usernames, key)
+        if position < len(self.usernames) and self.usernames[position] == key:
+            del self.usernames[position]
+
+
+def _similarity(grams, field):
+    """Trigram similarity (shared / total distinct trigrams) of a query and field."""
+
+    field_grams = trigrams(field)
+    if not field_grams:
+        return 0
+    return len(grams & field_grams) / len(grams | field_grams)
+
+
+_memory_index = None
+
+# changes made while a rebuild is running (None when none is), replayed
+# onto the new index before it replaces the old one
+_pending_changes = None
+
+# guards the two above; never held while building
+_memory_index_lock = Lock()
+
+# only one request builds the first index
+_first_build_lock = Lock()
+
+
+def memory_index():
+    """This process's in-memory index, (re)built from the users table as needed.
+
+    The first call builds it; after that, a stale index starts a rebuild in
+    the background and is used until the new one is ready.
+    """
+
+    global _pending_changes
+
+    with _memory_index_lock:
+        index = _memory_index
+        if (index is not None and _pending_changes is None
+                and monotonic() - index.built > settings['index_ttl']):
+            _pending_changes = []
+            Thread(target=_rebuild_in_background,
+                   args=(current_app._get_current_object(),),
+                   name='search-index', daemon=True).start()
+
+    if index is None:
+        with _first_build_lock:
+            with _memory_index_lock:
+                index = _memory_index
+                if index is None:
+                    _pending_changes = []
+            if index is None:
+                index = _rebuild()
+
+    return index
+
+
+def _rebuild():
+    """Build a new index from the users table and swap it in."""
+
+    global _memory_index, _pending_changes
+
+    try:
+        rows = db.session.query(User.id, User.username, User.bio, User.location)
+        index = MemoryIndex.build(rows.yield_per(1000))
+    except BaseException:
+        with _memory_index_lock:
+            _pending_changes = None
+        raise
+
+    with _memory_index_lock:
+        for change in _pending_changes:
+            change(index)
+        _pending_changes = None
+        _memory_index = index
+
+    return index
+
+
+def _rebuild_in_background(app):
+    with app.app_context():
+        try:
+            _rebuild()
+        except Exception:
+            app.logger.exception("rebuilding the search index failed")
+
+
+def _change(change):
+    """Apply `change` to the current index, and to one being rebuilt."""
+
+    with _memory_index_lock:
+        index = _memory_index
+        if _pending_changes is not None:
+            _pending_changes.append(change)
+
+    if index is not None:
+        change(index)
+
+
+def index_user(user):
+    """Reflect a new or updated user in the in-process index, if there is one."""
+
+    fields = (user.id, user.username, user.bio, user.location)
+    _change(lambda index: index.add(*fields))
+
+
+def unindex_user(user_id):
+    """Drop a deleted user from the in-process index, if there is one."""
+
+    _change(lambda index: index.remove(user_id))
+
+
+def reset():
+    """Forget the in-process index and which backend is available."""
+
+    global _memory_index, _pending_changes, _postgres_ready
+
+    _memory_index = None
+    _pending_changes = None
+    _postgres_ready = None
@@ -1,20 +1,312 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Streams each CSV straight into PostgreSQL with COPY, a chunk of rows at a
+time, so seeding millions of rows doesn't go through Python objects. While
+loading, the tables' foreign keys and non-unique indexes are dropped; they
+are recreated (and checked) once at the end, in the same transaction, so a
+failed load leaves the database as it was.
 
+    python seed.py                      # replace the tables' contents
+    python seed.py --upsert             # add rows, skipping duplicates
+    python seed.py --dir data/ --chunk-size 100000
 
-db.drop_all()
-db.create_all()
+By default the loaded tables are emptied first (and their ids restarted).
+With --upsert, rows are added to what's there and rows that clash with a
+unique constraint (a username or email already taken, an existing follow)
+are skipped. The CSVs' ids are used if they have an `id` column; otherwise
+rows get new ids, so a CSV without ids can't be deduplicated by id. (New
+message ids are made from each message's timestamp, so they sort the way
+the app's own do; see snowflake.py. They never clash, and the load fails
+if one would.)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Afterwards, id sequences are moved past the largest loaded id and the
+denormalized user counts and home timelines are rebuilt.
+"""
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+import argparse
+import os
+from glob import glob
+from io import StringIO
+from time import perf_counter
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from psycopg2 import sql
 
-db.session.commit()
+from app import app, db
+import counters
+import snowflake
+import timeline
+
+# tables to load, in an order that satisfies their foreign keys
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+# tables whose ids are made from the rows' timestamps when a CSV has none
+TIME_ORDERED_IDS = ['messages']
+
+# a staged row's timestamp, in Unix milliseconds
+STAGED_MS = sql.SQL("floor(extract(epoch FROM timestamp) * 1000)::bigint")
+
+
+def csv_files(directory, table):
+    """CSV files holding rows for `table`: `<table>.csv` or `<table>.*.csv`."""
+
+    return sorted(glob(os.path.join(directory, f'{table}.csv'))
+                  + glob(os.path.join(directory, f'{table}.*.csv')))
+
+
+def read_chunks(csv_file, chunk_size):
+    """Yield the header line of `csv_file`, then its records in chunks.
+
+    Each chunk is a file-like object holding up to `chunk_size` records, as
+    written in the CSV. Records are only split on newlines outside quotes.
+    """
+
+    yield csv_file.readline()
+
+    chunk = StringIO()
+    records = 0
+    quotes = 0
+
+    for line in csv_file:
+        chunk.write(line)
+        quotes += line.count('"')
+
+        if quotes % 2 == 0:
+            records += 1
+            if records == chunk_size:
+                chunk.seek(0)
+                yield chunk
+                chunk = StringIO()
+                records = 0
+
+    if records:
+        chunk.seek(0)
+        yield chunk
+
+
+def deferred_constraints(cursor, tables):
+    """Foreign keys and non-unique indexes on `tables`.
+
+    Returns a list of (drop statement, create statement) pairs.
+    """
+
+    cursor.execute("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f' AND conrelid::regclass::text = ANY(%s)
+        ORDER BY conrelid::regclass::text, conname
+    """, (tables,))
+
+    deferred = [
+        (sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+            sql.Identifier(table), sql.Identifier(name)),
+         sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.Identifier(table), sql.Identifier(name), sql.SQL(definition)))
+        for table, name, definition in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE NOT indisunique AND indrelid::regclass::text = ANY(%s)
+        ORDER BY indexrelid::regclass::text
+    """, (tables,))
+
+    deferred += [
+        (sql.SQL("DROP INDEX {}").format(sql.Identifier(name)), sql.SQL(definition))
+        for name, definition in cursor.fetchall()]
+
+    return deferred
+
+
+def copy_table(cursor, table, paths, chunk_size, upsert, worker):
+    """COPY the CSV files `paths` into `table`.
+
+    Rows of tables in TIME_ORDERED_IDS without an `id` column get ids made
+    for `worker` (see `insert_with_ids`).
+
+    Returns (rows read, rows inserted).
+    """
+
+    read = inserted = 0
+
+    for path in paths:
+        with open(path, newline='') as csv_file:
+            chunks = read_chunks(csv_file, chunk_size)
+            names = [column.strip() for column in next(chunks).split(',')]
+            columns = sql.SQL(', ').join(sql.Identifier(name) for name in names)
+
+            make_ids = table in TIME_ORDERED_IDS and 'id' not in names
+
+            # rows are COPYed straight in, unless they need deduplicating or
+            # ids made, in which case they go through a staging table
+            staged = upsert or make_ids
+            if staged:
+                staging = sql.Identifier(f'seed_{table}')
+                cursor.execute(sql.SQL(
+                    "CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA").format(
+                        staging, columns, sql.Identifier(table)))
+                target = staging
+            else:
+                target = sql.Identifier(table)
+
+            copy = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                target, columns)
+
+            for chunk in chunks:
+                cursor.copy_expert(copy, chunk)
+                read += cursor.rowcount
+
+                if make_ids:
+                    # made ids are new, so a clash is a bug, not a duplicate
+                    inserted += insert_with_ids(cursor, table, names, staging, worker)
+                elif staged:
+                    cursor.execute(sql.SQL(
+                        "INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING"
+                    ).format(sql.Identifier(table), columns, columns, staging))
+                    inserted += cursor.rowcount
+                else:
+                    inserted += cursor.rowcount
+
+                if staged:
+                    cursor.execute(sql.SQL("TRUNCATE {}").format(staging))
+
+            if staged:
+                cursor.execute(sql.SQL("DROP TABLE {}").format(staging))
+
+    return read, inserted
+
+
+def insert_with_ids(cursor, table, names, staging, worker):
+    """INSERT the rows staged in `staging` into `table`, with time-ordered ids.
+
+    Each id is its row's timestamp, `worker` and a count of the rows this
+    load has given ids at that millisecond (kept in the `seed_ids` table),
+    so ids never repeat within a load or clash with another process's.
+    Raises ValueError if more rows share a millisecond than the sequence
+    bits can count.
+
+    Returns the number of rows inserted.
+    """
+
+    cursor.execute(sql.SQL("""
+        WITH counted AS (
+            INSERT INTO seed_ids (ms, used)
+            SELECT {ms}, count(*) FROM {staging} GROUP BY 1
+            ON CONFLICT (ms) DO UPDATE SET used = seed_ids.used + excluded.used
+            RETURNING used
+        )
+        SELECT max(used) FROM counted
+    """).format(ms=STAGED_MS, staging=staging))
+
+    used = cursor.fetchone()[0]
+    if used is not None and used > 1 << snowflake.SEQUENCE_BITS:
+        raise ValueError(f"{table}: more than {1 << snowflake.SEQUENCE_BITS} rows "
+                         f"at one millisecond; their ids would collide")
+
+    # this chunk's rows at each millisecond take the last of its counts
+    cursor.execute(sql.SQL("""
+        INSERT INTO {table} (id, {columns})
+        SELECT ((staged.ms - {epoch}) << {shift}) | {worker}
+               | (seed_ids.used - count(*) OVER same + row_number() OVER same - 1),
+               {staged_columns}
+        FROM (SELECT {ms} AS ms, {columns} FROM {staging}) AS staged
+        JOIN seed_ids ON seed_ids.ms = staged.ms
+        WINDOW same AS (PARTITION BY staged.ms)
+    """).format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(', ').join(sql.Identifier(name) for name in names),
+        epoch=sql.Literal(snowflake.EPOCH_MS),
+        shift=sql.Literal(snowflake.TIME_SHIFT),
+        worker=sql.Literal(worker << snowflake.SEQUENCE_BITS),
+        staged_columns=sql.SQL(', ').join(sql.Identifier('staged', name)
+                                          for name in names),
+        ms=STAGED_MS,
+        staging=staging))
+
+    return cursor.rowcount
+
+
+def reset_sequences(cursor, tables):
+    """Move each table's id sequence past its largest id."""
+
+    for table in tables:
+        cursor.execute("""
+            SELECT pg_get_serial_sequence(table_name, column_name)
+            FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'id'
+        """, (table,))
+        sequence = (cursor.fetchone() or [None])[0]
+
+        if sequence:
+            cursor.execute(sql.SQL(
+                "SELECT setval(%s, COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+                "FROM {}").format(sql.Identifier(table)), (sequence,))
+
+
+def load(directory='generator', chunk_size=50000, upsert=False, report=print):
+    """Load every table's CSVs from `directory`.
+
+    Returns {table: (rows read, rows inserted, seconds)}.
+    """
+
+    db.create_all()
+
+    tables = [table for table in TABLES if csv_files(directory, table)]
+    stats = {}
+
+    cursor = db.session.connection().connection.cursor()
+
+    if not upsert:
+        cursor.execute(sql.SQL("TRUNCATE {} RESTART IDENTITY CASCADE").format(
+            sql.SQL(', ').join(sql.Identifier(table) for table in tables)))
+
+    deferred = deferred_constraints(cursor, tables)
+    for drop, create in deferred:
+        cursor.execute(drop)
+
+    # made ids count up from a worker id leased for this load, like a process
+    cursor.execute("SELECT nextval('snowflake_workers')")
+    worker = cursor.fetchone()[0] % snowflake.WORKERS
+    cursor.execute("CREATE TEMP TABLE seed_ids (ms bigint PRIMARY KEY, used integer NOT NULL)")
+
+    for table in tables:
+        start = perf_counter()
+        read, inserted = copy_table(
+            cursor, table, csv_files(directory, table), chunk_size, upsert, worker)
+        stats[table] = (read, inserted, perf_counter() - start)
+
+        report(f"{table}: {inserted:,} of {read:,} rows in {stats[table][2]:.2f}s "
+               f"({read / max(stats[table][2], 1e-9):,.0f} rows/s)")
+
+    start = perf_counter()
+    for drop, create in deferred:
+        cursor.execute(create)
+    reset_sequences(cursor, tables)
+    cursor.execute("DROP TABLE seed_ids")
+    report(f"indexes and foreign keys rebuilt in {perf_counter() - start:.2f}s")
+
+    db.session.commit()
+
+    start = perf_counter()
+    counters.reconcile_all(report=False)
+    report(f"counts reconciled in {perf_counter() - start:.2f}s")
+
+    start = perf_counter()
+    timeline.rebuild_all()
+    db.session.commit()
+    report(f"timelines rebuilt in {perf_counter() - start:.2f}s")
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding users.csv, messages.csv...")
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="rows per COPY")
+    parser.add_argument('--upsert', action='store_true',
+                        help="add to the existing rows instead of replacing them")
+    args = parser.parse_args()
+
+    with app.app_context():
+        load(args.dir, args.chunk_size, args.upsert)
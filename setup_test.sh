@@ -5,4 +5,15 @@ echo 'begin testing'
 python -m unittest -v test_user_model.py
 python -m unittest -v test_message_model.py
 python -m unittest -v test_user_views.py
-python -m unittest -v test_message_views.py
\ No newline at end of file
+python -m unittest -v test_message_views.py
+python -m unittest -v test_timeline.py
+python -m unittest -v test_search.py
+python -m unittest -v test_seed.py
+python -m unittest -v test_benchmark.py
+python -m unittest -v test_assets.py
+python -m unittest -v test_query_plans.py
+python -m unittest -v test_snowflake.py
+python -m unittest -v test_replicas.py
+python -m unittest -v test_pool.py
+python -m unittest -v test_live.py
+python -m unittest -v test_api.py
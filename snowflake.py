@@ -0,0 +1,79 @@
+"""Time-ordered 64-bit ids for Warbler messages.
+
+Each id packs, from the high bits down, the milliseconds since EPOCH (41
+bits, good until 2079), the id of the process that made it (10 bits) and a
+per-millisecond sequence number (12 bits). Ids made later sort higher, so
+lists of messages can be ordered and paged by id alone, and new rows go at
+the right-hand end of the primary key's btree.
+
+Processes don't coordinate beyond leasing a worker id once (models.py takes
+them, round-robin, from a database sequence); each can then make 4096 ids
+per millisecond that no other process will make, as long as it isn't still
+running 1024 leases later.
+"""
+
+import os
+import threading
+from datetime import datetime
+from time import time
+
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+WORKERS = 1 << WORKER_BITS
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def make_id(ms, worker, sequence):
+    """The id for the `sequence`th id `worker` made at `ms` (Unix time)."""
+
+    return ((ms - EPOCH_MS) << TIME_SHIFT) | (worker << SEQUENCE_BITS) | sequence
+
+
+def timestamp(id):
+    """The (naive UTC) time `id` was made."""
+
+    return datetime.utcfromtimestamp(((id >> TIME_SHIFT) + EPOCH_MS) / 1000)
+
+
+class IdGenerator:
+    """Makes ids for one process at a time.
+
+    `lease_worker(*args)` is called, with the arguments of the first
+    `next_id` call, for a worker id the first time this process makes an id
+    (and again in a forked child). Thread-safe.
+    """
+
+    def __init__(self, lease_worker):
+        self.lease_worker = lease_worker
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = None
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self, *args):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._worker = self.lease_worker(*args) % WORKERS
+                self._pid = os.getpid()
+                self._last_ms = 0
+
+            ms = int(time() * 1000)
+
+            if ms > self._last_ms:
+                self._last_ms = ms
+                self._sequence = 0
+            else:
+                # same millisecond, or the clock stepped back: keep counting
+                # from the last one, borrowing the next millisecond if this
+                # one runs out, so ids never repeat or go backwards
+                self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+                if self._sequence == 0:
+                    self._last_ms += 1
+
+            return make_id(self._last_ms, self._worker, self._sequence)
@@ -0,0 +1,94 @@
+// Like and follow buttons, without reloading the page.
+//
+// The buttons are plain forms, so they work without JavaScript. With it,
+// they're posted in the background asking for JSON (the new state and
+// counts), and the button and counts on the page are updated in place.
+// If that doesn't work out, the form is submitted the ordinary way.
+
+const TOGGLES = /^\/users\/(add_like|remove_like|follow|stop-following)\/(\d+)$/;
+
+document.addEventListener('submit', async function (event) {
+  const form = event.target;
+  const match = new URL(form.action).pathname.match(TOGGLES);
+  if (!match) return;
+
+  event.preventDefault();
+
+  let state;
+  try {
+    const response = await fetch(form.action, {
+      method: 'POST',
+      body: new FormData(form),
+      headers: {Accept: 'application/json'},
+      credentials: 'same-origin',
+    });
+    if (!response.ok || !(response.headers.get('Content-Type') || '').includes('json')) {
+      throw new Error(response.statusText);
+    }
+    state = await response.json();
+  } catch (error) {
+    form.submit();
+    return;
+  }
+
+  if ('liked' in state) {
+    showLike(form, state, match[2]);
+  } else {
+    showFollow(form, state);
+  }
+});
+
+// Message ids are 64-bit, more than a JavaScript number holds exactly, so
+// use the one in the form's URL rather than the response's.
+function showLike(form, state, messageId) {
+  const button = form.querySelector('button');
+  const icon = form.querySelector('i');
+
+  form.action = `/users/${state.liked ? 'remove_like' : 'add_like'}/${messageId}`;
+  button.classList.toggle('btn-primary', state.liked);
+  button.classList.toggle('btn-secondary', !state.liked);
+  icon.classList.toggle('fa-star', state.liked);
+  icon.classList.toggle('fa-thumbs-up', !state.liked);
+
+  setCount('like-count', messageId, state.like_count);
+  setCount('likes-count', state.user_id, state.likes_count);
+}
+
+function showFollow(form, state) {
+  const button = form.querySelector('button');
+
+  form.action = `/users/${state.following ? 'stop-following' : 'follow'}/${state.user_id}`;
+  button.textContent = state.following ? 'Unfollow' : 'Follow';
+  button.classList.toggle('btn-primary', state.following);
+  button.classList.toggle('btn-outline-primary', !state.following);
+
+  setCount('followers-count', state.user_id, state.followers_count);
+  setCount('following-count', state.follower_id, state.following_count);
+}
+
+function setCount(name, userId, count) {
+  for (const element of document.querySelectorAll(`[data-${name}="${userId}"]`)) {
+    element.textContent = count;
+  }
+}
+
+// New messages on the home timeline, as they're posted (see live.py).
+//
+// The first page's message list names its stream; each `messages` event
+// carries the new list items, which go at the top. The browser reconnects
+// by itself when the stream ends, sending the last event's id.
+
+const live = document.querySelector('[data-live]');
+
+if (live && window.EventSource) {
+  const source = new EventSource(live.dataset.live);
+
+  source.addEventListener('messages', function (event) {
+    live.insertAdjacentHTML('afterbegin', event.data);
+  });
+
+  source.addEventListener('reset', function (event) {
+    source.close();
+    live.insertAdjacentHTML('afterbegin', event.data);
+  });
+}
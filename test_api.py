@@ -0,0 +1,187 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import gzip
+import json
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import search
+import timeline
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
+
+        for user_id, name in [(1, "author"), (2, "reader")]:
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = user_id
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=1, user_following_id=2))
+        db.session.add_all([Message(id=(1 << 60) + i, text=f"message {i}", user_id=1)
+                            for i in range(5)])
+        db.session.commit()
+        db.session.add(Likes(user_id=2, message_id=(1 << 60) + 1))
+        db.session.commit()
+        with app.app_context():
+            timeline.rebuild_all()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url, status=200):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status)
+        self.assertEqual(resp.mimetype, 'application/json')
+        return resp.get_json()
+
+    def test_timeline(self):
+        """The home timeline, newest first, with authors and string ids"""
+
+        data = self.get("/api/v1/timeline")
+
+        self.assertEqual([item['text'] for item in data['items']],
+                         [f"message {i}" for i in range(4, -1, -1)])
+        self.assertEqual(data['items'][0]['id'], str((1 << 60) + 4))
+        self.assertEqual(data['items'][0]['user'],
+                         {'id': 1, 'username': "author",
+                          'image_url': "/static/images/default-pic.png"})
+        self.assertIsNone(data['older'])
+
+    def test_fields(self):
+        """`fields` picks the fields, and only their columns are selected"""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            data = self.get("/api/v1/users/1/messages?fields=text,user.username")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        selects = [statement for statement in statements if 'FROM messages' in statement]
+        self.assertEqual(len(selects), 1)
+        self.assertIn("SELECT messages.id AS id, messages.text AS text, "
+                      "users.username AS user__username", selects[0])
+        self.assertEqual(data['items'][0], {'text': "message 4",
+                                            'user': {'username': "author"}})
+        self.assertEqual(self.get("/api/v1/users/1?fields=username,followers_count"),
+                         {'username': "author", 'followers_count': 1})
+
+        data = self.get("/api/v1/users/1/messages?fields=text,password", status=400)
+        self.assertEqual(data['error'], "unknown fields: password")
+
+    def test_paging(self):
+        """Lists page by cursor, like the pages do"""
+
+        first = self.get("/api/v1/users/1/messages?fields=text&limit=2")
+        self.assertEqual([item['text'] for item in first['items']],
+                         ["message 4", "message 3"])
+
+        second = self.get(f"/api/v1/users/1/messages?fields=text&limit=2"
+                          f"&before={first['older']}")
+        self.assertEqual([item['text'] for item in second['items']],
+                         ["message 2", "message 1"])
+
+        back = self.get(f"/api/v1/users/1/messages?fields=text&limit=2"
+                        f"&after={second['newer']}")
+        self.assertEqual(back['items'], first['items'])
+
+        self.get("/api/v1/timeline?before=not-a-cursor!", status=400)
+
+    def test_polling(self):
+        """The newest page's `newer` cursor can be polled for new messages"""
+
+        first = self.get("/api/v1/timeline?fields=text")
+        self.assertIsNotNone(first['newer'])
+
+        empty = self.get(f"/api/v1/timeline?fields=text&after={first['newer']}")
+        self.assertEqual(empty, {'items': [], 'newer': first['newer'], 'older': None})
+
+        db.session.add(Message(id=(1 << 60) + 5, text="message 5", user_id=1))
+        db.session.commit()
+        with app.app_context():
+            timeline.rebuild_all()
+
+        new = self.get(f"/api/v1/timeline?fields=text&after={empty['newer']}")
+        self.assertEqual(new['items'], [{'text': "message 5"}])
+        self.assertNotEqual(new['newer'], first['newer'])
+
+    def test_likes_and_follows(self):
+        """Likes, followers and following lists"""
+
+        likes = self.get("/api/v1/users/2/likes?fields=text")
+        self.assertEqual(likes['items'], [{'text': "message 1"}])
+
+        followers = self.get("/api/v1/users/1/followers?fields=id,username")
+        self.assertEqual(followers['items'], [{'id': 2, 'username': "reader"}])
+
+        following = self.get("/api/v1/users/2/following?fields=username")
+        self.assertEqual(following['items'], [{'username': "author"}])
+
+    def test_message(self):
+        """A single message, or a JSON 404"""
+
+        message_id = (1 << 60) + 3
+        self.assertEqual(self.get(f"/api/v1/messages/{message_id}?fields=id,like_count"),
+                         {'id': str(message_id), 'like_count': 0})
+        self.assertIn('error', self.get("/api/v1/messages/1", status=404))
+        self.get("/api/v1/users/99/messages", status=404)
+
+    def test_signed_out(self):
+        """Profiles and messages are public; the rest needs signing in"""
+
+        client = app.test_client()
+        self.assertEqual(client.get("/api/v1/users/1").status_code, 200)
+        self.assertEqual(client.get("/api/v1/users/1/messages").status_code, 200)
+
+        resp = client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+        self.assertEqual(client.get("/api/v1/users/1/followers").status_code, 401)
+
+    def test_gzip(self):
+        """Large enough responses are gzipped, if the client accepts it"""
+
+        with patch.dict(app.config, API_GZIP_MIN_BYTES=200):
+            resp = self.client.get("/api/v1/timeline", headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertEqual(len(json.loads(gzip.decompress(resp.data))['items']), 5)
+
+            resp = self.client.get("/api/v1/users/1?fields=id",
+                                   headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertNotIn('Content-Encoding', self.client.get("/api/v1/timeline").headers)
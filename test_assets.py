@@ -0,0 +1,119 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build a small static directory into a temporary one."""
+
+        self.directory = TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'static')
+        self.dist = os.path.join(self.directory.name, 'dist')
+
+        os.makedirs(os.path.join(self.source, 'images'))
+        os.makedirs(os.path.join(self.source, 'stylesheets'))
+
+        with open(os.path.join(self.source, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+        with open(os.path.join(self.source, 'stylesheets', 'style.css'), 'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n' * 50)
+
+        self.assets_dir = app.config['ASSETS_DIR']
+        app.config['ASSETS_DIR'] = self.dist
+        self.built = assets.build(self.source, self.dist)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'] = self.assets_dir
+        assets.load(self.assets_dir)
+        self.directory.cleanup()
+
+    def test_build(self):
+        """Test files get content-hashed names and a manifest"""
+
+        image = self.built['images/bg.png']
+        stylesheet = self.built['stylesheets/style.css']
+
+        self.assertRegex(image, r'^images/bg\.[0-9a-f]{12}\.png$')
+        self.assertRegex(stylesheet, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(self.dist, assets.MANIFEST)) as f:
+            self.assertEqual(json.load(f), self.built)
+
+        # the stylesheet points at the hashed image
+        with open(os.path.join(self.dist, stylesheet)) as f:
+            self.assertIn(f'url("/assets/{image}")', f.read())
+
+        # text is precompressed, images aren't
+        with gzip.open(os.path.join(self.dist, stylesheet + '.gz')) as f:
+            self.assertIn(b'/assets/images/bg.', f.read())
+        self.assertFalse(os.path.exists(os.path.join(self.dist, image + '.gz')))
+
+    def test_build_is_deterministic(self):
+        """Test rebuilding unchanged files gives the same names and bytes"""
+
+        stylesheet = os.path.join(self.dist, self.built['stylesheets/style.css'] + '.gz')
+        with open(stylesheet, 'rb') as f:
+            before = f.read()
+
+        self.assertEqual(assets.build(self.source, self.dist), self.built)
+        with open(stylesheet, 'rb') as f:
+            self.assertEqual(f.read(), before)
+
+    def test_serve_compressed(self):
+        """Test assets are served precompressed, and cached for a year"""
+
+        path = f"/assets/{self.built['stylesheets/style.css']}"
+
+        resp = self.client.get(path, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('body', gzip.decompress(resp.data).decode())
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(f'max-age={assets.YEAR}', resp.headers['Cache-Control'])
+        self.assertNotIn('no-cache', resp.headers['Cache-Control'])
+
+        resp = self.client.get(path, headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'body', resp.data)
+
+    def test_serve_manifest(self):
+        """Test the manifest itself isn't served"""
+
+        self.assertEqual(self.client.get(f'/assets/{assets.MANIFEST}').status_code, 404)
+        self.assertEqual(self.client.get('/assets/missing.css').status_code, 404)
+
+    def test_asset_url(self):
+        """Test templates resolve static paths through the manifest"""
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/style.css'),
+                             f"/assets/{self.built['stylesheets/style.css']}")
+            self.assertEqual(assets.asset_url('not-built.js'), '/static/not-built.js')
+
+            self.assertEqual(assets.asset_filter('/static/images/bg.png'),
+                             f"/assets/{self.built['images/bg.png']}")
+            self.assertEqual(assets.asset_filter('https://example.com/me.png'),
+                             'https://example.com/me.png')
+            self.assertIsNone(assets.asset_filter(None))
@@ -0,0 +1,89 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+#    python -m unittest -v test_benchmark.py   # For results of both success and fail tests
+
+
+import os
+from random import Random
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from models import db, User, Follows
+import benchmark
+
+
+def results(p95_ms, queries, errors=0):
+    return {'routes': {'homepage': {'p95_ms': p95_ms,
+                                    'queries_per_request': queries,
+                                    'errors': errors}}}
+
+
+class BenchmarkTestCase(TestCase):
+    """Test comparing benchmark results."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(benchmark.percentile(values, 0.5), 51)
+        self.assertEqual(benchmark.percentile(values, 0.99), 100)
+        self.assertEqual(benchmark.percentile([3], 0.95), 3)
+
+    def test_no_regression(self):
+        self.assertEqual(
+            benchmark.compare(results(11, 3.2), results(10, 3), 0.2), [])
+
+    def test_slower(self):
+        regressions = benchmark.compare(results(13, 3), results(10, 3), 0.2)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("p95", regressions[0])
+
+    def test_more_queries(self):
+        regressions = benchmark.compare(results(10, 4), results(10, 3), 0.2)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("queries/request", regressions[0])
+
+    def test_errors(self):
+        self.assertEqual(len(benchmark.compare(results(10, 3, errors=2),
+                                               results(10, 3), 0.2)), 1)
+
+    def test_new_route(self):
+        self.assertEqual(
+            benchmark.compare(results(10, 3), {'routes': {}}, 0.2), [])
+
+
+class PlanTestCase(TestCase):
+    """Test planning requests."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for user_id in range(1, 4):
+            user = User.signup(f"user{user_id}", f"user{user_id}@test.com", "password", None)
+            user.id = user_id
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_plan_add_follow(self):
+        """Only follows not made yet are planned, as many as there are"""
+
+        with app.app_context():
+            planned = benchmark.plan_add_follow(Random(0), [1, 2], 10)
+            again = benchmark.plan_add_follow(Random(0), [1, 2], 2)
+
+        self.assertEqual([request.path for request in planned],
+                         ['/users/follow/3', '/users/follow/1', '/users/follow/3'])
+        self.assertEqual([request.user_id for request in planned], [1, 2, 2])
+        self.assertEqual(len(again), 2)
+
@@ -0,0 +1,247 @@
+"""Live timeline update tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import live
+import search
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BrokerTestCase(TestCase):
+    """Test the in-process pub/sub."""
+
+    def setUp(self):
+        self.broker = live.Broker()
+
+    def test_deliver_by_author(self):
+        """Subscribers get only their authors' messages"""
+
+        with self.broker.subscribe([1, 2]) as both, self.broker.subscribe([2]) as one:
+            self.broker.deliver(1, 10)
+            self.broker.deliver(2, 11)
+            self.broker.deliver(3, 12)
+
+            self.assertEqual(both.get(0), [10, 11])
+            self.assertEqual(one.get(0), [11])
+            self.assertEqual(one.get(0.01), [])
+            self.assertEqual(self.broker.subscriber_count(), 2)
+
+        self.assertEqual(self.broker.subscriber_count(), 0)
+        self.broker.deliver(2, 13)
+
+    def test_subscriber_count(self):
+        """Closing a subscription twice, or one with no authors, counts once"""
+
+        subscription = self.broker.subscribe([1])
+        nobody = self.broker.subscribe([])
+        self.assertEqual(self.broker.subscriber_count(), 2)
+
+        subscription.close()
+        subscription.close()
+        self.assertEqual(self.broker.subscriber_count(), 1)
+        nobody.close()
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+    def test_bounded_buffer(self):
+        """A reader that falls behind loses the oldest messages, and is told"""
+
+        with self.broker.subscribe([1], maxlen=2) as subscription:
+            self.broker.deliver(1, 10)
+            self.broker.deliver(1, 11)
+            self.assertFalse(subscription.overflowed)
+
+            self.broker.deliver(1, 12)
+            self.assertTrue(subscription.overflowed)
+            self.assertEqual(subscription.get(0), [11, 12])
+
+    def test_sse(self):
+        """Events are formatted line by line"""
+
+        self.assertEqual(live.sse('messages', "<li>\n</li>", id=5),
+                         "event: messages\nid: 5\ndata: <li>\ndata: </li>\n\n")
+        self.assertEqual(live.sse(comment='heartbeat'), ": heartbeat\n\n")
+
+
+class LiveViewsTestCase(TestCase):
+    """Test publishing messages and streaming them."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
+
+        for user_id, name in [(1, "author"), (2, "reader"), (3, "stranger")]:
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = user_id
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=1, user_following_id=2))
+        db.session.commit()
+
+        self.config = patch.dict(app.config, LIVE_HEARTBEAT_SECONDS=0.01)
+        self.config.start()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.config.stop()
+        live.settings['broker'] = 'memory'
+
+    def post(self, user_id, text):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        resp = client.post("/messages/new", data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+
+    def stream(self, user_id=2, **headers):
+        """Open `user_id`'s stream; returns the response and its events."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        resp = self.client.get("/timeline/stream", headers=headers, buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+
+        events = iter(resp.response)
+        self.assertTrue(next(events).startswith(b"retry: "))
+        return resp, events
+
+    def test_publish_on_commit(self):
+        """Messages are delivered once committed, and never if rolled back"""
+
+        with live.broker.subscribe([1]) as subscription:
+            with app.test_request_context():
+                live.publish(1, 10)
+                db.session.rollback()
+                live.publish(1, 11)
+                self.assertEqual(subscription.get(0), [])
+                db.session.commit()
+
+            self.assertEqual(subscription.get(0), [11])
+
+    def test_stream(self):
+        """Followers are sent new messages' cards, with heartbeats between"""
+
+        resp, events = self.stream()
+        try:
+            self.assertEqual(next(events), b": heartbeat\n\n")
+
+            self.post(1, "hot off the press")
+            self.post(3, "from a stranger")
+            event = next(events).decode()
+            message_id = Message.query.filter_by(text="hot off the press").one().id
+
+            self.assertIn("event: messages\n", event)
+            self.assertIn(f"id: {message_id}\n", event)
+            self.assertIn("hot off the press", event)
+            self.assertIn(f"/users/add_like/{message_id}", event)
+            self.assertEqual(next(events), b": heartbeat\n\n")
+        finally:
+            resp.close()
+
+        self.assertEqual(live.broker.subscriber_count(), 0)
+
+    def test_stream_catches_up(self):
+        """A reconnecting stream is sent what it missed since Last-Event-ID"""
+
+        db.session.add_all([Message(id=100, text="seen", user_id=1),
+                            Message(id=200, text="missed", user_id=1)])
+        db.session.commit()
+
+        resp, events = self.stream(**{'Last-Event-ID': '100'})
+        try:
+            event = next(events).decode()
+            self.assertIn("id: 200\n", event)
+            self.assertIn("missed", event)
+            self.assertNotIn("seen", event)
+        finally:
+            resp.close()
+
+    def test_stream_overflow(self):
+        """A stream that falls too far behind is told to reload"""
+
+        with patch.dict(live.settings, buffer_size=1):
+            resp, events = self.stream()
+        try:
+            self.post(1, "first")
+            self.post(1, "second")
+            event = next(events).decode()
+            self.assertIn("event: reset\n", event)
+            self.assertEqual(list(events), [])
+        finally:
+            resp.close()
+
+    def test_stream_ends(self):
+        """Streams end after LIVE_MAX_SECONDS, for the browser to reconnect"""
+
+        with patch.dict(app.config, LIVE_MAX_SECONDS=0):
+            resp, events = self.stream()
+            self.assertEqual(list(events), [])
+
+    def test_stream_head(self):
+        """A stream whose body is never read still unsubscribes when closed"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+        resp = self.client.head("/timeline/stream")
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+
+        self.assertEqual(live.broker.subscriber_count(), 0)
+
+    def test_stream_limit(self):
+        """Past LIVE_MAX_STREAMS, new streams are turned away"""
+
+        with patch.dict(app.config, LIVE_MAX_STREAMS=0):
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+            resp = self.client.get("/timeline/stream")
+
+        self.assertEqual(resp.status_code, 503)
+
+    def test_stream_signed_out(self):
+        """Only signed-in users have a stream"""
+
+        resp = self.client.get("/timeline/stream")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_home_page_streams(self):
+        """The first page of the home timeline listens for new messages"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn('data-live="/timeline/stream"', html)
+
+    def test_postgres_broker(self):
+        """With the postgres broker, messages go by NOTIFY through LISTEN"""
+
+        live.settings['broker'] = 'postgres'
+        with app.test_request_context():
+            subscription = live.broker.subscribe([1])
+        with subscription:
+            self.assertTrue(live.broker._listener.listening.wait(5))
+
+            self.post(1, "over the wire")
+            message_id = Message.query.filter_by(text="over the wire").one().id
+
+            message_ids = subscription.get(5)
+            self.assertEqual(message_ids, [message_id])
@@ -70,6 +70,21 @@ class MessageModelTestCase(TestCase):
         # test message.user relationship
         self.assertEqual(m.user, self.u)
 
+    def test_message_ids(self):
+        """Messages get increasing ids and their own timestamps"""
+
+        first = Message(text="first", user_id=self.uid)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="second", user_id=self.uid)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertGreater(first.id, 2 ** 31)
+
     def test_message_likes(self):
         """Test liking a message"""
 
@@ -7,6 +7,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User
@@ -14,6 +15,9 @@ from models import db, connect_db, Message, User
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+import current_user
+import fragments
+from querystats import query_budget
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
@@ -33,6 +37,8 @@ class MessageViewTestCase(TestCase):
         Message.query.delete()
 
         self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -197,4 +203,70 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
             message = Message.query.get(7777)
-            self.assertIsNotNone(message)
\ No newline at end of file
+            self.assertIsNotNone(message)
+
+    #=========================================================================================================
+    # Query Budget Tests
+    #=========================================================================================================
+
+    def test_message_show_queries(self):
+        """Test message details stay within their query budget"""
+
+        db.session.add(Message(id=9999, text="This is a message", user_id=self.uid))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with query_budget(self, 2):
+                resp = c.get('/messages/9999')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('db;dur=', resp.headers['Server-Timing'])
+            self.assertIn('desc="2 queries"', resp.headers['Server-Timing'])
+            self.assertIn('db-pool;dur=', resp.headers['Server-Timing'])
+
+    def test_message_show_not_modified(self):
+        """Test message details answer a matching If-None-Match with 304"""
+
+        db.session.add(Message(id=9999, text="This is a message", user_id=self.uid))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            etag = c.get('/messages/9999').headers['ETag']
+            resp = c.get('/messages/9999', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_message_show_last_modified(self):
+        """Test message details carry their timestamp as Last-Modified"""
+
+        db.session.add(Message(id=9999, text="This is a message", user_id=self.uid,
+                               timestamp=datetime(2020, 1, 2, 3, 4, 5)))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/messages/9999')
+
+            self.assertEqual(resp.headers['Last-Modified'], "Thu, 02 Jan 2020 03:04:05 GMT")
+
+            resp = c.get('/messages/9999',
+                         headers={'If-Modified-Since': resp.headers['Last-Modified']})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_add_message_queries(self):
+        """Test adding a message stays within its query budget"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with query_budget(self, 8):
+                resp = c.post("/messages/new", data={"text": "Hello"})
+
+            self.assertEqual(resp.status_code, 302)
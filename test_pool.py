@@ -0,0 +1,106 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pool.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, exc
+
+from models import db, pool_options, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+from querystats import TimedQueuePool, pool_metrics
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PoolTestCase(TestCase):
+    """Test pool configuration, timeouts and metrics."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+
+        user = User.signup("pooluser", "pool@test.com", "password", None)
+        user.id = 1
+        db.session.commit()
+
+        self.engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                                    poolclass=TimedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        db.session.rollback()
+        self.engine.dispose()
+        app.config['METRICS_TOKEN'] = None
+
+    def test_pool_options(self):
+        """The app's engine is built from the DB_POOL_* config"""
+
+        options = pool_options(app.config)
+
+        self.assertEqual(options['pool_size'], app.config['DB_POOL_SIZE'])
+        self.assertEqual(options['pool_timeout'], app.config['DB_POOL_TIMEOUT'])
+        self.assertNotIn('use_native_hstore', options)
+        self.assertIsInstance(db.engine.pool, TimedQueuePool)
+        self.assertEqual(db.engine.pool.size(), app.config['DB_POOL_SIZE'])
+
+        with patch.dict(app.config, DB_PGBOUNCER=True):
+            self.assertFalse(pool_options(app.config)['use_native_hstore'])
+
+    def test_checkout_totals(self):
+        """Checkouts, their waits and timeouts are counted"""
+
+        held = self.engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        held.close()
+        self.engine.connect().close()
+
+        pool = self.engine.pool
+        self.assertEqual(pool.checkouts, 3)
+        self.assertEqual(pool.checkout_timeouts, 1)
+        self.assertGreaterEqual(pool.checkout_wait, 0.05)
+
+        metrics = pool_metrics({'primary': self.engine})
+        self.assertIn('# TYPE warbler_db_pool_checkouts_total counter', metrics)
+        self.assertIn('warbler_db_pool_checkouts_total{bind="primary"} 3\n', metrics)
+        self.assertIn('warbler_db_pool_checkout_timeouts_total{bind="primary"} 1\n', metrics)
+        self.assertIn('warbler_db_pool_checked_out{bind="primary"} 0\n', metrics)
+
+    def test_metrics_endpoint(self):
+        """/metrics serves the app's pool metrics, to token holders if set"""
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('warbler_db_pool_size{bind="primary"}', resp.get_data(as_text=True))
+
+        app.config['METRICS_TOKEN'] = "scraper"
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        resp = self.client.get("/metrics", headers={'Authorization': "Bearer scraper"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_pool_timeout_503(self):
+        """A request that can't get a connection in time is turned away"""
+
+        timeout = exc.TimeoutError("QueuePool limit reached")
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            with patch.object(TimedQueuePool, '_do_get', side_effect=timeout):
+                resp = c.get("/")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
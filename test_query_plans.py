@@ -0,0 +1,237 @@
+"""Query plan tests."""
+
+# Runs EXPLAIN on every statement Warbler's hot routes issue, against a
+# seeded database, with sequential scans and sorts switched off in the
+# planner. PostgreSQL still uses them when nothing else can answer a query,
+# so one turning up in a plan means no index serves that query. So does
+# reading a whole index to find rows (an index scan with no condition, or
+# one on some column other than the index's first), rather than to return
+# the first few in order under a LIMIT.
+#
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_plans.py
+
+
+import os
+import re
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, Likes, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import migrations
+import search
+import timeline
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# the kinds of statements worth explaining
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+@contextmanager
+def captured_statements():
+    """Collect the (statement, parameters) the app runs in the block."""
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(EXPLAINABLE) and not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+# each index's first column (NULL for an expression)
+LEADING_COLUMNS = """
+    SELECT index.relname, attribute.attname
+    FROM pg_index
+    JOIN pg_class index ON index.oid = pg_index.indexrelid
+    LEFT JOIN pg_attribute attribute ON attribute.attrelid = pg_index.indrelid
+                                     AND attribute.attnum = pg_index.indkey[0]
+"""
+
+
+def plan_problems(statement, parameters, sorts_ok=False):
+    """Sequential scans, full index scans and (unless `sorts_ok`) sorts in
+    the plan of `statement`."""
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(LEADING_COLUMNS)
+        leading = dict(cursor.fetchall())
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        if not sorts_ok:
+            cursor.execute("SET LOCAL enable_sort = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0][0]['Plan']
+    finally:
+        connection.rollback()
+        connection.close()
+
+    problems = []
+    nodes = [(plan, False)]
+    while nodes:
+        node, limited = nodes.pop()
+        kind = node['Node Type']
+        limited = limited or kind == 'Limit'
+        nodes.extend((child, limited) for child in node.get('Plans', []))
+
+        relation = node.get('Relation Name', '')
+        if kind == 'Seq Scan' and not relation.startswith('pg_'):
+            problems.append(f"Seq Scan on {relation}")
+        elif kind in INDEX_SCANS and not limited:
+            index = node['Index Name']
+            condition = node.get('Index Cond', '')
+            column = leading.get(index)
+            # the index's own columns are unqualified in its condition
+            if not condition or column and not re.search(
+                    rf"(?<![\w.]){column}\b", condition):
+                problems.append(f"Full {kind} of {index}")
+        elif kind in ('Sort', 'Incremental Sort') and not sorts_ok:
+            problems.append(f"{kind} by {', '.join(node['Sort Key'])}")
+
+    return problems
+
+
+class QueryPlanTestCase(TestCase):
+    """Test the hot routes' queries are all answered from indexes."""
+
+    def setUp(self):
+        """Seed users who post, follow and like."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
+
+        # (user ids come from the sequence, 1 up, so new rows don't collide)
+        db.session.add_all([User(username=f"user{i}", email=f"user{i}@test.com",
+                                 password="hash")
+                            for i in range(1, 21)])
+        db.session.commit()
+
+        db.session.add_all([Follows(user_following_id=follower, user_being_followed_id=followed)
+                            for follower in range(1, 21)
+                            for followed in range(1, 21)
+                            if follower != followed and (follower + followed) % 3 == 0])
+        db.session.add_all([Message(id=i, text=f"message {i}", user_id=i % 20 + 1)
+                            for i in range(1, 201)])
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=user_id, message_id=message_id)
+                            for user_id in range(1, 21)
+                            for message_id in range(user_id, 201, 7)
+                            if message_id % 20 + 1 != user_id])
+        db.session.commit()
+
+        with app.app_context():
+            timeline.rebuild_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assertIndexed(self, method, path, data=None, sorts_ok=False):
+        """Every statement `method path` runs as user 1 has a plan free of
+        sequential scans, and of sorts unless `sorts_ok`."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            with captured_statements() as statements:
+                resp = c.open(path, method=method, data=data)
+
+        self.assertLess(resp.status_code, 400)
+        self.assertTrue(statements)
+
+        for statement, parameters in statements:
+            problems = plan_problems(statement, parameters, sorts_ok)
+            self.assertEqual(problems, [], f"{method} {path} ran:\n{statement}")
+
+    def test_homepage(self):
+        """Test the home timeline"""
+
+        # merging the ring (at most TIMELINE_SIZE messages) with pulled
+        # authors' newest page needs a sort, but never a table scan
+        self.assertIndexed('GET', '/', sorts_ok=True)
+
+    def test_users_show(self):
+        """Test a user's profile and messages"""
+
+        self.assertIndexed('GET', '/users/2')
+
+    def test_show_likes(self):
+        """Test the messages a user liked"""
+
+        self.assertIndexed('GET', '/users/2/likes')
+
+    def test_show_following(self):
+        """Test who a user follows"""
+
+        self.assertIndexed('GET', '/users/2/following')
+
+    def test_users_followers(self):
+        """Test a user's followers"""
+
+        self.assertIndexed('GET', '/users/2/followers')
+
+    def test_messages_show(self):
+        """Test a single message"""
+
+        self.assertIndexed('GET', '/messages/2')
+
+    def test_list_users(self):
+        """Test the user directory"""
+
+        self.assertIndexed('GET', '/users')
+
+    def test_likes(self):
+        """Test liking and unliking"""
+
+        self.assertIndexed('POST', '/users/add_like/3')
+        self.assertIndexed('POST', '/users/remove_like/3')
+
+    def test_follows(self):
+        """Test following and unfollowing"""
+
+        self.assertIndexed('POST', '/users/follow/4')
+        self.assertIndexed('POST', '/users/stop-following/4')
+
+    def test_messages_add(self):
+        """Test posting a message"""
+
+        self.assertIndexed('POST', '/messages/new', data={'text': "Hello"})
+
+    def test_messages_destroy(self):
+        """Test deleting a message"""
+
+        self.assertIndexed('POST', '/messages/20/delete')
+
+    def test_upgrades_create_declared_indexes(self):
+        """Test every index declared on the models has an upgrade statement"""
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                self.assertTrue(
+                    any(f"INDEX IF NOT EXISTS {index.name} " in statement
+                        for statement in migrations.UPGRADES),
+                    index.name)
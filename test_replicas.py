@@ -0,0 +1,127 @@
+"""Read replica routing tests."""
+
+# These need a second database to stand in for the replica:
+#
+#    createdb warbler-test-replica
+#
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import replicas
+import search
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+
+class ReplicaTestCase(TestCase):
+    """Test GET requests read from the replica, and writers stick to the primary."""
+
+    def setUp(self):
+        """Copy a user and message to the replica, then change the copy."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
+
+        user = User.signup("reader", "reader@test.com", "password", None)
+        user.id = 1
+        db.session.add(Message(id=10, text="on the primary", user_id=1))
+        db.session.commit()
+
+        app.config['SQLALCHEMY_BINDS'] = {replicas.REPLICA: REPLICA_URL}
+        self.replica = db.get_engine(app, bind=replicas.REPLICA)
+
+        # "replicate" by copying every row, then make the copy tell-tale
+        db.metadata.drop_all(bind=self.replica)
+        db.metadata.create_all(bind=self.replica)
+        with self.replica.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                rows = [dict(row) for row in db.session.execute(table.select())]
+                if rows:
+                    connection.execute(table.insert(), rows)
+            connection.execute(text(
+                "UPDATE messages SET text = 'on the replica' WHERE id = 10"))
+
+    def tearDown(self):
+        db.session.rollback()
+        del app.config['SQLALCHEMY_BINDS']
+
+    def get_message(self, client):
+        resp = client.get("/messages/10")
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_data(as_text=True)
+
+    def test_reads_from_replica(self):
+        """GET requests read from the replica"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/messages/10")
+            self.assertIn("on the replica", resp.get_data(as_text=True))
+            self.assertNotIn(replicas.PRIMARY_COOKIE, resp.headers.get('Set-Cookie', ''))
+
+    def test_read_your_writes(self):
+        """After writing, a browser reads from the primary for a while"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post("/messages/new", data={"text": "a new message"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn(f"{replicas.PRIMARY_COOKIE}=1", resp.headers['Set-Cookie'])
+            self.assertIn("Max-Age=10", resp.headers['Set-Cookie'])
+
+            self.assertIn("on the primary", self.get_message(c))
+
+        # the new message was written to the primary only
+        self.assertEqual(Message.query.count(), 2)
+        with self.replica.connect() as connection:
+            self.assertEqual(connection.scalar(text("SELECT count(*) FROM messages")), 1)
+
+        # a browser that hasn't written still reads from the replica (past
+        # the card cached from the primary)
+        fragments.cache.clear()
+        with app.test_client() as c:
+            self.assertIn("on the replica", self.get_message(c))
+
+    def test_no_replica(self):
+        """Without a replica bind, everything reads from the primary"""
+
+        del app.config['SQLALCHEMY_BINDS']
+        try:
+            with self.client as c:
+                self.assertIn("on the primary", self.get_message(c))
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = {replicas.REPLICA: REPLICA_URL}
+
+    def test_is_read(self):
+        """Only SELECTs (without FOR UPDATE) count as reads"""
+
+        self.assertTrue(replicas.is_read(Message.query.statement))
+        self.assertTrue(replicas.is_read(text("select 1")))
+        self.assertFalse(replicas.is_read(Message.query.with_for_update().statement))
+        self.assertFalse(replicas.is_read(Message.__table__.delete()))
+        self.assertFalse(replicas.is_read(None))
@@ -0,0 +1,194 @@
+"""User search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+#    python -m unittest -v test_search.py   # For results of both success and fail tests
+
+
+import os
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import search
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MemoryIndexTestCase(TestCase):
+    """Test the in-process search index."""
+
+    def setUp(self):
+        self.index = search.MemoryIndex()
+        self.index.add(1, "catlover", "I like dogs", None)
+        self.index.add(2, "cat", None, "Catalonia")
+        self.index.add(3, "dogperson", "no cats", "Boston")
+        self.index.add(4, "ca", None, None)
+
+    def test_ranking(self):
+        """Exact username first, then prefix, then other fields"""
+
+        self.assertEqual(self.index.search("cat", 0, 10), [2, 1, 3])
+
+    def test_bio_and_location(self):
+        """Matches bios and locations, not just usernames"""
+
+        self.assertEqual(self.index.search("dogs", 0, 10), [1])
+        self.assertEqual(self.index.search("boston", 0, 10), [3])
+
+    def test_substring_only(self):
+        """Sharing trigrams isn't enough; the query must appear as typed"""
+
+        self.assertEqual(self.index.search("catdog", 0, 10), [])
+
+    def test_prefix(self):
+        """Short queries match username prefixes, shortest first"""
+
+        self.assertEqual(self.index.search("ca", 0, 10), [4, 2, 1])
+        self.assertEqual(self.index.search("d", 0, 10), [3])
+
+    def test_paging(self):
+        self.assertEqual(self.index.search("cat", 1, 1), [1])
+
+    def test_update_and_remove(self):
+        self.index.add(2, "kitty", None, None)
+        self.assertEqual(self.index.search("cat", 0, 10), [1, 3])
+        self.assertEqual(self.index.search("ki", 0, 10), [2])
+
+        self.index.remove(1)
+        self.assertEqual(self.index.search("cat", 0, 10), [3])
+        self.assertEqual(self.index.search("ca", 0, 10), [4])
+
+    def test_build(self):
+        """Building from rows indexes the same as adding one at a time"""
+
+        built = search.MemoryIndex.build([(1, "catlover", "I like dogs", None),
+                                          (2, "cat", None, "Catalonia"),
+                                          (3, "dogperson", "no cats", "Boston"),
+                                          (4, "ca", None, None)])
+
+        self.assertEqual(built.usernames, self.index.usernames)
+        self.assertEqual(built.search("cat", 0, 10), [2, 1, 3])
+        self.assertEqual(built.search("ca", 0, 10), [4, 2, 1])
+
+
+class SearchViewTestCase(TestCase):
+    """Test /users search through the app."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
+
+        self.cat = User.signup("cat", "cat@test.com", "password", None)
+        self.cat.id = 100
+        self.catlover = User.signup("catlover", "catlover@test.com", "password", None)
+        self.catlover.id = 101
+        self.dogperson = User.signup("dogperson", "dog@test.com", "password", None)
+        self.dogperson.id = 102
+        self.dogperson.bio = "no cats please"
+        db.session.commit()
+
+        self.old_per_page = app.config['USERS_PER_PAGE']
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+        app.config['USERS_PER_PAGE'] = self.old_per_page
+
+    def usernames(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        return [name for name in ("@catlover", "@cat<", "@dogperson")
+                if name in html], html
+
+    def test_ranked_search(self):
+        """Searches usernames and bios, best matches first"""
+
+        html = self.client.get("/users?q=CAT").get_data(as_text=True)
+
+        self.assertLess(html.index("@cat<"), html.index("@catlover"))
+        self.assertLess(html.index("@catlover"), html.index("@dogperson"))
+
+    def test_search_pages(self):
+        """Search results are paged"""
+
+        app.config['USERS_PER_PAGE'] = 2
+
+        names, html = self.usernames("/users?q=cat")
+        self.assertEqual(names, ["@catlover", "@cat<"])
+        self.assertIn("/users?q=cat&amp;page=2", html)
+
+        names, html = self.usernames("/users?q=cat&page=2")
+        self.assertEqual(names, ["@dogperson"])
+        self.assertIn("/users?q=cat&amp;page=1", html)
+
+    def test_list_pages(self):
+        """Listing every user is paged too"""
+
+        app.config['USERS_PER_PAGE'] = 2
+
+        names, html = self.usernames("/users")
+        self.assertEqual(names, ["@catlover", "@cat<"])
+        self.assertIn("/users?page=2", html)
+
+        names, html = self.usernames("/users?page=2")
+        self.assertEqual(names, ["@dogperson"])
+
+    def test_profile_edit_reindexes(self):
+        """Editing a profile updates the in-process index"""
+
+        self.client.get("/users?q=cat")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 102
+
+            c.post("/users/profile", data={"username": "dogperson",
+                                           "email": "dog@test.com",
+                                           "bio": "just dogs",
+                                           "password": "password"})
+
+        names, html = self.usernames("/users?q=cat")
+        self.assertEqual(names, ["@catlover", "@cat<"])
+
+    def test_stale_index_rebuilds_in_background(self):
+        """A stale index keeps serving while its replacement is built"""
+
+        with app.app_context():
+            old = search.memory_index()
+
+            with patch.dict(search.settings, index_ttl=0):
+                new_user = User.signup("catnip", "catnip@test.com", "password", None)
+                db.session.commit()
+                search.index_user(new_user)
+
+                self.assertIs(search.memory_index(), old)
+
+            for attempt in range(100):
+                if search.memory_index() is not old:
+                    break
+                sleep(0.05)
+
+            new = search.memory_index()
+            self.assertIsNot(new, old)
+            self.assertIsNone(search._pending_changes)
+            self.assertEqual(new.search("catn", 0, 10), [new_user.id])
+
@@ -0,0 +1,159 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+#    python -m unittest -v test_seed.py   # For results of both success and fail tests
+
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import seed
+import snowflake
+
+USERS = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,/a.jpg,hash,"Likes ""quotes""
+and newlines",/h.jpg,Here
+b@test.com,bob,/b.jpg,hash,,/h.jpg,There
+"""
+
+MESSAGES = """text,timestamp,user_id
+hello,2020-01-01 00:00:00,1
+again,2020-01-02 00:00:00,1
+"""
+
+FOLLOWS = """user_being_followed_id,user_following_id
+1,2
+"""
+
+
+class SeedTestCase(TestCase):
+    """Test loading CSVs with COPY."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.dir = TemporaryDirectory()
+        for name, content in [('users.csv', USERS), ('messages.csv', MESSAGES),
+                              ('follows.000.csv', FOLLOWS)]:
+            with open(os.path.join(self.dir.name, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        db.session.rollback()
+        self.dir.cleanup()
+
+    def load(self, **kwargs):
+        with app.app_context():
+            return seed.load(self.dir.name, chunk_size=1,
+                             report=lambda line: None, **kwargs)
+
+    def test_load(self):
+        """Loads every table, then counts and timelines"""
+
+        stats = self.load()
+
+        self.assertEqual(stats['users'][:2], (2, 2))
+        self.assertEqual(stats['follows'][:2], (1, 1))
+
+        alice = User.query.get(1)
+        self.assertEqual(alice.bio, 'Likes "quotes"\nand newlines')
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 2)
+
+    def test_replace(self):
+        """Loading again replaces the rows and restarts the ids"""
+
+        self.load()
+        self.load()
+
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(sorted(u.id for u in User.query), [1, 2])
+
+    def test_message_ids(self):
+        """Messages without ids get time-ordered ones from their timestamps"""
+
+        self.load()
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([m.text for m in messages], ['hello', 'again'])
+        self.assertEqual([snowflake.timestamp(m.id) for m in messages],
+                         [m.timestamp for m in messages])
+
+    def test_message_ids_same_millisecond(self):
+        """Messages at the same moment get distinct ids, across chunks"""
+
+        with open(os.path.join(self.dir.name, 'messages.csv'), 'w') as f:
+            f.write("text,timestamp,user_id\n"
+                    + "".join(f"burst {i},2020-01-01 00:00:00,1\n" for i in range(5)))
+
+        stats = self.load()
+
+        self.assertEqual(stats['messages'][:2], (5, 5))
+        ids = sorted(m.id for m in Message.query)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual([id & snowflake.SEQUENCE_MASK for id in ids], list(range(5)))
+        self.assertEqual(len({id >> snowflake.SEQUENCE_BITS for id in ids}), 1)
+
+    def test_message_ids_overflow(self):
+        """A load fails rather than reuse ids when a millisecond runs out"""
+
+        with open(os.path.join(self.dir.name, 'messages.csv'), 'w') as f:
+            f.write("text,timestamp,user_id\n"
+                    + "".join(f"burst {i},2020-01-01 00:00:00,1\n" for i in range(3)))
+
+        with patch.object(snowflake, 'SEQUENCE_BITS', 1):
+            with self.assertRaises(ValueError):
+                self.load()
+        db.session.rollback()
+
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_upsert(self):
+        """Upserting skips rows that are already there"""
+
+        self.load()
+        stats = self.load(upsert=True)
+
+        self.assertEqual(stats['users'][:2], (2, 0))
+        self.assertEqual(stats['follows'][:2], (1, 0))
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Follows.query.count(), 1)
+
+    def test_sequences(self):
+        """New rows get ids after the loaded ones"""
+
+        self.load()
+
+        user = User.signup("carol", "c@test.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(user.id, 3)
+
+    def test_failed_load(self):
+        """A failed load leaves the tables and constraints as they were"""
+
+        self.load()
+
+        with open(os.path.join(self.dir.name, 'follows.001.csv'), 'w') as f:
+            f.write("user_being_followed_id,user_following_id\n1,99\n")
+
+        with self.assertRaises(Exception):
+            self.load()
+        db.session.rollback()
+
+        self.assertEqual(Follows.query.count(), 1)
+        with self.assertRaises(Exception):
+            db.session.add(Follows(user_being_followed_id=1, user_following_id=99))
+            db.session.commit()
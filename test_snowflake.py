@@ -0,0 +1,76 @@
+"""Time-ordered id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import snowflake
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test making snowflake ids."""
+
+    def setUp(self):
+        self.leases = []
+
+        def lease_worker(worker):
+            self.leases.append(worker)
+            return worker
+
+        self.generator = snowflake.IdGenerator(lease_worker)
+        self.now = 1600000000.0
+
+    def next_id(self, worker=5):
+        with patch('snowflake.time', lambda: self.now):
+            return self.generator.next_id(worker)
+
+    def test_fields(self):
+        """Ids hold the time, the worker and a sequence number"""
+
+        first, second = self.next_id(), self.next_id()
+
+        self.assertEqual(first, snowflake.make_id(1600000000000, 5, 0))
+        self.assertEqual(second, first + 1)
+        self.assertEqual(snowflake.timestamp(first), datetime(2020, 9, 13, 12, 26, 40))
+        self.assertLess(first, 1 << 63)
+
+    def test_time_ordered(self):
+        """Later ids are larger, whatever the worker"""
+
+        first = self.next_id()
+        self.now += 0.001
+        self.generator._pid = None
+        self.assertGreater(self.next_id(worker=0), first)
+
+    def test_lease_once_per_process(self):
+        """A worker id is leased once, and again after a fork"""
+
+        self.next_id(worker=3)
+        self.next_id(worker=4)
+        self.assertEqual(self.leases, [3])
+
+        self.generator._pid = -1
+        self.assertEqual(self.next_id(worker=1029) >> snowflake.SEQUENCE_BITS
+                         & (snowflake.WORKERS - 1), 5)
+        self.assertEqual(self.leases, [3, 1029])
+
+    def test_sequence_overflow(self):
+        """Running out of sequence numbers borrows the next millisecond"""
+
+        ids = [self.next_id() for i in range(snowflake.SEQUENCE_MASK + 2)]
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(ids[-1], snowflake.make_id(1600000000001, 5, 0))
+
+    def test_clock_steps_back(self):
+        """Ids keep increasing when the clock goes backwards"""
+
+        first = self.next_id()
+        self.now -= 5
+        self.assertEqual(self.next_id(), first + 1)
@@ -0,0 +1,307 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+#    python -m unittest -v test_timeline.py   # For results of both success and fail tests
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import current_user
+import follows
+import fragments
+import snowflake
+import timeline
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test materialized home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 100
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.reader.id = 101
+        self.other = User.signup("other", "other@test.com", "password", None)
+        self.other.id = 102
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=100, user_following_id=101))
+        db.session.commit()
+
+        self.old_size = app.config['TIMELINE_SIZE']
+        self.old_limit = app.config['TIMELINE_FANOUT_LIMIT']
+        self.old_trim_every = app.config['TIMELINE_TRIM_EVERY']
+
+        # trim every recipient of every post, unless a test says otherwise
+        app.config['TIMELINE_TRIM_EVERY'] = 1
+
+    def tearDown(self):
+        """Rollback problems from failed tests"""
+
+        db.session.rollback()
+        app.config['TIMELINE_SIZE'] = self.old_size
+        app.config['TIMELINE_FANOUT_LIMIT'] = self.old_limit
+        app.config['TIMELINE_TRIM_EVERY'] = self.old_trim_every
+
+    def post(self, user_id, text):
+        """Post a message through the messages_add route as `user_id`."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one()
+
+    def ring(self, user_id):
+        """Message ids in `user_id`'s materialized timeline."""
+
+        return {e.message_id for e in TimelineEntry.query.filter_by(user_id=user_id)}
+
+    def test_post_fans_out(self):
+        """Posting adds the message to the author's and followers' timelines"""
+
+        msg = self.post(100, "fan me out")
+
+        self.assertEqual(self.ring(100), {msg.id})
+        self.assertEqual(self.ring(101), {msg.id})
+        self.assertEqual(self.ring(102), set())
+
+    def test_pulled_author(self):
+        """High-follower accounts are merged in at read time"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        msg_id = self.post(100, "too popular").id
+
+        self.assertEqual(self.ring(101), set())
+        with app.app_context():
+            ids = [m.id for m in timeline.timeline_query(101)]
+        self.assertEqual(ids, [msg_id])
+
+    def test_author_drops_below_limit(self):
+        """An author's pulled messages stay on timelines once they're pushed again"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        db.session.add(Follows(user_being_followed_id=100, user_following_id=102))
+        db.session.commit()
+
+        pulled = [self.post(100, f"pulled {i}").id for i in range(2)]
+        self.assertEqual(self.ring(101), set())
+
+        with app.app_context():
+            follows.unfollow(102, [100])
+            db.session.commit()
+
+            self.assertEqual(self.ring(101), set(pulled))
+            self.assertEqual([m.id for m in timeline.timeline_query(101)], pulled[::-1])
+
+        pushed = self.post(100, "pushed").id
+        self.assertEqual(self.ring(101), set(pulled) | {pushed})
+
+    def test_author_drops_below_limit_on_delete(self):
+        """So do they when a follower deletes their account"""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        db.session.add(Follows(user_being_followed_id=100, user_following_id=102))
+        db.session.commit()
+
+        pulled = self.post(100, "pulled").id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 102
+            c.post("/users/delete")
+
+        self.assertEqual(self.ring(101), {pulled})
+
+    def test_trim(self):
+        """Timelines keep only the newest TIMELINE_SIZE entries"""
+
+        app.config['TIMELINE_SIZE'] = 2
+        msgs = [self.post(100, f"message {i}") for i in range(3)]
+
+        self.assertEqual(self.ring(101), {msgs[1].id, msgs[2].id})
+
+    def test_lazy_trim(self):
+        """Each post trims only its slice of the followers' timelines"""
+
+        app.config['TIMELINE_SIZE'] = 1
+        app.config['TIMELINE_TRIM_EVERY'] = 2
+
+        def fan_out(ms):
+            msg = Message(id=snowflake.make_id(ms, 0, 0), text=f"at {ms}", user_id=100)
+            db.session.add(msg)
+            db.session.flush()
+            timeline.fan_out(msg)
+            db.session.commit()
+            return msg.id
+
+        with app.app_context():
+            # the reader (101) is in the odd slice; the author is always trimmed
+            ids = [fan_out(ms) for ms in (1600000000000, 1600000000002)]
+            self.assertEqual(self.ring(101), set(ids))
+            self.assertEqual(self.ring(100), {ids[-1]})
+
+            newest = fan_out(1600000000003)
+            self.assertEqual(self.ring(101), {newest})
+
+    def test_unfollow_and_delete(self):
+        """Unfollowing and deleting messages remove timeline entries"""
+
+        msg = self.post(100, "short lived")
+        mine = self.post(101, "reader's own")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 101
+            c.post("/users/stop-following/100")
+
+        self.assertEqual(self.ring(101), {mine.id})
+        self.assertEqual(self.ring(100), {msg.id})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+            c.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(self.ring(100), set())
+
+    def test_follow_backfills(self):
+        """Following an account backfills its recent messages"""
+
+        msg = self.post(100, "before the follow")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 102
+            c.post("/users/follow/100")
+
+        self.assertEqual(self.ring(102), {msg.id})
+
+    def test_bulk_follow_backfills(self):
+        """Following accounts in bulk backfills their newest messages together"""
+
+        app.config['TIMELINE_SIZE'] = 2
+        self.post(100, "oldest")
+        newer = self.post(102, "newer").id
+        newest = self.post(100, "newest").id
+
+        with app.app_context():
+            follows.unfollow(101, [100])
+            self.assertEqual(self.ring(101), set())
+
+            self.assertEqual(sorted(follows.follow(101, [100, 102])), [100, 102])
+            db.session.commit()
+
+        self.assertEqual(self.ring(101), {newer, newest})
+
+    def test_rebuild(self):
+        """Rebuilding recreates timelines from messages and follows"""
+
+        m1 = Message(text="seeded", user_id=100)
+        m2 = Message(text="also seeded", user_id=102)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        m1_id, m2_id = m1.id, m2.id
+
+        with app.app_context():
+            self.assertEqual(timeline.rebuild_all(), 3)
+
+        self.assertEqual(self.ring(100), {m1_id})
+        self.assertEqual(self.ring(101), {m1_id})
+        self.assertEqual(self.ring(102), {m2_id})
+
+    def test_page_past_ring(self):
+        """Paging past the end of a full ring falls back to the follow graph"""
+
+        app.config['TIMELINE_SIZE'] = 3
+        ids = [self.post(100, f"message {i}").id for i in range(5)]
+
+        with app.app_context():
+            first = timeline.timeline_page(101, per_page=2)
+            self.assertEqual([m.id for m in first], [ids[4], ids[3]])
+
+            second = timeline.timeline_page(101, before=first.older, per_page=2)
+            self.assertEqual([m.id for m in second], [ids[2], ids[1]])
+
+            third = timeline.timeline_page(101, before=second.older, per_page=2)
+            self.assertEqual([m.id for m in third], [ids[0]])
+            self.assertIsNone(third.older)
+
+            newer = timeline.timeline_page(101, after=third.newer, per_page=2)
+            self.assertEqual([m.id for m in newer], [ids[2], ids[1]])
+
+    def walk(self, user_id):
+        """Ids on every page of `user_id`'s timeline, paging back 2 at a time."""
+
+        ids = []
+        with app.app_context():
+            page = timeline.timeline_page(user_id, per_page=2)
+            ids += [m.id for m in page]
+            while page.older:
+                page = timeline.timeline_page(user_id, before=page.older, per_page=2)
+                ids += [m.id for m in page]
+        return ids
+
+    def test_page_past_ring_with_pulled_author(self):
+        """Paging past a full ring doesn't skip to only pulled authors' messages"""
+
+        app.config['TIMELINE_SIZE'] = 3
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        # other (102) is followed by both others, so is pulled
+        db.session.add_all([Follows(user_being_followed_id=102, user_following_id=101),
+                            Follows(user_being_followed_id=102, user_following_id=100)])
+        db.session.commit()
+
+        ids = [self.post(102, f"old pulled {i}").id for i in range(4)]
+        for i in range(5):
+            ids.append(self.post(100, f"pushed {i}").id)
+            ids.append(self.post(102, f"pulled {i}").id)
+
+        self.assertEqual(len(self.ring(101)), 3)
+        self.assertEqual(self.walk(101), ids[::-1])
+
+    def test_page_past_shrunk_ring(self):
+        """Unfollowing and deleting don't hide history below a trimmed ring"""
+
+        app.config['TIMELINE_SIZE'] = 3
+        ids = [self.post(100, f"message {i}").id for i in range(5)]
+
+        db.session.add(Follows(user_being_followed_id=102, user_following_id=101))
+        db.session.commit()
+        self.post(102, "from other")
+
+        with app.app_context():
+            follows.unfollow(101, [102])
+            db.session.commit()
+        self.assertEqual(len(self.ring(101)), 2)
+        self.assertEqual(self.walk(101), ids[::-1])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+            c.post(f"/messages/{ids[4]}/delete")
+        self.assertEqual(self.ring(101), {ids[3]})
+        self.assertEqual(self.walk(101), ids[3::-1])
+
@@ -7,14 +7,21 @@
 
 
 import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
 from unittest import TestCase
+from unittest.mock import patch
+from threading import BoundedSemaphore
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app
+from follows import FollowState
+import counters
+import passwords
 
 DEFAULT_IMAGE_URL ="/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL ="/static/images/warbler-hero.jpg"
@@ -119,6 +126,27 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u2.is_followed_by(self.u1), True)   
         self.assertFalse(self.u1.is_followed_by(self.u2), True)
     
+    def test_follow_state(self):
+        """Test batched follow state lookup"""
+
+        u3 = User.signup("testuser3", "test3@test.com", "password3", None)
+        u3.id = 3
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=self.uid2, user_following_id=self.uid1),
+            Follows(user_being_followed_id=self.uid1, user_following_id=3),
+        ])
+        db.session.commit()
+
+        state = FollowState(self.uid1).load([self.uid2, 3])
+        self.assertEqual(state.following, {self.uid2})
+        self.assertEqual(state.followers, {3})
+        self.assertTrue(state.is_following(self.uid2))
+        self.assertFalse(state.is_following(3))
+        self.assertTrue(state.is_followed_by(3))
+        self.assertFalse(state.is_followed_by(self.uid2))
+
     #=========================================================================================================
     # Create User Tests    
     #=========================================================================================================
@@ -192,4 +220,189 @@ class UserModelTestCase(TestCase):
     def test_invalid_password(self):
         """Test invalid password"""
 
-        self.assertFalse(User.authenticate(self.u1.username, "wrongpassword"))
\ No newline at end of file
+        self.assertFalse(User.authenticate(self.u1.username, "wrongpassword"))
+    #=========================================================================================================
+    # Counter Tests
+    #=========================================================================================================
+
+    def test_counts(self):
+        """Test counts follow adding and removing rows"""
+
+        follow = Follows(user_being_followed_id=self.uid2, user_following_id=self.uid1)
+        message = Message(text="counted message", user_id=self.uid2)
+        db.session.add_all([follow, message])
+        db.session.commit()
+
+        like = Likes(user_id=self.uid1, message_id=message.id)
+        db.session.add(like)
+        db.session.commit()
+
+        u1 = User.query.get(self.uid1)
+        u2 = User.query.get(self.uid2)
+        self.assertEqual((u1.following_count, u1.followers_count, u1.likes_count), (1, 0, 1))
+        self.assertEqual((u2.followers_count, u2.messages_count), (1, 1))
+
+        db.session.delete(message)
+        db.session.delete(follow)
+        db.session.commit()
+
+        u1 = User.query.get(self.uid1)
+        u2 = User.query.get(self.uid2)
+        self.assertEqual((u1.following_count, u1.likes_count), (0, 0))
+        self.assertEqual((u2.followers_count, u2.messages_count), (0, 0))
+
+    def test_delete_user_counts(self):
+        """Test deleting a user releases the counts of users they touched"""
+
+        message = Message(text="doomed message", user_id=self.uid1)
+        db.session.add_all([
+            Follows(user_being_followed_id=self.uid2, user_following_id=self.uid1),
+            Follows(user_being_followed_id=self.uid1, user_following_id=self.uid2),
+            message,
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.uid2, message_id=message.id))
+        db.session.commit()
+
+        db.session.delete(User.query.get(self.uid1))
+        db.session.commit()
+
+        u2 = User.query.get(self.uid2)
+        self.assertEqual((u2.following_count, u2.followers_count, u2.likes_count), (0, 0, 0))
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_message_like_counts(self):
+        """Test messages count their likes, including from deleted users"""
+
+        message = Message(text="liked message", user_id=self.uid1)
+        db.session.add(message)
+        db.session.commit()
+
+        self.assertTrue(Likes.add(self.uid1, message.id))
+        self.assertFalse(Likes.add(self.uid1, message.id))
+        db.session.add(Likes(user_id=self.uid2, message_id=message.id))
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(message.id).like_count, 2)
+        self.assertEqual(User.query.get(self.uid1).likes_count, 1)
+
+        self.assertTrue(Likes.remove(self.uid1, message.id))
+        self.assertFalse(Likes.remove(self.uid1, message.id))
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(message.id).like_count, 1)
+        self.assertEqual(User.query.get(self.uid1).likes_count, 0)
+
+        db.session.delete(User.query.get(self.uid2))
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(message.id).like_count, 0)
+
+    def test_reconcile_counts(self):
+        """Test reconciling counts that drifted"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2, user_following_id=self.uid1))
+        db.session.commit()
+
+        User.query.filter_by(id=self.uid1).update({'following_count': 5, 'likes_count': 2})
+        db.session.commit()
+
+        drift = counters.reconcile()
+        self.assertEqual(drift, [{'id': self.uid1, 'following_count': (5, 1), 'likes_count': (2, 0)}])
+
+        u1 = User.query.get(self.uid1)
+        self.assertEqual((u1.following_count, u1.likes_count), (1, 0))
+        self.assertEqual(counters.reconcile(), [])
+
+    def test_reconcile_like_counts(self):
+        """Test reconciling messages' like counts"""
+
+        message = Message(id=5000, text="miscounted", user_id=self.uid1, like_count=3)
+        db.session.add(message)
+        db.session.commit()
+
+        drift = counters.reconcile_all()
+        self.assertEqual(drift[Message], [{'id': 5000, 'like_count': (3, 0)}])
+        self.assertEqual(Message.query.get(5000).like_count, 0)
+
+    def test_reconcile_without_report(self):
+        """Test reconciling in bulk without reporting the drift"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2, user_following_id=self.uid1))
+        db.session.commit()
+        User.query.update({'following_count': 7, 'followers_count': 3})
+        db.session.commit()
+
+        self.assertEqual(counters.reconcile_all(report=False), {User: None, Message: None})
+        self.assertEqual(counters.reconcile_all(), {User: [], Message: []})
+        self.assertEqual(User.query.get(self.uid1).following_count, 1)
+        self.assertEqual(User.query.get(self.uid2).followers_count, 1)
+
+    #=========================================================================================================
+    # Password Hashing Tests
+    #=========================================================================================================
+
+    def test_rehash_on_login(self):
+        """Test a hash made at a different cost is replaced on login"""
+
+        self.u1.password = passwords.hash_password("password1", rounds=4)
+        db.session.commit()
+
+        user = User.authenticate("testuser1", "password1")
+        db.session.commit()
+
+        self.assertEqual(passwords.hash_rounds(user.password), passwords.settings['rounds'])
+        self.assertTrue(passwords.check_password(user.password, "password1"))
+
+    def test_password_pool_busy(self):
+        """Test hashing is refused once the queue is full"""
+
+        old_slots = passwords._slots
+        passwords._slots = BoundedSemaphore(1)
+        passwords._slots.acquire()
+        try:
+            with self.assertRaises(passwords.PasswordPoolBusy):
+                passwords.hash_password("password")
+        finally:
+            passwords._slots = old_slots
+
+    def test_password_pool_timeout(self):
+        """Test a slow hash gives PasswordPoolBusy, and holds its slot until done"""
+
+        future = Future()
+        old_slots = passwords._slots
+        passwords._slots = BoundedSemaphore(1)
+        try:
+            with patch.dict(passwords.settings, workers=1, timeout=0), \
+                    patch.object(passwords._get_pool(), 'submit', return_value=future):
+                with self.assertRaises(passwords.PasswordPoolBusy):
+                    passwords.hash_password("password")
+                with self.assertRaises(passwords.PasswordPoolBusy):
+                    passwords.hash_password("password")
+
+                future.set_result("hashed")
+                self.assertTrue(passwords._slots.acquire(blocking=False))
+        finally:
+            passwords._slots = old_slots
+
+    def test_password_pool_broken(self):
+        """Test a broken pool gives PasswordPoolBusy, and is replaced"""
+
+        with patch.dict(passwords.settings, workers=1):
+            pool = passwords._get_pool()
+            future = Future()
+            future.set_exception(BrokenProcessPool())
+            with patch.object(pool, 'submit', return_value=future):
+                with self.assertRaises(passwords.PasswordPoolBusy):
+                    passwords.hash_password("password")
+
+            self.assertIsNot(passwords._get_pool(), pool)
+            self.assertTrue(passwords.check_password(
+                passwords.hash_password("password", rounds=4), "password"))
+
+    def test_calibrate(self):
+        """Test calibration stops at the target latency"""
+
+        rounds, timings = passwords.calibrate(0, min_rounds=4, max_rounds=6)
+        self.assertEqual(rounds, 4)
+        self.assertEqual(list(timings), [4])
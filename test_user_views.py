@@ -8,6 +8,7 @@
 
 import os
 from unittest import TestCase
+from datetime import datetime
 from bs4 import BeautifulSoup
 
 from models import db, connect_db, Message, User, Follows, Likes
@@ -15,6 +16,11 @@ from models import db, connect_db, Message, User, Follows, Likes
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+import current_user
+import fragments
+import search
+from querystats import query_budget, record_requests
+import timeline
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 app.config['WTF_CSRF_ENABLED'] = False
@@ -32,6 +38,9 @@ class MessageViewTestCase(TestCase):
         Message.query.delete()
 
         self.client = app.test_client()
+        current_user.cache.clear()
+        fragments.cache.clear()
+        search.reset()
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -99,6 +108,72 @@ class MessageViewTestCase(TestCase):
 
             self.assertIn("@testuser", str(resp.data))
 
+    def test_user_show_pages(self):
+        """Test paging through /users/<user_id> with cursors"""
+
+        for i in range(5):
+            db.session.add(Message(id=100 + i, text=f"paged message {i}",
+                                   timestamp=datetime(2021, 1, 1 + i),
+                                   user_id=self.uid))
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.uid}")
+                self.assertIn("paged message 4", str(resp.data))
+                self.assertIn("paged message 3", str(resp.data))
+                self.assertNotIn("paged message 2", str(resp.data))
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                older = soup.find("a", string="Older")["href"]
+                self.assertIsNone(soup.find("a", string="Newer"))
+
+                resp = c.get(older)
+                self.assertIn("paged message 2", str(resp.data))
+                self.assertIn("paged message 1", str(resp.data))
+                self.assertNotIn("paged message 3", str(resp.data))
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                newer = soup.find("a", string="Newer")["href"]
+
+                resp = c.get(newer)
+                self.assertIn("paged message 4", str(resp.data))
+                self.assertIn("paged message 3", str(resp.data))
+                self.assertNotIn("paged message 2", str(resp.data))
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_user_show_bad_cursor(self):
+        """Test /users/<user_id> with a malformed cursor"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.uid}?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_current_user_cached(self):
+        """Test the logged-in user is served from the cache until it changes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            with record_requests() as first:
+                c.get(f"/users/{self.u1_id}")
+            with record_requests() as second:
+                c.get(f"/users/{self.u1_id}")
+
+            self.assertEqual(second[0][1].count, first[0][1].count - 1)
+
+            resp = c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "password": "testuser",
+            }, follow_redirects=True)
+
+            self.assertIn("@renamed", str(resp.data))
+            self.assertEqual(current_user.load(self.uid).username, "renamed")
+
     #=========================================================================================================
     # Follow Tests
     #=========================================================================================================
@@ -146,6 +221,23 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn("@user3", str(resp.data))
             self.assertNotIn("@user4", str(resp.data))
 
+    def test_users_follow_buttons(self):
+        """Test /users shows follow state for each user"""
+
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.get("/users")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            actions = {form["action"] for form in soup.find_all("form")}
+
+            self.assertIn(f"/users/stop-following/{self.u1_id}", actions)
+            self.assertIn(f"/users/stop-following/{self.u2_id}", actions)
+            self.assertIn(f"/users/follow/{self.u3_id}", actions)
+            self.assertIn(f"/users/follow/{self.u4_id}", actions)
+
     def test_unauth_following_access(self):
         """Test fail of /users/<user_id>/following with no session"""
 
@@ -233,6 +325,55 @@ class MessageViewTestCase(TestCase):
             # There are no liked messages
             self.assertEqual(len(likes), 0)
 
+    def test_likes_per_user(self):
+        """Test many users can like a message, and unlike only their own like"""
+
+        db.session.add(Message(id=777, text="Popular message", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            for user_id in [self.uid, self.u2_id, self.u3_id]:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post("/users/add_like/777")
+
+            self.assertEqual(Message.query.get(777).like_count, 3)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post("/users/remove_like/777")
+
+            likers = {like.user_id for like in Likes.query.filter_by(message_id=777)}
+            self.assertEqual(likers, {self.uid, self.u3_id})
+            self.assertEqual(Message.query.get(777).like_count, 2)
+
+            # liking a message that doesn't exist
+            self.assertEqual(c.post("/users/add_like/99999").status_code, 404)
+
+    def test_homepage_likes(self):
+        """Test the homepage marks the viewer's likes among its messages"""
+
+        db.session.add_all([
+            Follows(user_being_followed_id=self.u1_id, user_following_id=self.uid),
+            Message(id=777, text="Liked message", user_id=self.u1_id),
+            Message(id=778, text="Unliked message", user_id=self.u1_id),
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.uid, message_id=777))
+        db.session.commit()
+        with app.app_context():
+            timeline.rebuild_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            soup = BeautifulSoup(c.get("/").get_data(as_text=True), 'html.parser')
+
+            self.assertIsNotNone(soup.find('form', action="/users/remove_like/777"))
+            self.assertIsNotNone(soup.find('form', action="/users/add_like/778"))
+            self.assertEqual(soup.find(attrs={'data-like-count': '777'}).text, '1')
+
     def test_like_no_auth(self):
         """Test fail of like message with no session"""
 
@@ -307,4 +448,402 @@ class MessageViewTestCase(TestCase):
             self.assertIn("2", found[2].text)
 
             # Test for a count of 0 likes
-            self.assertIn("0", found[3].text)
\ No newline at end of file
+            self.assertIn("0", found[3].text)
+
+    #=========================================================================================================
+    # Query Budget Tests
+    #=========================================================================================================
+
+    def setup_authors(self):
+        """Setup messages from several followed authors, all liked by testuser"""
+
+        self.setup_followers()
+        for uid in (self.u1_id, self.u2_id):
+            for i in range(3):
+                db.session.add(Message(id=uid * 10 + i, text=f"message {i} from {uid}", user_id=uid))
+        db.session.add_all([
+            Follows(user_being_followed_id=self.u3_id, user_following_id=self.uid),
+            Message(id=self.u3_id * 10, text="message from u3", user_id=self.u3_id),
+        ])
+        db.session.commit()
+
+        # messages added directly skip fan-out, so build timelines from them
+        with app.app_context():
+            timeline.rebuild_all()
+
+        for mid in (self.u1_id * 10, self.u2_id * 10, self.u3_id * 10):
+            db.session.add(Likes(user_id=self.uid, message_id=mid))
+        db.session.commit()
+
+    def test_homepage_queries(self):
+        """Test the homepage doesn't issue a query per author"""
+
+        self.setup_authors()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            with query_budget(self, 4):
+                resp = c.get("/")
+
+            self.assertIn("message from u3", str(resp.data))
+
+    def test_likes_queries(self):
+        """Test /users/<user_id>/likes doesn't issue a query per author"""
+
+        self.setup_authors()
+        with self.client as c:
+            with query_budget(self, 2):
+                resp = c.get(f"/users/{self.uid}/likes")
+
+            self.assertIn("message from u3", str(resp.data))
+            self.assertIn("@user2", str(resp.data))
+
+    #=========================================================================================================
+    # Conditional Response Tests
+    #=========================================================================================================
+
+    def test_user_show_not_modified(self):
+        """Test /users/<user_id> answers a matching If-None-Match with 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.get(f"/users/{self.u1_id}")
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+            self.assertIn('Cookie', resp.headers['Vary'])
+
+            with query_budget(self, 1):
+                resp = c.get(f"/users/{self.u1_id}", headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+    def test_etag_changes(self):
+        """Test following someone or editing a profile changes the ETags"""
+
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            profile = c.get(f"/users/{self.u3_id}").headers['ETag']
+            following = c.get(f"/users/{self.uid}/following").headers['ETag']
+
+            c.post(f"/users/follow/{self.u3_id}")
+
+            self.assertNotEqual(c.get(f"/users/{self.u3_id}").headers['ETag'], profile)
+            following_after = c.get(f"/users/{self.uid}/following").headers['ETag']
+            self.assertNotEqual(following_after, following)
+
+        user1 = User.query.get(self.u1_id)
+        user1.bio = "A new bio"
+        db.session.commit()
+        current_user.cache.clear()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.uid}/following",
+                         headers={'If-None-Match': following_after})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("A new bio", str(resp.data))
+
+    def test_etag_follows_viewer_row(self):
+        """Test the viewer's part of an ETag comes from the database, not the current-user cache"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            etag = c.get(f"/users/{self.u1_id}").headers['ETag']
+
+            # e.g. changed by another process, whose cache this one doesn't share
+            User.query.filter_by(id=self.uid).update(
+                {User.activity_version: User.activity_version + 1})
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.u1_id}", headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_not_modified_with_flash(self):
+        """Test pages aren't 304'd (or tagged) while a flash is waiting"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            etag = c.get(f"/users/{self.u1_id}").headers['ETag']
+
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello again')]
+
+            resp = c.get(f"/users/{self.u1_id}", headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello again", str(resp.data))
+            self.assertNotIn('ETag', resp.headers)
+
+    def test_uncached_pages(self):
+        """Test pages without validators aren't stored at all"""
+
+        with self.client as c:
+            resp = c.get("/signup")
+
+            self.assertNotIn('ETag', resp.headers)
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+            self.assertIn('private', resp.headers['Cache-Control'])
+
+    def test_static_max_age(self):
+        """Test static files may be cached"""
+
+        with self.client as c:
+            resp = c.get("/static/stylesheets/style.css")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"max-age={app.config['SEND_FILE_MAX_AGE_DEFAULT']}",
+                          resp.headers['Cache-Control'])
+            resp.close()
+
+    #=========================================================================================================
+    # Message Card Cache Tests
+    #=========================================================================================================
+
+    def test_message_cards_shared(self):
+        """Test message cards are rendered once, with buttons per viewer"""
+
+        db.session.add(Message(id=777, text="A shared card", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/777")
+            self.assertIn("A shared card", str(resp.data))
+            self.assertIn("/messages/777/delete", str(resp.data))
+            self.assertEqual(len(fragments.cache), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.get("/messages/777")
+            self.assertIn("A shared card", str(resp.data))
+            self.assertNotIn("/messages/777/delete", str(resp.data))
+            self.assertIn(f"/users/follow/{self.u1_id}", str(resp.data))
+            self.assertEqual(len(fragments.cache), 1)
+
+    def test_message_cards_invalidated(self):
+        """Test cached cards are dropped after a profile edit or delete"""
+
+        db.session.add(Message(id=777, text="A cached card", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u1_id}")
+            self.assertEqual(len(fragments.cache), 1)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test1@test.com",
+                                           "password": "password1"})
+            self.assertEqual(len(fragments.cache), 0)
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn("@renamed", str(resp.data))
+            self.assertNotIn("@user1", str(resp.data))
+
+            c.post("/messages/777/delete")
+            self.assertEqual(len(fragments.cache), 0)
+
+    def test_fragment_cache_bounded(self):
+        """Test the card cache evicts its least recently used entries"""
+
+        cache = fragments.FragmentCache(maxsize=2)
+        cache.set(('card', 1, 0), 10, 'one')
+        cache.set(('card', 2, 0), 10, 'two')
+        cache.get(('card', 1, 0))
+        cache.set(('card', 3, 0), 20, 'three')
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(('card', 2, 0)))
+        self.assertEqual(cache.get(('card', 1, 0)), 'one')
+
+        cache.invalidate_author(10)
+        self.assertIsNone(cache.get(('card', 1, 0)))
+        self.assertEqual(cache.get(('card', 3, 0)), 'three')
+
+    #=========================================================================================================
+    # JSON Like / Follow Tests
+    #=========================================================================================================
+
+    def test_like_json(self):
+        """Test liking and unliking answer JSON, and are idempotent"""
+
+        db.session.add(Message(id=777, text="Like me", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            for i in range(2):
+                resp = c.post("/users/add_like/777", headers={'Accept': 'application/json'})
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json, {'message_id': 777, 'liked': True,
+                                             'like_count': 1,
+                                             'user_id': self.uid, 'likes_count': 1})
+
+            for i in range(2):
+                resp = c.post("/users/remove_like/777", headers={'Accept': 'application/json'})
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json['liked'], False)
+                self.assertEqual(resp.json['like_count'], 0)
+                self.assertEqual(resp.json['likes_count'], 0)
+
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_like_own_message_json(self):
+        """Test liking your own message answers 403 JSON"""
+
+        db.session.add(Message(id=777, text="My own", user_id=self.uid))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.post("/users/add_like/777", headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.status_code, 403)
+            self.assertIn('error', resp.json)
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_follow_json(self):
+        """Test following and unfollowing answer JSON, and are idempotent"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            for i in range(2):
+                resp = c.post(f"/users/follow/{self.u1_id}",
+                              headers={'Accept': 'application/json'})
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json, {'user_id': self.u1_id, 'following': True,
+                                             'followers_count': 1,
+                                             'follower_id': self.uid,
+                                             'following_count': 1})
+
+            resp = c.post(f"/users/stop-following/{self.u1_id}",
+                          headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.json['following'], False)
+            self.assertEqual(resp.json['followers_count'], 0)
+            self.assertEqual(resp.json['following_count'], 0)
+
+            # browsers still get redirected
+            resp = c.post(f"/users/follow/{self.u1_id}",
+                          headers={'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8'})
+            self.assertEqual(resp.status_code, 302)
+
+    def test_follow_missing_user(self):
+        """Test following (or unfollowing, for JSON) someone who doesn't exist 404s"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.post("/users/follow/99999")
+
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(Follows.query.count(), 0)
+
+            resp = c.post("/users/stop-following/99999",
+                          headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_follow(self):
+        """Test following and unfollowing many users in one request"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            resp = c.post("/users/follows",
+                          json={'follow': [self.u1_id, self.u2_id, self.u3_id, 99999]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {'followed': [self.u1_id, self.u2_id, self.u3_id],
+                                         'unfollowed': [],
+                                         'following_count': 3})
+
+            # already-followed ids are skipped
+            resp = c.post("/users/follows",
+                          json={'follow': [self.u3_id, self.u4_id],
+                                'unfollow': [self.u1_id, self.u2_id]})
+
+            self.assertEqual(resp.json, {'followed': [self.u4_id],
+                                         'unfollowed': [self.u1_id, self.u2_id],
+                                         'following_count': 2})
+
+            self.assertEqual({f.user_being_followed_id for f in
+                              Follows.query.filter_by(user_following_id=self.uid)},
+                             {self.u3_id, self.u4_id})
+            self.assertEqual(User.query.get(self.u1_id).followers_count, 0)
+            self.assertEqual(User.query.get(self.u4_id).followers_count, 1)
+
+    def test_bulk_follow_bad_request(self):
+        """Test bulk follows need lists of ids, and no more than the limit"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid
+
+            self.assertEqual(c.post("/users/follows", data={'follow': self.u1_id}).status_code, 400)
+            self.assertEqual(c.post("/users/follows", json={'follow': ["1"]}).status_code, 400)
+
+            app.config['FOLLOW_BULK_LIMIT'] = 1
+            try:
+                resp = c.post("/users/follows", json={'follow': [self.u1_id, self.u2_id]})
+                self.assertEqual(resp.status_code, 413)
+            finally:
+                app.config['FOLLOW_BULK_LIMIT'] = 5000
+
+            self.assertEqual(Follows.query.count(), 0)
+
+    def test_toggles_need_csrf_token(self):
+        """Test likes and follows are refused without a CSRF token"""
+
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid
+
+                resp = c.post(f"/users/follow/{self.u1_id}",
+                              headers={'Accept': 'application/json'})
+                self.assertEqual(resp.status_code, 400)
+
+                page = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+                token = BeautifulSoup(page, 'html.parser').find(
+                    'input', attrs={'name': 'csrf_token'})['value']
+
+                resp = c.post(f"/users/follow/{self.u1_id}", data={'csrf_token': token},
+                              headers={'Accept': 'application/json'})
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.json['following'])
+
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
@@ -0,0 +1,428 @@
+"""Materialized home timelines for Warbler.
+
+Every user has a bounded ring of the newest message ids from the accounts
+they follow (plus their own) in `timeline_entries`. New messages are fanned
+out into those rings when they're posted, so reading a timeline doesn't
+depend on how many accounts a user follows.
+
+Accounts with more than TIMELINE_FANOUT_LIMIT followers aren't fanned out
+(one post would mean thousands of writes); their messages are merged into
+their followers' timelines at read time instead. When one comes back down
+to the limit, their recent messages are fanned out then.
+
+Rings are trimmed back to TIMELINE_SIZE lazily: each post trims the rings
+of about one in TIMELINE_TRIM_EVERY of its recipients, so a ring runs
+around that many entries over its size between trims. Once a ring has
+been trimmed, history older than its oldest entry is read from the follow
+graph instead.
+"""
+
+from flask import current_app
+from sqlalchemy import func, literal, select, union
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import decode_cursor, paginate
+import snowflake
+
+ENTRY_COLUMNS = ['user_id', 'message_id']
+
+# above every message id (the largest BIGINT)
+MAX_MESSAGE_ID = (1 << 63) - 1
+
+
+def timeline_size():
+    """Number of message ids kept in each user's timeline."""
+
+    return current_app.config['TIMELINE_SIZE']
+
+
+def fanout_limit():
+    """Follower count above which an account's messages are pulled, not pushed."""
+
+    return current_app.config['TIMELINE_FANOUT_LIMIT']
+
+
+def trim_every():
+    """Each post trims about one in this many of its recipients' rings."""
+
+    return current_app.config['TIMELINE_TRIM_EVERY']
+
+
+def is_pulled(user_id):
+    """Does `user_id` have too many followers to fan out to?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) > fanout_limit()
+
+
+def pulled_authors(user_id=None):
+    """Query of high-follower account ids (followed by `user_id`, if given)."""
+
+    query = (db.session
+             .query(User.id)
+             .filter(User.followers_count > fanout_limit()))
+
+    if user_id is not None:
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+        query = query.filter(User.id.in_(followed.subquery()))
+
+    return query
+
+
+def timeline_sources(user_id):
+    """Message queries whose union is `user_id`'s home timeline.
+
+    That's the user's materialized ring plus messages from any
+    high-follower accounts they follow.
+    """
+
+    ring = (db.session
+            .query(TimelineEntry.message_id)
+            .filter(TimelineEntry.user_id == user_id))
+
+    pushed = Message.query.filter(Message.id.in_(ring.subquery()))
+    pulled = Message.query.filter(
+        Message.user_id.in_(pulled_authors(user_id).subquery()))
+
+    return [pushed, pulled]
+
+
+def timeline_query(user_id):
+    """Query of the messages on `user_id`'s home timeline, newest first."""
+
+    pushed, pulled = timeline_sources(user_id)
+
+    return (pushed
+            .union(pulled)
+            .order_by(Message.id.desc()))
+
+
+def followed_query(user_id):
+    """Query of messages by `user_id` and everyone they follow.
+
+    This is the timeline without the materialized ring, used for history
+    older than the ring reaches.
+    """
+
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))
+
+    return Message.query.filter(
+        Message.user_id.in_(followed.subquery()) | (Message.user_id == user_id))
+
+
+def ring_horizon(user_id):
+    """Message id below which `user_id`'s ring may be missing messages, or
+    None if the ring has never been trimmed (so it's their whole timeline).
+
+    A trimmed ring is complete from its oldest entry up: trims only cut
+    from the bottom, and backfills after a trim don't reach below it.
+    """
+
+    oldest = (db.session
+              .query(func.min(TimelineEntry.message_id))
+              .filter(TimelineEntry.user_id == user_id)
+              .as_scalar())
+
+    row = (db.session
+           .query(User.timeline_trimmed, oldest)
+           .filter(User.id == user_id)
+           .first())
+
+    if row is None or not row[0]:
+        return None
+
+    # trimmed, then emptied: all of the timeline is history
+    return row[1] if row[1] is not None else MAX_MESSAGE_ID
+
+
+def timeline_page(user_id, before=None, after=None, per_page=100, options=(),
+                  project=None):
+    """One page of `user_id`'s home timeline (see `pagination.paginate`).
+
+    Pages within the ring are served from it; pages reaching below the
+    horizon of a trimmed ring come from the follow graph instead.
+    """
+
+    def from_follows():
+        return paginate(followed_query(user_id), before, after, per_page, options,
+                        project=project)
+
+    horizon = ring_horizon(user_id)
+
+    if horizon is not None:
+        if after and decode_cursor(after) < horizon:
+            return from_follows()
+        if before and decode_cursor(before) <= horizon:
+            return from_follows()
+
+    page = paginate(timeline_sources(user_id), before, after, per_page, options,
+                    project=project)
+
+    # the ring ran out, or pulled authors' messages went past its horizon
+    if (horizon is not None and not after
+            and (page.older is None or page.items[-1].id < horizon)):
+        page = from_follows()
+
+    return page
+
+
+def fan_out(message):
+    """Add a newly posted `message` to its author's and followers' timelines."""
+
+    author_id = message.user_id
+    recipients = [author_id]
+
+    rows = db.session.query(literal(author_id), literal(message.id))
+
+    if not is_pulled(author_id):
+        rows = rows.union_all(
+            db.session
+            .query(Follows.user_following_id, literal(message.id))
+            .filter(Follows.user_being_followed_id == author_id)
+            .filter(Follows.user_following_id != author_id))
+
+        # this post's slice of the recipients, by the millisecond it was made
+        every = trim_every()
+        slot = (message.id >> snowflake.TIME_SHIFT) % every
+        recipients = (db.session
+                      .query(Follows.user_following_id)
+                      .filter(Follows.user_being_followed_id == author_id)
+                      .filter(Follows.user_following_id % every == slot)
+                      .union(db.session.query(literal(author_id))))
+
+    _insert(rows)
+    _trim(recipients)
+
+
+def add_authors(user_id, author_ids):
+    """Backfill `author_ids`' recent messages after `user_id` follows them."""
+
+    pushed = (db.session
+              .query(User.id)
+              .filter(User.id.in_(author_ids))
+              .filter(User.followers_count <= fanout_limit()))
+
+    existing = (db.session
+                .query(TimelineEntry.message_id)
+                .filter(TimelineEntry.user_id == user_id))
+
+    # only the newest TIMELINE_SIZE across all of them could survive the
+    # trim; one more, if there is one, makes sure the ring counts as trimmed
+    rows = (db.session
+            .query(literal(user_id), Message.id)
+            .filter(Message.user_id.in_(pushed.subquery()))
+            .filter(~Message.id.in_(existing.subquery())))
+
+    horizon = ring_horizon(user_id)
+    if horizon is not None:
+        rows = rows.filter(Message.id > horizon)
+
+    _insert(rows.order_by(Message.id.desc()).limit(timeline_size() + 1))
+    _trim([user_id])
+
+
+def backfill_unpulled(author_ids):
+    """Fan out the recent messages of any of `author_ids` who have just come
+    down to TIMELINE_FANOUT_LIMIT followers, e.g. after an unfollow.
+
+    Their messages were merged in at read time while they had more, so
+    they're in no one's ring; from now on they'd be read from rings alone.
+    Returns the ids of the authors backfilled.
+    """
+
+    unpulled = [user_id for (user_id,) in
+                db.session
+                .query(User.id)
+                .filter(User.id.in_(author_ids))
+                .filter(User.followers_count == fanout_limit())]
+
+    for author_id in unpulled:
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == author_id)
+                     .filter(Follows.user_following_id != author_id))
+
+        # as in add_authors: only the newest TIMELINE_SIZE could survive
+        # the trim, and one more marks rings with older history trimmed
+        recent = (db.session
+                  .query(Message.id)
+                  .filter(Message.user_id == author_id)
+                  .order_by(Message.id.desc())
+                  .limit(timeline_size() + 1)
+                  .subquery())
+
+        oldest = (db.session
+                  .query(func.min(TimelineEntry.message_id))
+                  .filter(TimelineEntry.user_id == User.id)
+                  .as_scalar())
+
+        existing = (db.session
+                    .query(TimelineEntry.message_id)
+                    .filter(TimelineEntry.user_id == User.id)
+                    .filter(TimelineEntry.message_id == recent.c.id))
+
+        # nothing below a trimmed ring's horizon (see ring_horizon)
+        rows = (db.session
+                .query(User.id, recent.c.id)
+                .filter(User.id.in_(followers.subquery()))
+                .filter(User.timeline_trimmed.is_(False)
+                        | (recent.c.id > func.coalesce(oldest, MAX_MESSAGE_ID)))
+                .filter(~existing.exists()))
+
+        _insert(rows)
+        _trim(followers)
+
+    return unpulled
+
+
+def remove_authors(user_id, author_ids):
+    """Drop `author_ids`' messages after `user_id` unfollows them."""
+
+    authored = db.session.query(Message.id).filter(Message.user_id.in_(author_ids))
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id)
+     .filter(TimelineEntry.message_id.in_(authored.subquery()))
+     .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    """Drop a deleted message from every timeline it was fanned out to."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def remove_user(user_id):
+    """Drop a deleted user's own timeline and their messages in others'."""
+
+    authored = db.session.query(Message.id).filter(Message.user_id == user_id)
+
+    (TimelineEntry
+     .query
+     .filter((TimelineEntry.user_id == user_id)
+             | TimelineEntry.message_id.in_(authored.subquery()))
+     .delete(synchronize_session=False))
+
+
+def rebuild(user_ids):
+    """Recompute the timelines of `user_ids` from `messages` and `follows`."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id.in_(user_ids))
+     .delete(synchronize_session=False))
+
+    (User
+     .query
+     .filter(User.id.in_(user_ids))
+     .update({User.timeline_trimmed: False}, synchronize_session=False))
+
+    followed = (db.session
+                .query(Follows.user_following_id.label('user_id'),
+                       Message.id.label('message_id'))
+                .join(Message, Message.user_id == Follows.user_being_followed_id)
+                .filter(Follows.user_following_id.in_(user_ids))
+                .filter(~Follows.user_being_followed_id.in_(
+                    pulled_authors().subquery())))
+
+    own = (db.session
+           .query(Message.user_id, Message.id)
+           .filter(Message.user_id.in_(user_ids)))
+
+    candidates = union(followed.statement, own.statement).alias('candidates')
+
+    rank = func.row_number().over(
+        partition_by=candidates.c.user_id,
+        order_by=candidates.c.message_id.desc())
+
+    ranked = (db.session
+              .query(candidates.c.user_id,
+                     candidates.c.message_id,
+                     rank.label('rank'))
+              .subquery())
+
+    # one more than fits, so users with older history are trimmed
+    rows = (db.session
+            .query(ranked.c.user_id, ranked.c.message_id)
+            .filter(ranked.c.rank <= timeline_size() + 1))
+
+    _insert(rows)
+    _trim(user_ids)
+
+
+def rebuild_all(batch_size=500):
+    """Rebuild every user's timeline, committing after each batch of users.
+
+    Returns the number of users rebuilt.
+    """
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).order_by(User.id)]
+
+    for start in range(0, len(user_ids), batch_size):
+        rebuild(user_ids[start:start + batch_size])
+        db.session.commit()
+
+    return len(user_ids)
+
+
+def _insert(rows):
+    """Insert (user_id, message_id) rows selected by `rows`."""
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(ENTRY_COLUMNS, rows.statement))
+
+
+def _trim(user_ids):
+    """Drop entries beyond the timeline size for each of `user_ids`.
+
+    Each ring is cut below its (TIMELINE_SIZE + 1)th newest entry, found by
+    one bounded walk down the primary key; nothing is ranked or sorted.
+    Users whose rings lost entries are marked as trimmed (see
+    `ring_horizon`), and their ids returned.
+    """
+
+    if not isinstance(user_ids, list):
+        user_ids = user_ids.subquery()
+
+    entries = TimelineEntry.__table__
+    newer = entries.alias('newer')
+
+    cutoff = (select([newer.c.message_id])
+              .where(newer.c.user_id == User.id)
+              .order_by(newer.c.message_id.desc())
+              .offset(timeline_size())
+              .limit(1)
+              .as_scalar())
+
+    cutoffs = (select([User.id.label('user_id'), cutoff.label('message_id')])
+               .where(User.id.in_(user_ids))
+               .alias('cutoffs'))
+
+    trimmed = db.session.execute(
+        entries.delete()
+        .where(entries.c.user_id == cutoffs.c.user_id)
+        .where(entries.c.message_id <= cutoffs.c.message_id)
+        .returning(entries.c.user_id))
+
+    trimmed = {user_id for (user_id,) in trimmed}
+
+    if trimmed:
+        (User
+         .query
+         .filter(User.id.in_(trimmed))
+         .filter(User.timeline_trimmed.is_(False))
+         .update({User.timeline_trimmed: True}, synchronize_session=False))
+
+    return trimmed